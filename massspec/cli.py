@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface, ``massspec <command>`` or ``python -m massspec``.
+
+    convert     raw files to xlsx, parquet, hdf5, mat, npz or the spectrum cache
+    summarize   scans, points, m/z range and total ion count of raw files
+    track       integrated areas of tracked masses over the files of runs
+    watch       live view of a run directory
+    benchmark   timings and peak memory of the hot paths on synthetic runs
+
+Paths can be files, directories or glob patterns. Files (directories for
+``track``) are processed in parallel on ``--jobs`` worker processes.
+``convert`` appends every finished file to a progress file, an interrupted
+conversion started again skips the files that are converted and did not
+change since. ``--report`` writes a JSON report of the run.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+from .core.readers import reader_suffixes
+from .core.state import file_signature
+from .core import profiling
+from .core.precision import INTENSITY_DTYPES, CODECS
+
+FORMATS = {'xlsx': '.xlsx',
+           'parquet': '.parquet',
+           'hdf5': '.h5',
+           'mat': '.mat',
+           'npz': '.npz',
+           'cache': '.msc'}
+PROGRESS_FILE = '.massspec-progress.jsonl'
+
+
+def _file_number(name):
+    from .core.raw_file import _file_number
+    return _file_number(name)
+
+
+def expand_paths(paths, reader=None, directories=False):
+    # files (or directories) matching paths, directories are expanded to
+    # their raw files in the numeric order of the names
+    suffixes = reader_suffixes(reader)
+    ret = []
+    for path in paths:
+        if glob.has_magic(path):
+            matches = [Path(x) for x in sorted(glob.glob(path, recursive=True))]
+        else:
+            matches = [Path(path)]
+        if len(matches) == 0 or not matches[0].exists():
+            print(f"{path} does not exist, skipping", file=sys.stderr)
+            continue
+        for match in matches:
+            if directories:
+                if match.is_dir():
+                    ret.append(match)
+            elif match.is_dir():
+                files = [x for x in match.iterdir() if x.suffix.lower() in suffixes]
+                ret.extend(sorted(files, key=lambda x: (_file_number(x.name), x.name)))
+            elif match.suffix.lower() in suffixes:
+                ret.append(match)
+    unique = {}
+    for path in ret:
+        unique.setdefault(path.resolve(), path)
+    return list(unique.values())
+
+
+class Progress(object):
+    """
+    Finished files of a conversion, one JSON line per file. A file is done
+    if it was converted to the same output and its size and modification
+    time did not change since.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.done = {}
+        if self.path.exists():
+            with open(self.path) as rf:
+                for line in rf:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of an interrupted run
+                        continue
+                    self.done[entry['file'], entry['format']] = entry
+
+    def is_done(self, filename, fmt, output):
+        entry = self.done.get((Path(filename).resolve().as_posix(), fmt))
+        if entry is None or entry['output'] != Path(output).as_posix():
+            return False
+        try:
+            signature = file_signature(filename)
+        except OSError:
+            return False
+        return list(signature) == entry['signature'] and Path(output).exists()
+
+    def add(self, result):
+        entry = dict(file=Path(result['file']).resolve().as_posix(),
+                     format=result['format'],
+                     output=result['output'],
+                     signature=result['signature'])
+        self.done[entry['file'], entry['format']] = entry
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as wf:
+            wf.write(json.dumps(entry) + '\n')
+
+
+def output_path(filename, fmt, output=None, cache=None):
+    # next to the source file, or in output/<source directory name>/
+    filename = Path(filename)
+    if fmt == 'cache':
+        return cache.path_for(filename)
+    if output is None:
+        return filename.with_suffix(FORMATS[fmt])
+    return Path(output) / filename.parent.resolve().name / (filename.stem + FORMATS[fmt])
+
+
+def convert_file(args):
+    # module level so that it can be sent to worker processes
+    filename, fmt, path, options = args
+    start = time.perf_counter()
+    result = dict(file=Path(filename).as_posix(), format=fmt, output=Path(path).as_posix(),
+                  status='ok', error=None, nspectra=None)
+    try:
+        result['signature'] = list(file_signature(filename))
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if fmt == 'cache':
+            from .core.cache import SpectrumCache, read_metadata
+            cache_file = SpectrumCache(path.parent, options['reader'], precision=options['precision'],
+                                       compression=options['compression']).build(filename)
+            result['error_bounds'] = read_metadata(cache_file).get('error_bounds')
+        else:
+            from .core.raw_file import RawFile
+            raw_file = RawFile(filename, reader=options['reader'], lazy=True)
+            if raw_file.has_error:
+                raise Exception(f'{filename} could not be read')
+            result['nspectra'] = raw_file.nspectra
+            # written next to the output and renamed, an interrupted
+            # conversion never leaves a partial file behind
+            tmp_path = path.with_name(f".{path.name}.part")
+            if fmt == 'xlsx':
+                raw_file.to_excel(tmp_path, rounding=options['decimals'] is not None,
+                                  decimals=options['decimals'] or 2, overwrite=True,
+                                  streaming=True)
+            elif fmt == 'parquet':
+                raw_file.to_parquet(tmp_path)
+            elif fmt == 'hdf5':
+                raw_file.to_hdf5(tmp_path, precision=options['precision'])
+            elif fmt == 'mat':
+                raw_file.to_matlab(tmp_path)
+            elif fmt == 'npz':
+                result['error_bounds'] = raw_file.to_npz(tmp_path, precision=options['precision'],
+                                                         compression=options['compression'])
+            # savemat and savez add their suffix to the name
+            for suffix in ['', '.mat', '.npz']:
+                if Path(f"{tmp_path}{suffix}").exists():
+                    os.replace(f"{tmp_path}{suffix}", path)
+                    break
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def summarize_file(args):
+    filename, options = args
+    start = time.perf_counter()
+    result = dict(file=Path(filename).as_posix(), status='ok', error=None)
+    try:
+        from .core.raw_file import RawFile
+        raw_file = RawFile(filename, reader=options['reader'], lazy=True)
+        if raw_file.has_error:
+            raise Exception(f'{filename} could not be read')
+        npoints, tic = 0, 0.0
+        low, high = np.inf, -np.inf
+        # scans are streamed, the file is never loaded as a whole
+        for _, store in raw_file.iter_spectra():
+            npoints += len(store.mz)
+            tic += float(store.intensity.sum())
+            if len(store.mz) > 0:
+                low, high = min(low, float(store.mz.min())), max(high, float(store.mz.max()))
+        times = raw_file.start_times
+        result.update(nspectra=raw_file.nspectra, npoints=npoints,
+                      mz_min=low if npoints else None, mz_max=high if npoints else None,
+                      rt_min=float(np.nanmin(times)) if np.isfinite(times).any() else None,
+                      rt_max=float(np.nanmax(times)) if np.isfinite(times).any() else None,
+                      tic=tic, mass_resolution=raw_file.mass_resolution)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def track_directory(args):
+    directory, options = args
+    from .core.raw_file import RawFileCollection
+    start = time.perf_counter()
+    result = dict(file=Path(directory).as_posix(), status='ok', error=None)
+    try:
+        collection = RawFileCollection(directory, interpolation=None,
+                                       track_mass=options['masses'],
+                                       delta_mz=options['delta_mz'], dmz=options['dmz'],
+                                       reader=options['reader'], n_jobs=options['n_jobs'],
+                                       lazy=True, state=options['state'])
+        areas = np.array(collection.track_area, dtype=float).reshape(collection.nfiles, -1)
+        result['files'] = collection.files
+        result['masses'] = collection.track_masses.tolist()
+        result['track_area'] = areas.tolist()
+        result['total_area'] = np.array(collection.total_area, dtype=float).tolist()
+        result['errors'] = list(collection.errors)
+        if options['output'] is not None:
+            path = Path(options['output']) / f"{Path(directory).resolve().name}-track.csv"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w') as wf:
+                write_track_csv(wf, result)
+            result['output'] = path.as_posix()
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def write_track_csv(wf, result):
+    columns = ['file'] + [f"{mass} Count" for mass in result['masses']] + ['Total Count']
+    wf.write(','.join(columns) + '\n')
+    for name, areas, total in zip(result['files'], result['track_area'], result['total_area']):
+        wf.write(','.join([name] + [repr(x) for x in areas] + [repr(total)]) + '\n')
+
+
+def _run_task(args):
+    # stages profiled in a worker process go back with the result
+    function, task = args
+    with profiling.collect() as stages:
+        result = function(task)
+    if stages:
+        result['profile'] = stages
+    return result
+
+
+def run_tasks(function, tasks, jobs=1, callback=None):
+    # results in the order they finish, jobs=1 runs in this process
+    results = []
+    if jobs == 1 or len(tasks) < 2:
+        for task in tasks:
+            results.append(function(task))
+            if callback is not None:
+                callback(results[-1])
+        return results
+    jobs = min(jobs or os.cpu_count(), len(tasks))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_run_task, (function, task)) for task in tasks]
+        for future in as_completed(futures):
+            results.append(future.result())
+            profiling.merge(results[-1].pop('profile', None))
+            if callback is not None:
+                callback(results[-1])
+    return results
+
+
+def _print_result(result):
+    if result['status'] == 'failed':
+        print(f"{result['file']}: failed", file=sys.stderr)
+        print(result['error'], file=sys.stderr)
+    elif result['status'] == 'skipped':
+        print(f"{result['file']}: up to date", file=sys.stderr)
+    else:
+        print(f"{result['file']}: {result['seconds']:.2f} s", file=sys.stderr)
+
+
+def write_report(path, command, args, results, start):
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    report = dict(command=command,
+                  arguments={k: v for k, v in vars(args).items() if k != 'func'},
+                  started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+                  seconds=time.time() - start,
+                  counts=counts,
+                  results=results)
+    text = json.dumps(report, indent=2, default=str)
+    if path == '-':
+        print(text)
+    else:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as wf:
+            wf.write(text)
+    return report
+
+
+def convert(args):
+    start = time.time()
+    files = expand_paths(args.paths, args.reader)
+    cache = None
+    if args.to == 'cache':
+        from .core.cache import SpectrumCache
+        cache = SpectrumCache(args.output, args.reader, precision=args.precision,
+                              compression=args.compress)
+    if args.progress is not None:
+        progress_path = Path(args.progress)
+    elif args.output is not None:
+        progress_path = Path(args.output) / PROGRESS_FILE
+    else:
+        progress_path = Path(PROGRESS_FILE)
+    progress = Progress(progress_path)
+    options = dict(reader=args.reader, decimals=args.decimals, precision=args.precision,
+                   compression=args.compress)
+    tasks, results = [], []
+    for filename in files:
+        path = output_path(filename, args.to, args.output, cache)
+        if not args.force and progress.is_done(filename, args.to, path):
+            results.append(dict(file=filename.as_posix(), format=args.to,
+                                output=path.as_posix(), status='skipped'))
+            _print_result(results[-1])
+        else:
+            tasks.append((filename, args.to, path, options))
+
+    def finished(result):
+        if result['status'] == 'ok':
+            progress.add(result)
+        _print_result(result)
+
+    results += run_tasks(convert_file, tasks, args.jobs, finished)
+    return results, start
+
+
+def summarize(args):
+    start = time.time()
+    files = expand_paths(args.paths, args.reader)
+    tasks = [(filename, dict(reader=args.reader)) for filename in files]
+    results = run_tasks(summarize_file, tasks, args.jobs)
+    order = {x.as_posix(): i for i, x in enumerate(files)}
+    results.sort(key=lambda x: order[x['file']])
+    columns = ['file', 'nspectra', 'npoints', 'mz_min', 'mz_max', 'rt_min', 'rt_max', 'tic']
+    if args.report != '-':
+        print('\t'.join(columns))
+        for result in results:
+            if result['status'] == 'failed':
+                _print_result(result)
+            else:
+                print('\t'.join(str(result[x]) for x in columns))
+    return results, start
+
+
+def track(args):
+    start = time.time()
+    directories = expand_paths(args.paths, args.reader, directories=True)
+    # a single run uses the workers to load its files
+    n_jobs = args.jobs if len(directories) == 1 else 1
+    options = dict(masses=args.mass if len(args.mass) > 1 else args.mass[0],
+                   delta_mz=args.delta_mz, dmz=args.dmz, reader=args.reader, n_jobs=n_jobs,
+                   state=not args.no_state, output=args.output)
+    tasks = [(directory, options) for directory in directories]
+    results = run_tasks(track_directory, tasks, 1 if n_jobs != 1 else args.jobs, _print_result)
+    if args.output is None and args.report != '-':
+        for result in results:
+            if result['status'] == 'ok':
+                if len(results) > 1:
+                    print(f"# {result['file']}")
+                write_track_csv(sys.stdout, result)
+    return results, start
+
+
+def watch(args):
+    if args.dash:
+        from .live_view_dash import LiveView
+        view = LiveView(args.path, delay=args.delay, interpolation=None, reader=args.reader,
+                        track_mass=args.mass, n_jobs=args.jobs, state=not args.no_state)
+        view.run(port=args.port)
+    else:
+        from .core.run import LiveView
+        view = LiveView(args.path, delay=args.delay, reader=args.reader, n_jobs=args.jobs,
+                        state=not args.no_state, window=args.window)
+        view.run()
+    return [], None
+
+
+def benchmark(args):
+    from .utils.benchmark import run_benchmarks
+    report = run_benchmarks(args.directory, nfiles=args.files, nscans=args.scans,
+                            npoints=args.points, peak_density=args.peak_density,
+                            noise=args.noise, repeat=args.repeat, memory=not args.no_memory,
+                            exporters=not args.no_exporters, baseline=args.baseline,
+                            output=args.output)
+    # stages slower than the baseline fail the run
+    slower = set(x['name'] for x in report.get('slower', []))
+    results = [dict(x, status='failed' if x['name'] in slower else
+                    'skipped' if 'skipped' in x else 'ok') for x in report['results']]
+    return results, None
+
+
+def parser():
+    main_parser = argparse.ArgumentParser(prog='massspec', description=__doc__.split('\n\n')[0].strip())
+    main_parser.add_argument('--profile', default=None,
+                             help='stage timings, as JSON or as OpenMetrics text for a .prom or .txt file')
+    subparsers = main_parser.add_subparsers(dest='command', required=True)
+
+    def add_common(sub, paths=True):
+        if paths:
+            sub.add_argument('paths', nargs='+', help='files, directories or glob patterns')
+        sub.add_argument('--reader', default=None, help='reader backend, msfilereader (default) or npz')
+        sub.add_argument('-j', '--jobs', type=int, default=1,
+                         help='worker processes, 0 uses every core')
+        sub.add_argument('--report', default=None, help='JSON report of the run, - for stdout')
+
+    sub = subparsers.add_parser('convert', help='convert raw files')
+    add_common(sub)
+    sub.add_argument('-t', '--to', choices=list(FORMATS), required=True)
+    sub.add_argument('-o', '--output', default=None,
+                     help='output directory, by default next to the raw files')
+    sub.add_argument('--decimals', type=int, default=None, help='rounding of xlsx cells')
+    sub.add_argument('--precision', choices=INTENSITY_DTYPES, default=None,
+                     help='intensity dtype of npz, cache and hdf5 outputs, the errors are reported')
+    sub.add_argument('--compress', nargs='?', const=True, default=None, choices=CODECS,
+                     help='compress npz and cache outputs, with zstd when available or the codec given')
+    sub.add_argument('--progress', default=None,
+                     help=f'progress file, by default {PROGRESS_FILE} in the output directory')
+    sub.add_argument('--force', action='store_true', help='convert files that are done again')
+    sub.set_defaults(func=convert)
+
+    sub = subparsers.add_parser('summarize', help='summary of raw files')
+    add_common(sub)
+    sub.set_defaults(func=summarize)
+
+    sub = subparsers.add_parser('track', help='areas of tracked masses over runs')
+    add_common(sub)
+    sub.add_argument('-m', '--mass', type=float, nargs='+', required=True)
+    sub.add_argument('--delta-mz', type=float, default=3)
+    sub.add_argument('--dmz', type=float, default=0.2)
+    sub.add_argument('-o', '--output', default=None,
+                     help='directory of the <run>-track.csv files, by default stdout')
+    sub.add_argument('--no-state', action='store_true',
+                     help='do not resume from the files summarized by earlier runs')
+    sub.set_defaults(func=track)
+
+    sub = subparsers.add_parser('watch', help='live view of a run directory')
+    sub.add_argument('path')
+    sub.add_argument('--reader', default=None)
+    sub.add_argument('-j', '--jobs', type=int, default=1)
+    sub.add_argument('--delay', type=float, default=1)
+    sub.add_argument('--window', type=int, default=20)
+    sub.add_argument('--dash', action='store_true', help='serve a Dash dashboard')
+    sub.add_argument('--port', type=int, default=8050)
+    sub.add_argument('-m', '--mass', type=float, nargs='+', default=None)
+    sub.add_argument('--no-state', action='store_true')
+    sub.set_defaults(func=watch, report=None)
+
+    sub = subparsers.add_parser('benchmark', help='benchmarks on synthetic runs')
+    sub.add_argument('--directory', default=None,
+                     help='where the synthetic runs are written, by default a temporary directory')
+    sub.add_argument('--files', type=int, default=8)
+    sub.add_argument('--scans', type=int, default=200)
+    sub.add_argument('--points', type=int, default=2000, help='points per scan')
+    sub.add_argument('--peak-density', type=float, default=2, help='compounds per 100 m/z')
+    sub.add_argument('--noise', type=float, default=20)
+    sub.add_argument('--repeat', type=int, default=3)
+    sub.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    sub.add_argument('--no-exporters', action='store_true')
+    sub.add_argument('--baseline', default=None,
+                     help='JSON report of an earlier run, slower stages fail the run')
+    sub.add_argument('-o', '--output', default=None, help='JSON report')
+    sub.set_defaults(func=benchmark, report=None)
+    return main_parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if getattr(args, 'jobs', 1) == 0:
+        args.jobs = None
+    if args.profile is not None:
+        profiling.enable()
+    try:
+        results, start = args.func(args)
+    finally:
+        if args.profile is not None:
+            if Path(args.profile).suffix in ('.prom', '.txt'):
+                with open(args.profile, 'w') as wf:
+                    wf.write(profiling.to_openmetrics())
+            else:
+                profiling.to_json(args.profile)
+    if args.report is not None:
+        write_report(args.report, args.command, args, results, start)
+    return 1 if any(x['status'] == 'failed' for x in results) else 0
@@ -1,2 +1,12 @@
 from .raw_file import RawFile, RawFileCollection
-from .run import LiveView, Handler
\ No newline at end of file
+from .run import LiveView, Handler
+from .readers import SpectrumReader, MSFileReaderBackend, NpzReader, write_npz
+from .cache import SpectrumCache
+from .ingest import SettleDetector, Ingestor, DirectoryPoller, AsyncIngestor
+from .state import FileRecord, CollectionState
+from .header import HeaderTable
+from .averaging import SpectrumAverager
+from .compare import RunComparison
+from .ratio_map import GridLayout, RatioMap
+from .precision import StoragePrecision
+from . import profiling
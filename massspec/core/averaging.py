@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Averaged spectra over any range of scans or time window.
+
+``SpectrumAverager`` bins every scan of a ScanStore once on a common m/z grid
+(a sparse scans x bins matrix) and keeps cumulative sums of the rows at
+checkpoints every ``block`` scans. The sum of any range of scans is the
+difference of two checkpoints plus the rows between the range ends and the
+nearest checkpoints, so a mean or a sum costs O(bins + block*points per scan)
+whatever the length of the range. ``block`` is 1 (plain prefix sums) unless
+the checkpoints would take more than ``max_bytes``. Medians are computed
+from the rows of the range. Recent results are kept in an LRU cache.
+"""
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix
+from .scans import ScanStore
+from .binning import MzGrid, bin_spectra
+
+STATISTICS = ('mean', 'sum', 'median')
+
+
+class SpectrumAverager(object):
+    def __init__(self, store: ScanStore, grid: MzGrid=None, width=None, ppm=None,
+                 start_times=None, cache_size=32, max_bytes=256*2**20):
+        if grid is None:
+            grid = MzGrid.for_spectra(store, width=width, ppm=ppm)
+        self.grid = grid
+        self.nspectra = store.nspectra
+        self.start_times = None if start_times is None else np.asarray(start_times, dtype=float)
+        self.rows = bin_spectra(store, grid=grid, statistic='sum', sparse=True).values.tocsr()
+        nbins = grid.nbins
+        self.block = max(1, int(np.ceil((self.nspectra + 1)*nbins*8/max_bytes)))
+        # checkpoints[j] is the sum of the rows of scans 0 to j*block - 1
+        scans = np.arange(self.nspectra)
+        blocks = csr_matrix((np.ones(self.nspectra), (scans//self.block, scans)),
+                            shape=(-(-self.nspectra//self.block), self.nspectra))
+        self.checkpoints = np.zeros((blocks.shape[0] + 1, nbins))
+        np.cumsum((blocks @ self.rows).toarray(), axis=0, out=self.checkpoints[1:])
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @property
+    def mz(self):
+        return self.grid.centers
+
+    def scan_range(self, start=None, stop=None, rt=None):
+        # 0-based half-open range of scans, from scans or from a time window
+        if rt is not None:
+            if self.start_times is None:
+                raise Exception('A time window needs the start times of the scans.')
+            low, high = rt
+            start = 0 if low is None else int(np.searchsorted(self.start_times, low, side='left'))
+            stop = self.nspectra if high is None else int(np.searchsorted(self.start_times, high, side='right'))
+        start = 0 if start is None else max(0, min(start, self.nspectra))
+        stop = self.nspectra if stop is None else max(start, min(stop, self.nspectra))
+        return start, stop
+
+    def _rows_sum(self, start, stop):
+        if stop <= start:
+            return np.zeros(self.grid.nbins)
+        return np.asarray(self.rows[start:stop].sum(axis=0)).ravel()
+
+    def _sum(self, start, stop):
+        first = -(-start//self.block)
+        last = stop//self.block
+        if first > last:
+            return self._rows_sum(start, stop)
+        return (self.checkpoints[last] - self.checkpoints[first]
+                + self._rows_sum(start, min(first*self.block, stop))
+                + self._rows_sum(max(last*self.block, start), stop))
+
+    def values(self, start=None, stop=None, rt=None, statistic='mean'):
+        # intensity of every bin of the grid over a range of scans
+        if statistic not in STATISTICS:
+            raise Exception(f'Unknown statistic {statistic}, choose from {", ".join(STATISTICS)}.')
+        start, stop = self.scan_range(start, stop, rt)
+        key = (start, stop, statistic)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if statistic == 'median':
+            values = np.median(self.rows[start:stop].toarray(), axis=0) if stop > start \
+                else np.zeros(self.grid.nbins)
+        else:
+            values = self._sum(start, stop)
+            if statistic == 'mean':
+                values = values/max(stop - start, 1)
+        self._cache[key] = values
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return values
+
+    def average(self, start=None, stop=None, rt=None, statistic='mean', nonzero=True):
+        # (n, 2) spectrum like RawFile.data_avg, nonzero=True drops empty bins
+        values = self.values(start, stop, rt, statistic)
+        if nonzero:
+            keep = values != 0
+            return np.column_stack([self.mz[keep], values[keep]])
+        return np.column_stack([self.mz, values])
+
+    def clear(self):
+        self._cache.clear()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import matplotlib.pylab as plt
+from .scans import ScanStore
+
+
+class MzGrid(object):
+    """
+    Common m/z axis defined by its bin edges. Bins are either a fixed width in
+    Da (``from_width``) or a fixed relative width in ppm (``from_ppm``), in
+    which case the edges grow geometrically with m/z.
+    """
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        if self.edges.ndim != 1 or len(self.edges) < 2:
+            raise Exception('A m/z grid needs at least two edges.')
+
+    @classmethod
+    def from_width(cls, mz_min, mz_max, width):
+        nbins = max(int(np.ceil((mz_max - mz_min)/width)), 1)
+        return cls(mz_min + width*np.arange(nbins + 1))
+
+    @classmethod
+    def from_ppm(cls, mz_min, mz_max, ppm):
+        ratio = 1 + ppm*1e-6
+        nbins = max(int(np.ceil(np.log(mz_max/mz_min)/np.log(ratio))), 1)
+        return cls(mz_min*ratio**np.arange(nbins + 1))
+
+    @classmethod
+    def for_spectra(cls, store: ScanStore, width=None, ppm=None):
+        # covers every point of the store, the default width is the median
+        # spacing of the points
+        mz_min, mz_max = np.min(store.mz), np.max(store.mz)
+        if ppm is not None:
+            return cls.from_ppm(mz_min, mz_max*(1 + ppm*1e-6), ppm)
+        if width is None:
+            spacing = np.diff(store.mz)
+            spacing = spacing[spacing > 0]
+            width = np.median(spacing) if len(spacing) > 0 else 1.0
+        return cls.from_width(mz_min, mz_max + width, width)
+
+    @property
+    def nbins(self):
+        return len(self.edges) - 1
+
+    @property
+    def centers(self):
+        return (self.edges[1:] + self.edges[:-1])/2
+
+    def index(self, mz):
+        # bin of every m/z value, -1 outside the grid
+        index = np.searchsorted(self.edges, mz, side='right') - 1
+        index[(index < 0) | (index >= self.nbins)] = -1
+        return index
+
+
+class BinnedSpectra(object):
+    """
+    Dense or sparse ``(nrows, nbins)`` intensity matrix on a common m/z grid.
+    Rows are scans or files, labelled by ``rows`` (e.g. retention time).
+    """
+    def __init__(self, values, grid: MzGrid, rows=None, row_label='Scan', names=None):
+        self.values = values
+        self.grid = grid
+        self.rows = np.arange(values.shape[0]) if rows is None else np.asarray(rows)
+        self.row_label = row_label
+        self.names = names
+
+    @property
+    def mz(self):
+        return self.grid.centers
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def is_sparse(self):
+        return not isinstance(self.values, np.ndarray)
+
+    def todense(self):
+        if self.is_sparse:
+            return self.values.toarray()
+        return self.values
+
+    def tosparse(self):
+        from scipy.sparse import csr_matrix
+        if self.is_sparse:
+            return self.values
+        return csr_matrix(self.values)
+
+    def plot(self, ax=None, log=False, show=True):
+        if ax is None:
+            plt.figure(figsize=(9, 6))
+            ax = plt.subplot(111)
+        values = self.todense()
+        if log:
+            values = np.log10(np.clip(values, 1, None))
+        mesh = ax.pcolormesh(self.grid.edges, np.arange(self.shape[0] + 1), values,
+                             shading='flat')
+        ax.set_xlabel("m/z")
+        ax.set_ylabel(self.row_label)
+        ticks = np.linspace(0, self.shape[0] - 1, min(self.shape[0], 10)).astype(int)
+        ax.set_yticks(ticks + 0.5)
+        ax.set_yticklabels(self.names[i] if self.names is not None else f"{self.rows[i]:g}"
+                           for i in ticks)
+        plt.colorbar(mesh, ax=ax, label="log10 Intensity" if log else "Intensity")
+        plt.tight_layout()
+        if show:
+            plt.show()
+        return ax
+
+
+def bin_spectra(store: ScanStore,
+                grid: MzGrid=None,
+                width=None,
+                ppm=None,
+                statistic='sum',
+                sparse=None,
+                density=0.1,
+                rows=None,
+                row_label='Scan',
+                names=None):
+    # statistic is 'sum', 'max' or 'mean' of the points falling in each bin.
+    # sparse=None returns a scipy.sparse matrix when less than ``density``
+    # of the cells are filled
+    if grid is None:
+        grid = MzGrid.for_spectra(store, width=width, ppm=ppm)
+    nrows, nbins = store.nspectra, grid.nbins
+    bins = grid.index(store.mz)
+    inside = bins >= 0
+    cells = store.scan_index[inside]*nbins + bins[inside]
+    values = np.asarray(store.intensity[inside], dtype=float)
+    if np.any(cells[1:] < cells[:-1]):
+        # scans with sorted m/z already give sorted cells
+        order = np.argsort(cells, kind='stable')
+        cells, values = cells[order], values[order]
+    starts = np.flatnonzero(np.concatenate([[True], cells[1:] != cells[:-1]])) if len(cells) else cells[:0]
+    unique = cells[starts]
+    counts = np.diff(np.append(starts, len(cells)))
+    if statistic == 'sum':
+        reduced = np.add.reduceat(values, starts) if len(starts) > 0 else values[:0]
+    elif statistic == 'mean':
+        reduced = np.add.reduceat(values, starts)/counts if len(starts) > 0 else values[:0]
+    elif statistic == 'max':
+        reduced = np.maximum.reduceat(values, starts) if len(starts) > 0 else values[:0]
+    else:
+        raise Exception(f'Unknown statistic {statistic}, choose from sum, mean or max.')
+    if sparse is None:
+        sparse = len(unique) < density*nrows*nbins
+    if sparse:
+        from scipy.sparse import csr_matrix
+        matrix = csr_matrix((reduced, (unique//nbins, unique % nbins)), shape=(nrows, nbins))
+    else:
+        matrix = np.zeros(nrows*nbins)
+        matrix[unique] = reduced
+        matrix = matrix.reshape(nrows, nbins)
+    return BinnedSpectra(matrix, grid, rows=rows, row_label=row_label, names=names)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+import numpy as np
+from .decimate import minmax_decimate
+
+
+class BlitManager(object):
+    """
+    Draws new artists on top of a cached image of the canvas instead of
+    drawing the whole figure. Artists are drawn once, when they are added,
+    and then become part of the cached image; a full draw of the canvas
+    (resize, zoom, new limits or removed artists) renders everything again
+    and refreshes the cache. Canvases that can not blit fall back to
+    ``draw_idle``.
+    """
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.background = None
+        self.artists = []
+        self._pending = []
+        self._cid = canvas.mpl_connect('draw_event', self._on_draw)
+
+    @property
+    def can_blit(self):
+        return getattr(self.canvas, 'supports_blit', False)
+
+    def add(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+        self._pending.append(artist)
+
+    def touch(self, artist):
+        # draws an artist that changed again on the next update
+        if artist not in self._pending:
+            self._pending.append(artist)
+
+    def remove(self, artist):
+        # only visible after the next full draw
+        self.artists.remove(artist)
+        if artist in self._pending:
+            self._pending.remove(artist)
+        artist.remove()
+
+    def _on_draw(self, event):
+        if event is not None and event.canvas != self.canvas:
+            return
+        figure = self.canvas.figure
+        for artist in self.artists:
+            figure.draw_artist(artist)
+        self._pending = []
+        self.background = self.canvas.copy_from_bbox(figure.bbox) if self.can_blit else None
+
+    def redraw(self):
+        self.canvas.draw()
+
+    def update(self):
+        # draws the artists added since the last update
+        if self.background is None or not self.can_blit:
+            self.canvas.draw_idle()
+        elif len(self._pending) > 0:
+            figure = self.canvas.figure
+            self.canvas.restore_region(self.background)
+            for artist in self._pending:
+                figure.draw_artist(artist)
+            self._pending = []
+            self.canvas.blit(figure.bbox)
+            self.background = self.canvas.copy_from_bbox(figure.bbox)
+        self.canvas.flush_events()
+
+    def disconnect(self):
+        self.canvas.mpl_disconnect(self._cid)
+
+
+class Waterfall(object):
+    """
+    Live waterfall of spectra on a 3D axes. Every spectrum is decimated to
+    the min/max of ``points`` m/z bins and blitted once over the cached
+    image of the plot. The depth axis spans one and a half ``window`` and
+    moves by half a window at a time: only then is the scene drawn again,
+    with the last ``window`` spectra, and older artists are dropped. The
+    cost of a new spectrum does not grow with the length of the run.
+    """
+    def __init__(self, ax, window=20, dt=1, points=2000, colors=None):
+        self.ax = ax
+        self.window = window
+        self.dt = dt
+        self.points = points
+        self.colors = colors or ['red', 'blue', 'green', 'cyan', 'magenta']
+        self.lines = deque()
+        self.count = 0
+        self.blit = BlitManager(ax.figure.canvas)
+        self.ax.set_autoscale_on(False)
+        self._first = 0
+        self._set_depth_limits()
+        self._zmax = 0.0
+        self._needs_redraw = True
+
+    @property
+    def depth_limits(self):
+        return self._first*self.dt, (self._first + self.window + self.window//2)*self.dt
+
+    def _set_depth_limits(self):
+        self.ax.set_ylim(*self.depth_limits)
+
+    def add(self, x, z, color=None):
+        # adds the next spectrum, drawn by the next call to draw
+        x, z = minmax_decimate(np.asarray(x, dtype=float), np.asarray(z, dtype=float), self.points)
+        depth = self.count*self.dt
+        color = color or self.colors[self.count % len(self.colors)]
+        line, = self.ax.plot(x, np.full(len(x), depth), z, color=color)
+        self.blit.add(line)
+        self.lines.append(line)
+        self.count += 1
+        self._update_limits(x, z)
+        return line
+
+    def _update_limits(self, x, z):
+        # limits only grow, by at least half again, or move by half a window
+        if len(x) == 0:
+            return
+        if self.count > self._first + self.window + self.window//2:
+            self._first = self.count - self.window
+            self._set_depth_limits()
+            while len(self.lines) > self.window:
+                self.blit.remove(self.lines.popleft())
+            self._needs_redraw = True
+        if np.nanmax(z) > self._zmax:
+            self._zmax = 1.5*np.nanmax(z)
+            self.ax.set_zlim(0, self._zmax)
+            self._needs_redraw = True
+        low, high = self.ax.get_xlim()
+        if self.count == 1 or np.nanmin(x) < low or np.nanmax(x) > high:
+            if self.count == 1:
+                low, high = np.nanmin(x), np.nanmax(x)
+            self.ax.set_xlim(min(low, np.nanmin(x)), max(high, np.nanmax(x)))
+            self._needs_redraw = True
+
+    def draw(self):
+        if self._needs_redraw:
+            self._needs_redraw = False
+            self.blit.redraw()
+        self.blit.update()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent columnar cache of decoded spectra.
+
+``SpectrumCache`` wraps another reader. The first time a file is opened every
+scan is decoded through the wrapped reader and written to one cache file;
+afterwards the columns are memory-mapped straight from disk. Entries are keyed
+on the resolved path of the source file and are rebuilt as soon as its size or
+modification time changes.
+
+Cache file layout (little endian)::
+
+    8 bytes    magic b'MSSPEC01'
+    8 bytes    uint64 length of the JSON metadata
+    n bytes    JSON metadata: source path, size, mtime_ns, nspectra,
+               mass_resolution, non numeric header fields and, for every
+               column, its dtype, shape and byte offset
+    ...        columns, each aligned to 64 bytes:
+               mz, intensity       concatenated scans
+               offsets             int64 (nspectra + 1)
+               intensity_offset,   float64 (nspectra), only for intensities
+               intensity_scale     stored as scaled integers
+               average             averaged spectrum (M, 2)
+               average_mass_list   average mass list (M, 2)
+               header_<Field>      one column per numeric scan header field
+
+The dtypes of the m/z and intensity columns follow the ``precision`` of the
+cache (see ``precision.StoragePrecision``) and the metadata records the
+errors they introduce. With ``compression`` every column is stored
+compressed (its metadata then also holds the codec and the compressed size,
+see ``precision.encode_column``) and is decoded when the file is opened
+instead of being memory-mapped.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+import numpy as np
+from .readers import SpectrumReader, open_reader, reader_suffixes, take_scans
+from .header import HeaderTable
+from .scans import ScanStore
+from .precision import StoragePrecision, encode_column, decode_column, dequantize, get_codec
+from .profiling import profile
+
+MAGIC = b'MSSPEC01'
+ALIGNMENT = 64
+
+
+def default_cache_dir():
+    if 'MASSSPEC_CACHE' in os.environ:
+        return Path(os.environ['MASSSPEC_CACHE'])
+    return Path.home() / '.cache' / 'massspec'
+
+
+def _stat_key(filename):
+    stat = Path(filename).stat()
+    return {'source': Path(filename).resolve().as_posix(),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def read_metadata(cache_file):
+    with open(cache_file, 'rb') as rf:
+        if rf.read(len(MAGIC)) != MAGIC:
+            raise Exception(f'{cache_file} is not a spectrum cache file.')
+        length = int(np.frombuffer(rf.read(8), dtype='<u8')[0])
+        return json.loads(rf.read(length).decode('utf-8'))
+
+
+def write_cache_file(cache_file, columns, metadata, compression=None):
+    # compression: None, or the codec of every column, see precision.get_codec
+    cache_file = Path(cache_file)
+    metadata = dict(metadata)
+    metadata['columns'] = {}
+    columns = {name: np.ascontiguousarray(array) for name, array in columns.items()}
+    payloads = {}
+    for name, array in columns.items():
+        if compression is None:
+            payloads[name] = (array.tobytes(), {'dtype': array.dtype.str, 'shape': list(array.shape)})
+        else:
+            # m/z columns are delta encoded
+            payloads[name] = encode_column(array, compression, delta=name == 'mz')
+    # offsets depend on the metadata length, so lay out until it is stable
+    blob = json.dumps(metadata).encode('utf-8')
+    while True:
+        position = len(MAGIC) + 8 + len(blob)
+        layout = {}
+        for name, (payload, info) in payloads.items():
+            position += -position % ALIGNMENT
+            layout[name] = dict(info, offset=position)
+            position += len(payload)
+        metadata['columns'] = layout
+        new_blob = json.dumps(metadata).encode('utf-8')
+        if len(new_blob) == len(blob):
+            blob = new_blob
+            break
+        blob = new_blob
+    # every process and thread writes its own temporary file, the last
+    # complete file wins
+    tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_file, 'wb') as wf:
+            wf.write(MAGIC)
+            wf.write(np.array(len(blob), dtype='<u8').tobytes())
+            wf.write(blob)
+            for name, (payload, _) in payloads.items():
+                wf.write(b'\0' * (layout[name]['offset'] - wf.tell()))
+                wf.write(payload)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        if tmp_file.exists():
+            tmp_file.unlink()
+        raise
+    return
+
+
+def read_cache_file(cache_file):
+    metadata = read_metadata(cache_file)
+    columns = {}
+    for name, column in metadata['columns'].items():
+        shape = tuple(column['shape'])
+        if 'codec' in column:
+            with open(cache_file, 'rb') as rf:
+                rf.seek(column['offset'])
+                columns[name] = decode_column(rf.read(column['nbytes']), column)
+        elif np.prod(shape) == 0:
+            columns[name] = np.zeros(shape, dtype=column['dtype'])
+        else:
+            columns[name] = np.memmap(cache_file, dtype=column['dtype'], mode='r',
+                                      offset=column['offset'], shape=shape)
+    return columns, metadata
+
+
+class CachedReader(SpectrumReader):
+    def __init__(self, filename, cache_file):
+        super(CachedReader, self).__init__(filename)
+        self.cache_file = Path(cache_file)
+        self._columns, self._metadata = read_cache_file(self.cache_file)
+        self._header_keys = [key for key in self._columns if key.startswith('header_')]
+
+    @property
+    def nspectra(self):
+        return self._metadata['nspectra']
+
+    @property
+    def mass_resolution(self):
+        return self._metadata['mass_resolution']
+
+    @property
+    def mz(self):
+        return self._columns['mz']
+
+    @property
+    def intensity(self):
+        # scaled integers are decoded to float32 on first use
+        if 'intensity_scale' in self._columns:
+            self._columns['intensity'] = dequantize(self._columns['intensity'], self.offsets,
+                                                    self._columns.pop('intensity_offset'),
+                                                    self._columns.pop('intensity_scale'))
+        return self._columns['intensity']
+
+    @property
+    def error_bounds(self):
+        # errors of the stored m/z and intensities, see precision.error_bounds
+        return self._metadata.get('error_bounds')
+
+    @property
+    def offsets(self):
+        return self._columns['offsets']
+
+    def get_spectrum(self, iscan):
+        start, stop = self.offsets[iscan - 1], self.offsets[iscan]
+        return np.array([self.mz[start:stop], self.intensity[start:stop]]).T
+
+    def get_spectra(self):
+        return ScanStore(self.mz, self.intensity, self.offsets)
+
+    def get_spectra_range(self, start, stop):
+        # views of the memory map, nothing is read until it is used
+        return self.get_spectra().slice(start, stop)
+
+    def get_scans(self, indices):
+        # only the pages of the selected scans are read
+        return take_scans(self.get_spectra(), indices)
+
+    def get_header(self, iscan):
+        header = {}
+        for key in self._header_keys:
+            header[key[len('header_'):]] = self._columns[key][iscan - 1].item()
+        for key, values in self._metadata['header_text'].items():
+            header[key] = values[iscan - 1]
+        return header
+
+    def get_headers(self):
+        columns = {key[len('header_'):]: self._columns[key] for key in self._header_keys}
+        for key, values in self._metadata['header_text'].items():
+            columns[key] = np.array(['' if v is None else v for v in values])
+        return HeaderTable.from_columns(columns, nscans=self.nspectra)
+
+    def get_average_spectrum(self):
+        return np.array(self._columns['average'])
+
+    def get_average_mass_list(self):
+        return np.array(self._columns['average_mass_list'])
+
+    def close(self):
+        self._columns = {}
+
+
+class SpectrumCache(object):
+    def __init__(self, directory=None, reader=None, precision=None, compression=None):
+        # precision: dtypes of the stored scans, e.g. 'float32' or 'uint16'
+        # intensities, see precision.StoragePrecision. compression: 'zstd',
+        # 'zlib' or True for zstd when it is installed
+        self.directory = Path(directory) if directory is not None else default_cache_dir()
+        self.reader = reader
+        self.precision = StoragePrecision.create(precision)
+        self.compression = get_codec(None if compression is True else compression)[0] if compression else None
+
+    @property
+    def suffixes(self):
+        return reader_suffixes(self.reader)
+
+    def path_for(self, filename):
+        source = Path(filename).resolve().as_posix()
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+        return self.directory / f"{Path(filename).stem}-{digest}.msc"
+
+    def is_valid(self, filename):
+        cache_file = self.path_for(filename)
+        if not cache_file.exists():
+            return False
+        try:
+            metadata = read_metadata(cache_file)
+        except Exception:
+            return False
+        key = _stat_key(filename)
+        # a cache written with other settings is built again
+        key.update(precision=self.precision.to_dict(), compression=self.compression)
+        defaults = dict(precision=StoragePrecision().to_dict(), compression=None)
+        return all(metadata.get(k, defaults.get(k)) == v for k, v in key.items())
+
+    @profile('SpectrumCache.build', size=None)
+    def build(self, filename):
+        key = _stat_key(filename)
+        with open_reader(filename, self.reader) as ms_file:
+            nspectra = ms_file.nspectra
+            spectra = ms_file.get_spectra()
+            headers = ms_file.get_headers()
+            average = ms_file.get_average_spectrum() if nspectra > 0 else np.zeros((0, 2))
+            average_mass_list = ms_file.get_average_mass_list() if nspectra > 0 else np.zeros((0, 2))
+            mass_resolution = ms_file.mass_resolution
+        columns, error_bounds = self.precision.encode(spectra)
+        columns.update({
+            'average': np.asarray(average, dtype=float).reshape(-1, 2),
+            'average_mass_list': np.asarray(average_mass_list, dtype=float).reshape(-1, 2),
+            })
+        header_text = {}
+        for field, values in headers.to_columns().items():
+            if values.dtype.kind in 'biuf':
+                columns[f'header_{field}'] = values
+            else:
+                header_text[field] = values.tolist()
+        metadata = dict(key,
+                        nspectra=nspectra,
+                        mass_resolution=None if mass_resolution is None else float(mass_resolution),
+                        header_text=header_text,
+                        precision=self.precision.to_dict(),
+                        compression=self.compression,
+                        error_bounds=error_bounds)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        write_cache_file(self.path_for(filename), columns, metadata, compression=self.compression)
+        return self.path_for(filename)
+
+    def open(self, filename):
+        if not self.is_valid(filename):
+            self.build(filename)
+        return CachedReader(filename, self.path_for(filename))
+
+    def __call__(self, filename):
+        return self.open(filename)
+
+    def invalidate(self, filename):
+        cache_file = self.path_for(filename)
+        if cache_file.exists():
+            cache_file.unlink()
+
+    def clear(self):
+        if self.directory.exists():
+            for cache_file in self.directory.glob('*.msc'):
+                cache_file.unlink()
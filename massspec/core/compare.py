@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Comparison of the files of many runs.
+
+``RunComparison`` bins the averaged spectra of every file of one or more
+RawFileCollections on a common m/z grid (a sparse files x bins matrix).
+Pairwise similarities (cosine, Pearson, spectral contrast angle) are all
+computed from blocks of dot products of that matrix, with the row norms and
+means applied afterwards, so the matrix stays sparse. Blocks of rows can be
+spread over worker processes. ``drift`` flags the files that moved away from
+a reference spectrum and ``differential`` tabulates the bins that differ
+between two groups of files.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse as sp
+from scipy.stats import t as t_distribution
+from .scans import ScanStore
+from .binning import MzGrid, bin_spectra
+
+METRICS = ('cosine', 'pearson', 'contrast_angle')
+
+DIFFERENTIAL_DTYPE = np.dtype([('mz', float),
+                               ('mean_a', float),
+                               ('mean_b', float),
+                               ('log2_ratio', float),
+                               ('t', float),
+                               ('p', float)])
+
+
+def _row_stats(matrix):
+    # sum, sum of squares and number of columns of every row
+    if sp.issparse(matrix):
+        sums = np.asarray(matrix.sum(axis=1)).ravel()
+        squares = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+    else:
+        sums = matrix.sum(axis=1)
+        squares = np.einsum('ij,ij->i', matrix, matrix)
+    return sums, squares, matrix.shape[1]
+
+
+def _similarity(dots, left, right, metric):
+    # similarities of a block from its dot products and the row statistics
+    sum_l, square_l, n = left
+    sum_r, square_r, _ = right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'pearson':
+            cov = dots - np.outer(sum_l, sum_r)/n
+            var_l = square_l - sum_l**2/n
+            var_r = square_r - sum_r**2/n
+            values = cov/np.sqrt(np.outer(var_l, var_r))
+        else:
+            values = dots/np.sqrt(np.outer(square_l, square_r))
+    values = np.clip(np.nan_to_num(values, nan=0.0), -1, 1)
+    if metric == 'contrast_angle':
+        # radians, 0 for identical spectra
+        return np.arccos(values)
+    return values
+
+
+_shared = {}
+
+
+def _init_worker(right, right_stats):
+    _shared['right'] = right
+    _shared['right_stats'] = right_stats
+
+
+def _block(args):
+    start, left, metric = args
+    dots = left @ _shared['right'].T
+    dots = dots.toarray() if sp.issparse(dots) else np.asarray(dots)
+    return start, _similarity(dots, _row_stats(left), _shared['right_stats'], metric)
+
+
+def similarity_matrix(left, right=None, metric='cosine', block=256, n_jobs=1):
+    """
+    (n, m) similarities between the rows of left and those of right (left
+    by default), dense or scipy.sparse matrices of intensities on the same
+    grid. Rows are handled ``block`` at a time; n_jobs > 1 (None for every
+    core) sends the blocks to worker processes, right is sent once to each.
+    """
+    if metric not in METRICS:
+        raise Exception(f'Unknown metric {metric}, choose from {", ".join(METRICS)}.')
+    left = left.tocsr() if sp.issparse(left) else np.asarray(left, dtype=float)
+    right = left if right is None else (right.tocsr() if sp.issparse(right) else np.asarray(right, dtype=float))
+    right_stats = _row_stats(right)
+    ret = np.zeros((left.shape[0], right.shape[0]))
+    tasks = [(start, left[start:start + block], metric) for start in range(0, left.shape[0], block)]
+    if n_jobs == 1 or len(tasks) < 2:
+        _init_worker(right, right_stats)
+        try:
+            results = map(_block, tasks)
+            for start, values in results:
+                ret[start:start + len(values)] = values
+        finally:
+            _shared.clear()
+        return ret
+    n_jobs = min(n_jobs or os.cpu_count(), len(tasks))
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                             initargs=(right, right_stats)) as pool:
+        for start, values in pool.map(_block, tasks):
+            ret[start:start + len(values)] = values
+    return ret
+
+
+def _column_stats(matrix):
+    # mean and unbiased variance of every column
+    n = matrix.shape[0]
+    if sp.issparse(matrix):
+        mean = np.asarray(matrix.mean(axis=0)).ravel()
+        square = np.asarray(matrix.multiply(matrix).mean(axis=0)).ravel()
+    else:
+        mean = matrix.mean(axis=0)
+        square = (matrix**2).mean(axis=0)
+    var = (square - mean**2)*n/max(n - 1, 1)
+    return mean, np.clip(var, 0, None), n
+
+
+class RunComparison(object):
+    """
+    ``collections`` is a list of RawFileCollections (or a dict of them by
+    name). The averaged spectrum of every file is a row, named
+    ``<run>/<file>``; ``runs`` holds the run of every row.
+    """
+    def __init__(self, collections, grid: MzGrid=None, width=None, ppm=None):
+        if isinstance(collections, dict):
+            labels, collections = list(collections), list(collections.values())
+        else:
+            collections = list(collections)
+            labels = [collection.path.name for collection in collections]
+        averages = ScanStore.concatenate([collection.averages for collection in collections])
+        self.names = [f"{label}/{name}" for label, collection in zip(labels, collections)
+                      for name in collection.files]
+        self.runs = np.array([label for label, collection in zip(labels, collections)
+                              for _ in range(collection.nfiles)])
+        self.binned = bin_spectra(averages, grid=grid, width=width, ppm=ppm, sparse=True,
+                                  row_label='File', names=self.names)
+        self.matrix = self.binned.values.tocsr()
+
+    @property
+    def mz(self):
+        return self.binned.mz
+
+    @property
+    def nfiles(self):
+        return self.matrix.shape[0]
+
+    def rows(self, selection):
+        # row indices of a run label, a list of labels, a boolean mask or indices
+        selection = np.atleast_1d(selection)
+        if selection.dtype.kind in 'US':
+            return np.flatnonzero(np.isin(self.runs, selection))
+        if selection.dtype == bool:
+            return np.flatnonzero(selection)
+        return selection.astype(np.int64)
+
+    def similarity(self, metric='cosine', block=256, n_jobs=1):
+        # (nfiles, nfiles) similarity matrix of every pair of files
+        return similarity_matrix(self.matrix, metric=metric, block=block, n_jobs=n_jobs)
+
+    def reference(self, selection=None, statistic='median'):
+        # median (or mean) spectrum of the files selected, all by default
+        rows = self.matrix if selection is None else self.matrix[self.rows(selection)]
+        if statistic == 'mean':
+            return np.asarray(rows.mean(axis=0)).ravel()
+        return np.median(rows.toarray(), axis=0)
+
+    def drift(self, metric='cosine', reference=None, threshold=3.5):
+        """
+        Similarity of every file to a reference spectrum (the median of the
+        files of the ``reference`` runs, of all files by default) and the
+        files flagged as drifting: those whose similarity is more than
+        ``threshold`` robust z-scores (median absolute deviation) away from
+        the others, on the side of being less similar.
+        """
+        values = similarity_matrix(self.matrix, self.reference(reference)[None, :], metric=metric)[:, 0]
+        center = np.median(values)
+        mad = 1.4826*np.median(np.abs(values - center))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = (values - center)/mad if mad > 0 else np.zeros_like(values)
+        if metric == 'contrast_angle':
+            score = -score
+        return values, score < -threshold
+
+    def differential(self, a, b, normalize='tic', min_intensity=0):
+        """
+        Table (DIFFERENTIAL_DTYPE) of the bins of group a against group b
+        (run labels, masks or row indices): mean intensities, log2 ratio and
+        Welch's t test, sorted by p value. normalize='tic' scales every file
+        to a total intensity of 1 first.
+        """
+        matrix = self.matrix
+        if normalize == 'tic':
+            total = np.asarray(matrix.sum(axis=1)).ravel()
+            matrix = sp.diags(1/np.where(total > 0, total, 1)) @ matrix
+        mean_a, var_a, n_a = _column_stats(matrix[self.rows(a)])
+        mean_b, var_b, n_b = _column_stats(matrix[self.rows(b)])
+        keep = np.maximum(mean_a, mean_b) > min_intensity
+        mean_a, var_a, mean_b, var_b = mean_a[keep], var_a[keep], mean_b[keep], var_b[keep]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            error_a, error_b = var_a/n_a, var_b/n_b
+            t = (mean_a - mean_b)/np.sqrt(error_a + error_b)
+            dof = (error_a + error_b)**2/(error_a**2/max(n_a - 1, 1) + error_b**2/max(n_b - 1, 1))
+            p = 2*t_distribution.sf(np.abs(t), dof)
+            ratio = np.log2(mean_a/mean_b)
+        table = np.zeros(int(keep.sum()), dtype=DIFFERENTIAL_DTYPE)
+        table['mz'] = self.mz[keep]
+        table['mean_a'] = mean_a
+        table['mean_b'] = mean_b
+        table['log2_ratio'] = ratio
+        table['t'] = t
+        table['p'] = np.where(np.isfinite(p), p, 1.0)
+        return np.sort(table, order='p')
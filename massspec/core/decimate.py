@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from .scans import ScanStore
+
+
+def _first_extreme(values, starts, group, ufunc):
+    # flat index of the first minimum / maximum of every group, NaN and
+    # infinite values are skipped and groups without a finite value are left out
+    finite = np.isfinite(values)
+    values = np.where(finite, values, np.inf if ufunc is np.minimum else -np.inf)
+    extreme = ufunc.reduceat(values, starts)
+    position = np.where(finite & (values == extreme[group]), np.arange(len(values)), len(values))
+    position = np.minimum.reduceat(position, starts)
+    return position[position < len(values)]
+
+
+def minmax_indices(x, y, nbins, x_range=None, scans=None):
+    """
+    Indices of the points kept when every scan is drawn ``nbins`` pixels
+    wide: the minimum and the maximum of each pixel bin, plus the first and
+    the last point of the scan, in their original order. The drawn line
+    keeps every peak and valley a full resolution line would show.
+
+    ``scans`` is the scan number of every point (all zeros by default) and
+    ``x_range`` the (low, high) range mapped on the pixels, per scan or for
+    all of them; by default the range of each scan.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    scans = np.zeros(n, dtype=np.int64) if scans is None else np.asarray(scans, dtype=np.int64)
+    nscans = int(scans.max()) + 1
+    if x_range is None:
+        low = np.full(nscans, np.inf)
+        high = np.full(nscans, -np.inf)
+        # NaN m/z are ignored, they are never inside the range
+        np.fmin.at(low, scans, x)
+        np.fmax.at(high, scans, x)
+    else:
+        low, high = (np.broadcast_to(np.asarray(bound, dtype=float), nscans) for bound in x_range)
+    keep = np.zeros(n, dtype=bool)
+    inside = (x >= low[scans]) & (x <= high[scans])
+    # points outside x_range only keep the line going to the edge of the view
+    edges = np.flatnonzero(inside[1:] != inside[:-1])
+    keep[edges] = True
+    keep[edges + 1] = True
+    index = np.flatnonzero(inside)
+    if len(index) > 0:
+        s = scans[index]
+        width = np.where(high > low, high - low, 1.0)
+        pixel = np.floor((x[index] - low[s])/width[s]*nbins).astype(np.int64)
+        cells = s*nbins + np.clip(pixel, 0, nbins - 1)
+        starts = np.flatnonzero(np.concatenate([[True], cells[1:] != cells[:-1]]))
+        group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(index))))
+        keep[index[_first_extreme(y[index], starts, group, np.minimum)]] = True
+        keep[index[_first_extreme(y[index], starts, group, np.maximum)]] = True
+        # the ends of every scan keep the extent of the line
+        boundary = np.flatnonzero(np.concatenate([[True], s[1:] != s[:-1]]))
+        keep[index[boundary]] = True
+        keep[index[np.append(boundary[1:] - 1, len(index) - 1)]] = True
+    return np.flatnonzero(keep)
+
+
+def minmax_decimate(x, y, nbins=2000, x_range=None):
+    # (x, y) reduced to at most about 2*nbins points, see minmax_indices
+    x, y = np.asarray(x), np.asarray(y)
+    if len(x) <= 2*nbins and x_range is None:
+        return x, y
+    index = minmax_indices(x, y, nbins, x_range=x_range)
+    return x[index], y[index]
+
+
+def decimate_spectrum(spectrum, nbins=2000, x_range=None):
+    # same for a (n, 2) spectrum
+    spectrum = np.asarray(spectrum)
+    x, y = minmax_decimate(spectrum[:, 0], spectrum[:, 1], nbins, x_range=x_range)
+    return np.column_stack([x, y])
+
+
+def decimate_store(store: ScanStore, nbins=2000, x_range=None):
+    # every scan of a store decimated in one pass
+    index = minmax_indices(store.mz, store.intensity, nbins, x_range=x_range,
+                           scans=store.scan_index)
+    counts = np.bincount(store.scan_index[index], minlength=store.nspectra)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return ScanStore(store.mz[index], store.intensity[index], offsets)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Scan headers as a typed table.
+
+``HeaderTable`` keeps the headers of the scans of a file in a numpy
+structured array, one record per scan and one typed column per field. The
+fields of the MSFileReader scan header used by the package (``HEADER_FIELDS``)
+are always present, missing values are NaN (-1 for integers); any other
+field of the source is kept as a numeric or text column.
+
+Indexing keeps the interface of the former list of dicts, ``header[i]`` is
+the dict of scan i, while ``header['StartTime']`` is a whole column. Scans
+are selected with vectorized queries::
+
+    scans = header.select(rt=(1.5, 3.0), tic=(1e6, None))
+"""
+import numpy as np
+
+HEADER_FIELDS = [('ScanNumber', np.int64),
+                 ('StartTime', np.float64),
+                 ('TIC', np.float64),
+                 ('BasePeakMass', np.float64),
+                 ('BasePeakIntensity', np.float64),
+                 ('LowMass', np.float64),
+                 ('HighMass', np.float64),
+                 ('NumPackets', np.int64)]
+
+ALIASES = {'scan': 'ScanNumber',
+           'rt': 'StartTime',
+           'tic': 'TIC',
+           'base_peak_mz': 'BasePeakMass',
+           'base_peak': 'BasePeakIntensity',
+           'low_mass': 'LowMass',
+           'high_mass': 'HighMass',
+           'npoints': 'NumPackets'}
+
+
+def _column(values):
+    # typed column of a list of header values, None is a missing value
+    values = list(values)
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, (bool, np.bool_)) for v in present) and present:
+        return np.array([bool(v) if v is not None else False for v in values])
+    if all(isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) for v in present) and present:
+        return np.array([-1 if v is None else v for v in values], dtype=np.int64)
+    if all(isinstance(v, (int, float, np.number)) for v in present):
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array(['' if v is None else str(v) for v in values])
+
+
+class HeaderTable(object):
+    def __init__(self, records):
+        self.records = records
+
+    @classmethod
+    def from_columns(cls, columns, nscans=None):
+        # columns: field -> array, the missing standard fields are added
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        if nscans is None:
+            nscans = len(next(iter(columns.values()))) if columns else 0
+        for name, dtype in HEADER_FIELDS:
+            if name not in columns:
+                if name == 'ScanNumber':
+                    columns[name] = np.arange(1, nscans + 1)
+                else:
+                    columns[name] = np.full(nscans, -1 if dtype == np.int64 else np.nan, dtype=dtype)
+        standard = [name for name, _ in HEADER_FIELDS]
+        names = standard + [name for name in columns if name not in standard]
+        dtypes = dict(HEADER_FIELDS)
+        records = np.zeros(nscans, dtype=[(name, dtypes.get(name, columns[name].dtype)) for name in names])
+        for name in names:
+            records[name] = columns[name]
+        return cls(records)
+
+    @classmethod
+    def from_dicts(cls, headers):
+        headers = list(headers)
+        fields = {}
+        for header in headers:
+            for key in header:
+                fields.setdefault(key, None)
+        return cls.from_columns({key: _column(h.get(key) for h in headers) for key in fields},
+                                nscans=len(headers))
+
+    @property
+    def fields(self):
+        return list(self.records.dtype.names)
+
+    @property
+    def nscans(self):
+        return len(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _field(self, name):
+        name = ALIASES.get(name, name)
+        if name not in self.records.dtype.names:
+            raise KeyError(f'Unknown header field {name}, choose from {self.fields}.')
+        return name
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.records[self._field(key)]
+        if isinstance(key, (int, np.integer)):
+            record = self.records[key]
+            return {name: record[name].item() for name in self.records.dtype.names}
+        return HeaderTable(self.records[key])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def column(self, name, default=np.nan):
+        # column of a field, filled with default when the field is missing
+        name = ALIASES.get(name, name)
+        if name in self.records.dtype.names:
+            return self.records[name]
+        return np.full(len(self), default)
+
+    @property
+    def start_times(self):
+        return self.records['StartTime'].astype(float)
+
+    def mask(self, where=None, **ranges):
+        """
+        Boolean mask of the scans matching every condition. Each keyword is
+        a field (or an alias: rt, tic, scan, base_peak, ...) with either a
+        (low, high) range, inclusive and None for an open end, or a value
+        the field must be equal to. ``where`` is a boolean mask or a function
+        of the table returning one.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name, condition in ranges.items():
+            column = self[name]
+            if isinstance(condition, (tuple, list)):
+                low, high = condition
+                if low is not None:
+                    mask &= column >= low
+                if high is not None:
+                    mask &= column <= high
+            else:
+                mask &= column == condition
+        if where is not None:
+            mask &= np.asarray(where(self) if callable(where) else where, dtype=bool)
+        return mask
+
+    def select(self, where=None, **ranges):
+        # 0-based indices of the matching scans, see mask
+        return np.flatnonzero(self.mask(where, **ranges))
+
+    def to_columns(self):
+        return {name: self.records[name] for name in self.records.dtype.names}
+
+    def to_dicts(self):
+        return list(self)
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.records)
+
+    def __repr__(self):
+        return f"HeaderTable(nscans={len(self)}, fields={self.fields})"
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from .raw_file import _load_raw_file
+
+
+class SettleDetector(object):
+    """
+    Decides when a file that is being written or copied is complete, without
+    blocking: a file is settled once its size and modification time did not
+    change for ``settle_time`` seconds and it is at least ``min_size`` bytes.
+    """
+    def __init__(self, settle_time=2.0, min_size=22*1024, clock=time.monotonic):
+        self.settle_time = settle_time
+        self.min_size = min_size
+        self.clock = clock
+        # path -> ((size, mtime), time the signature was first seen)
+        self.pending = {}
+
+    def _signature(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def observe(self, path):
+        path = Path(path)
+        signature = self._signature(path)
+        if signature is None:
+            self.pending.pop(path, None)
+            return
+        if path not in self.pending or self.pending[path][0] != signature:
+            self.pending[path] = (signature, self.clock())
+
+    def discard(self, path):
+        self.pending.pop(Path(path), None)
+
+    def settled(self):
+        # pops and returns the (path, signature) of the settled files, the
+        # others stay pending
+        now = self.clock()
+        ret = []
+        for path, (signature, since) in list(self.pending.items()):
+            current = self._signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current != signature:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle_time and current[0] >= self.min_size:
+                del self.pending[path]
+                ret.append((path, current))
+        return ret
+
+
+class Ingestor(object):
+    """
+    Event driven loading of raw files. ``submit`` only puts a path on a
+    queue, so it can be called from watchdog callbacks. A dispatcher thread
+    feeds a SettleDetector and hands settled files to a pool of ``n_jobs``
+    worker processes (threads with ``threads=True``); loaded files are
+    collected with ``results`` from the thread that plots them.
+    """
+    def __init__(self,
+                 load_kwargs=None,
+                 suffixes=None,
+                 settle_time=2.0,
+                 min_size=22*1024,
+                 n_jobs=1,
+                 threads=False,
+                 poll_interval=0.2):
+        self.load_kwargs = load_kwargs or {}
+        self.suffixes = suffixes
+        self.detector = SettleDetector(settle_time=settle_time, min_size=min_size)
+        self.n_jobs = n_jobs
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.events = queue.Queue()
+        self._results = queue.Queue()
+        # signature of every file handed to the pool, a file is loaded again
+        # only if it changed after it settled
+        self.submitted = {}
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        executor = ThreadPoolExecutor if self.threads else ProcessPoolExecutor
+        self._pool = executor(max_workers=self.n_jobs or os.cpu_count())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._dispatch, name='massspec-ingest', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+        self._pool = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit(self, path):
+        path = Path(path)
+        if self.suffixes is None or path.suffix.lower() in self.suffixes:
+            self.events.put(path)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self.detector.pending) + self.events.qsize() + self.in_flight
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            try:
+                path = self.events.get(timeout=self.poll_interval)
+            except queue.Empty:
+                path = None
+            with self._lock:
+                if path is not None:
+                    self.detector.observe(path)
+                # drain the rest of a burst before checking the pending files
+                while True:
+                    try:
+                        self.detector.observe(self.events.get_nowait())
+                    except queue.Empty:
+                        break
+                for path, signature in self.detector.settled():
+                    if self.submitted.get(path) == signature:
+                        continue
+                    self.submitted[path] = signature
+                    self.in_flight += 1
+                    future = self._pool.submit(_load_raw_file, (path, self.load_kwargs))
+                    future.add_done_callback(lambda x, path=path: self._done(path, x))
+
+    def _done(self, path, future):
+        try:
+            raw_file, error = future.result()
+        except Exception as err:
+            raw_file, error = None, repr(err)
+        with self._lock:
+            self.in_flight -= 1
+        self._results.put((path, raw_file, error))
+
+    def results(self, block=False, timeout=None):
+        # (path, RawFile or None, error or None) of every file loaded since
+        # the last call. With block=True waits for at least one
+        ret = []
+        if block:
+            try:
+                ret.append(self._results.get(timeout=timeout))
+            except queue.Empty:
+                return ret
+        while True:
+            try:
+                ret.append(self._results.get_nowait())
+            except queue.Empty:
+                return ret
+
+
+class DirectoryPoller(object):
+    """
+    Polls a directory for new or changed files at a cost that does not grow
+    with the files already seen. The state of a file is its (inode, size,
+    mtime) signature, kept in a dict by name. The directory is only listed
+    (with os.scandir) when its own modification time changed, and the files
+    already known are not stat'ed again unless their inode changed; only the
+    files being written are, until they settle (see SettleDetector). Every
+    ``full_scan_interval`` seconds all files are stat'ed again, which also
+    catches files rewritten in place.
+    """
+    def __init__(self, path, suffixes=None, settle_time=2.0, min_size=22*1024,
+                 full_scan_interval=30.0, clock=time.monotonic):
+        self.path = Path(path)
+        self.suffixes = suffixes
+        self.settle_time = settle_time
+        self.min_size = min_size
+        self.full_scan_interval = full_scan_interval
+        self.clock = clock
+        # name -> (inode, size, mtime) of the files reported, inode is None
+        # for the files seeded from a saved state
+        self.known = {}
+        # name -> ((inode, size, mtime), time the signature was first seen)
+        self.pending = {}
+        self._directory = None
+        self._last_full_scan = None
+
+    def seed(self, name, size, mtime_ns, inode=None):
+        # a file already loaded, only reported again if it changes
+        self.known[Path(name).name] = (inode, size, mtime_ns)
+
+    def forget(self, name):
+        name = Path(name).name
+        self.known.pop(name, None)
+        self.pending.pop(name, None)
+
+    @staticmethod
+    def _signature(stat):
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _observe(self, name, signature, now):
+        known = self.known.get(name)
+        if known is not None and known[1:] == signature[1:] and known[0] in (None, signature[0]):
+            self.known[name] = signature
+            self.pending.pop(name, None)
+            return
+        if name not in self.pending or self.pending[name][0] != signature:
+            self.pending[name] = (signature, now)
+
+    def _scan(self, now, full):
+        names = set()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                name = entry.name
+                if self.suffixes is not None and os.path.splitext(name)[1].lower() not in self.suffixes:
+                    continue
+                try:
+                    known = self.known.get(name)
+                    if not full and name not in self.pending and known is not None \
+                            and known[0] is not None and known[0] == entry.inode():
+                        names.add(name)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    signature = self._signature(entry.stat())
+                except OSError:
+                    continue
+                names.add(name)
+                self._observe(name, signature, now)
+        # deleted files are loaded again if they come back
+        for name in [name for name in self.known if name not in names]:
+            del self.known[name]
+        for name in [name for name in self.pending if name not in names]:
+            del self.pending[name]
+
+    def _check_pending(self, now):
+        for name in list(self.pending):
+            try:
+                signature = self._signature(os.stat(self.path / name))
+            except OSError:
+                del self.pending[name]
+                continue
+            self._observe(name, signature, now)
+
+    def poll(self):
+        # paths of the files that settled since the last call
+        now = self.clock()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+        directory = (stat.st_ino, stat.st_mtime_ns)
+        full = self._last_full_scan is None or now - self._last_full_scan >= self.full_scan_interval
+        # with coarse timestamps (FAT, some network shares) a file created in
+        # the same tick as the last listing leaves the mtime unchanged
+        recent = time.time_ns() - stat.st_mtime_ns < 2e9
+        if full or recent or directory != self._directory:
+            self._scan(now, full)
+            self._directory = directory
+            if full:
+                self._last_full_scan = now
+        else:
+            self._check_pending(now)
+        settled = []
+        for name, (signature, since) in list(self.pending.items()):
+            if now - since >= self.settle_time and signature[1] >= self.min_size:
+                del self.pending[name]
+                self.known[name] = signature
+                settled.append((signature[2], name))
+        # in the order they were written
+        return [self.path / name for _, name in sorted(settled)]
+
+
+_STOP = object()
+
+
+class AsyncIngestor(object):
+    """
+    asyncio service loading the files of a directory as they are written.
+    A DirectoryPoller runs every ``poll_interval`` seconds and the settled
+    files are loaded on a pool of ``n_jobs`` worker processes (threads with
+    ``threads=True``). At most ``max_pending`` files are being loaded or
+    waiting to be consumed; beyond that polling waits for the consumer, so
+    a slow consumer does not pile up loaded files in memory. Loaded files
+    are consumed as an async iterator of (path, RawFile or None, error or
+    None)::
+
+        async with AsyncIngestor(path, suffixes=('.npz', )) as ingestor:
+            async for path, raw_file, error in ingestor:
+                ...
+    """
+    def __init__(self,
+                 path,
+                 load_kwargs=None,
+                 suffixes=None,
+                 settle_time=2.0,
+                 min_size=22*1024,
+                 n_jobs=1,
+                 threads=False,
+                 poll_interval=0.5,
+                 max_pending=None,
+                 full_scan_interval=30.0):
+        self.poller = DirectoryPoller(path, suffixes=suffixes, settle_time=settle_time,
+                                      min_size=min_size, full_scan_interval=full_scan_interval)
+        self.load_kwargs = load_kwargs or {}
+        self.n_jobs = n_jobs
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending or 2*(n_jobs or os.cpu_count())
+        self.in_flight = 0
+        self._closed = False
+        self._stopping = False
+        self._pool = None
+        self._loop = None
+        self._task = None
+        self._slots = None
+        self._results = None
+
+    async def start(self):
+        if self._task is not None:
+            return self
+        executor = ThreadPoolExecutor if self.threads else ProcessPoolExecutor
+        self._pool = executor(max_workers=self.n_jobs or os.cpu_count())
+        self._stopping = False
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._results = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._poll())
+        if self._closed:
+            self._results.put_nowait(_STOP)
+        return self
+
+    async def stop(self, wait=True):
+        if self._task is None:
+            return
+        # files loaded from now on are dropped
+        self._stopping = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._results.put_nowait(_STOP)
+        pool, self._pool = self._pool, None
+        # waiting for the loads in flight must not block the event loop
+        await self._loop.run_in_executor(None, functools.partial(pool.shutdown, wait=wait,
+                                                                 cancel_futures=not wait))
+        self._loop = None
+
+    def close(self):
+        # ends the iteration, can be called from any thread
+        self._closed = True
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._results.put_nowait, _STOP)
+            except RuntimeError:
+                # the event loop is already closed
+                pass
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *args):
+        await self.stop(wait=False)
+
+    async def _poll(self):
+        while True:
+            # scandir and stat calls run on a thread, not on the event loop
+            for path in await self._loop.run_in_executor(None, self.poller.poll):
+                await self._slots.acquire()
+                self.in_flight += 1
+                future = self._loop.run_in_executor(self._pool, _load_raw_file, (path, self.load_kwargs))
+                future.add_done_callback(lambda x, path=path: self._done(path, x))
+            await asyncio.sleep(self.poll_interval)
+
+    def _done(self, path, future):
+        self.in_flight -= 1
+        if future.cancelled() or self._stopping:
+            self._slots.release()
+            return
+        try:
+            raw_file, error = future.result()
+        except Exception as err:
+            raw_file, error = None, repr(err)
+        self._results.put_nowait((path, raw_file, error))
+
+    @property
+    def pending(self):
+        return len(self.poller.pending) + self.in_flight + (self._results.qsize() if self._results else 0)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        result = await self._results.get()
+        if result is _STOP:
+            raise StopAsyncIteration
+        self._slots.release()
+        return result
+
+    def results(self):
+        # the files loaded and not consumed yet, without waiting
+        ret = []
+        while self._results is not None and not self._results.empty():
+            result = self._results.get_nowait()
+            if result is _STOP:
+                self._results.put_nowait(_STOP)
+                break
+            self._slots.release()
+            ret.append(result)
+        return ret
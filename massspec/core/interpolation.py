@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy.linalg import solve_banded
+from .scans import ScanStore
+
+KINDS = ['linear', 'cubic', 'pchip']
+
+
+class BatchInterpolator(object):
+    """
+    Interpolates every scan of a ScanStore at once.
+
+    All kinds are evaluated as piecewise cubic Hermite polynomials from the
+    knot values and one slope per knot, computed for the whole store in a
+    single pass:
+
+    ``linear``  straight lines between the knots
+    ``cubic``   natural cubic spline, one banded solve for all scans
+    ``pchip``   monotone piecewise cubic (Fritsch-Carlson, as in scipy)
+
+    Queries outside the m/z range of a scan return ``fill_value``.
+    """
+    def __init__(self, store: ScanStore, kind='cubic', fill_value=np.nan):
+        if kind not in KINDS:
+            raise Exception(f'Unknown interpolation {kind}, choose from {KINDS}.')
+        self.store = store
+        self.kind = kind
+        self.fill_value = fill_value
+        self.x = np.asarray(store.mz, dtype=float)
+        self.y = np.asarray(store.intensity, dtype=float)
+        self.offsets = store.offsets
+        self.scan_index = store.scan_index
+        self.first, self.last = store.mz_range()
+        # shifting each scan by its index makes the flat m/z buffer globally
+        # sorted, so one searchsorted finds the interval for any (scan, m/z)
+        if len(self.x) > 0:
+            self._x0 = np.nanmin(self.first)
+            self._span = np.nanmax(self.last) - self._x0 + 1.0
+        else:
+            self._x0, self._span = 0.0, 1.0
+        self._keys = self._key(self.x, self.scan_index)
+        self._slopes = self._get_slopes()
+
+    def _key(self, x, scans):
+        return (x - self._x0) + scans*self._span
+
+    def _segments(self):
+        # secant slope and width of the interval starting at each point,
+        # zero for the last point of every scan
+        h = np.zeros_like(self.x)
+        m = np.zeros_like(self.y)
+        if len(self.x) < 2:
+            return h, m
+        inner = np.ones(len(self.x), dtype=bool)
+        inner[self.offsets[1:] - 1] = False
+        inner[-1] = False
+        index = np.nonzero(inner)[0]
+        h[index] = self.x[index + 1] - self.x[index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m[index] = (self.y[index + 1] - self.y[index])/h[index]
+        return h, m
+
+    def _get_slopes(self):
+        h, m = self._segments()
+        if self.kind == 'linear':
+            return m
+        n = len(self.x)
+        local = np.arange(n) - self.offsets[:-1][self.scan_index]
+        length = self.store.lengths[self.scan_index]
+        interior = (local > 0) & (local < length - 1)
+        left, right = np.nonzero(local == 0)[0], np.nonzero(local == length - 1)[0]
+        if self.kind == 'cubic':
+            return self._natural_spline_slopes(h, m, interior, right)
+        return self._pchip_slopes(h, m, interior, left, right)
+
+    def _natural_spline_slopes(self, h, m, interior, right):
+        n = len(self.x)
+        ab = np.zeros((3, n))
+        ab[1] = 1.0
+        rhs = np.zeros(n)
+        i = np.nonzero(interior)[0]
+        ab[0, i + 1] = h[i]
+        ab[1, i] = 2*(h[i - 1] + h[i])
+        ab[2, i - 1] = h[i - 1]
+        rhs[i] = 6*(m[i] - m[i - 1])
+        # the boundary rows decouple the scans, one solve handles all of them
+        curvature = solve_banded((1, 1), ab, rhs) if n > 0 else rhs
+        slopes = np.zeros(n)
+        j = np.nonzero(h)[0]
+        slopes[j] = m[j] - h[j]*(2*curvature[j] + curvature[j + 1])/6
+        r = right[self.store.lengths[self.scan_index[right]] > 1]
+        slopes[r] = m[r - 1] + h[r - 1]*(curvature[r - 1] + 2*curvature[r])/6
+        return slopes
+
+    def _pchip_slopes(self, h, m, interior, left, right):
+        slopes = np.zeros(len(self.x))
+        i = np.nonzero(interior)[0]
+        w1 = 2*h[i] + h[i - 1]
+        w2 = h[i] + 2*h[i - 1]
+        same_sign = (np.sign(m[i]) == np.sign(m[i - 1])) & (m[i] != 0) & (m[i - 1] != 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            harmonic = (w1 + w2)/(w1/m[i - 1] + w2/m[i])
+        slopes[i] = np.where(same_sign, harmonic, 0.0)
+        lengths = self.store.lengths[self.scan_index]
+        # edges use the one-sided three point estimate of scipy's pchip
+        for edge, inward, outward in [(left, 0, 1), (right, -1, -2)]:
+            two = edge[lengths[edge] == 2]
+            slopes[two] = m[two + (0 if inward == 0 else -1)]
+            k = edge[lengths[edge] > 2]
+            if inward == 0:
+                h0, h1, m0, m1 = h[k], h[k + 1], m[k], m[k + 1]
+            else:
+                h0, h1, m0, m1 = h[k - 1], h[k - 2], m[k - 1], m[k - 2]
+            d = ((2*h0 + h1)*m0 - h0*m1)/(h0 + h1)
+            d = np.where(np.sign(d) != np.sign(m0), 0.0, d)
+            d = np.where((np.sign(m0) != np.sign(m1)) & (np.abs(d) > 3*np.abs(m0)), 3*m0, d)
+            slopes[k] = d
+        return slopes
+
+    def __call__(self, x, scans):
+        # evaluates scan ``scans`` at ``x``, both broadcast elementwise
+        x, scans = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(scans))
+        shape = x.shape
+        x, scans = x.ravel(), scans.ravel().astype(np.int64)
+        scans = np.where(scans < 0, scans + self.store.nspectra, scans)
+        out = np.full(x.shape, self.fill_value, dtype=float)
+        lengths = self.store.lengths[scans]
+        valid = (lengths > 0) & (x >= self.first[scans]) & (x <= self.last[scans])
+        x, scans = x[valid], scans[valid]
+        start = self.offsets[scans]
+        stop = self.offsets[scans + 1]
+        i = np.searchsorted(self._keys, self._key(x, scans), side='right') - 1
+        i = np.clip(i, start, np.maximum(stop - 2, start))
+        j = np.minimum(i + 1, stop - 1)
+        h = self.x[j] - self.x[i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(h > 0, (x - self.x[i])/h, 0.0)
+        y0, y1 = self.y[i], self.y[j]
+        if self.kind == 'linear':
+            y = y0 + t*(y1 - y0)
+        else:
+            d0, d1 = self._slopes[i]*h, self._slopes[j]*h
+            y = (y0*(1 + 2*t)*(1 - t)**2 + d0*t*(1 - t)**2
+                 + y1*t**2*(3 - 2*t) + d1*t**2*(t - 1))
+        out[valid] = y
+        out = out.reshape(shape)
+        return out if out.ndim > 0 else out.item()
+
+    def matrix(self, masses, scans=None):
+        # intensity of every mass in every scan, shape (len(masses), len(scans))
+        masses = np.atleast_1d(np.asarray(masses, dtype=float))
+        scans = np.arange(self.store.nspectra) if scans is None else np.atleast_1d(scans)
+        return self(masses[:, None], scans[None, :])
+
+    def resample(self, factor=1):
+        # factor times as many evenly spaced points per scan, within the
+        # m/z range of each scan
+        lengths = self.store.lengths*factor
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        scans = np.repeat(np.arange(self.store.nspectra), lengths)
+        position = np.arange(offsets[-1]) - offsets[:-1][scans]
+        steps = np.maximum(lengths - 1, 1)[scans]
+        first, last = self.first[scans], self.last[scans]
+        x = first + (last - first)*position/steps
+        # the ends of every scan are exact, rounding must not take a point
+        # past the last one, where the scan is not defined
+        x = np.clip(np.where(position == steps, last, x), first, last)
+        return ScanStore(x, self(x, scans), offsets)
+
+    def on_grid(self, grid, scans=None):
+        # every scan evaluated on one shared m/z grid, shape (len(scans), len(grid))
+        return self.matrix(grid, scans).T
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import numpy as np
+from .decimate import minmax_indices
+
+
+class LevelOfDetail(object):
+    """
+    Level of detail for dense lines on a matplotlib (or mplot3d) axes.
+
+    Lines added with ``plot`` only hold the min/max envelope of the points
+    per screen pixel of m/z. The envelopes are recomputed when the x limits
+    change and are cached per zoom level: the view is snapped to tiles of a
+    quantized width, and each tile is decimated with some margin around it,
+    so panning and zooming back reuse the cached envelopes.
+    """
+    def __init__(self, ax, pixels=None, cache_size=32, margin=1):
+        self.ax = ax
+        self.pixels = pixels
+        self.cache_size = cache_size
+        self.margin = margin
+        # x, y, depth (None for 2D lines) and matplotlib line of every series
+        self.series = []
+        self._cache = OrderedDict()
+        self._cid = ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
+
+    @property
+    def width(self):
+        # width of the axes in pixels
+        if self.pixels is not None:
+            return self.pixels
+        return max(int(self.ax.get_window_extent().width), 100)
+
+    @property
+    def npoints(self):
+        # points drawn, against sum(len(x) for x, *_ in self.series) points
+        return sum(len(line.get_xdata()) for *_, line in self.series)
+
+    def _view(self, xlim):
+        # cache key and decimated range of a view: the span is rounded down
+        # to a quarter power of two and the view snapped to tiles of it
+        low, high = sorted(float(x) for x in xlim)
+        span = max(high - low, 1e-12)
+        level = np.floor(np.log2(span)*4)/4
+        tile = 2**level
+        index = int(np.floor(low/tile))
+        x_range = ((index - self.margin)*tile, (index + 2 + self.margin)*tile)
+        pixels = int(self.width*(x_range[1] - x_range[0])/span)
+        return (level, index, pixels), x_range, pixels
+
+    def _indices(self, xlim):
+        # index arrays of the points drawn for every series in a view, 
+        # xlim=None decimates each series over its own range
+        if xlim is None:
+            key, x_range, pixels = None, None, self.width
+        else:
+            key, x_range, pixels = self._view(xlim)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            self._cache[key] = []
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        entry = self._cache[key]
+        for x, y, _, _ in self.series[len(entry):]:
+            entry.append(minmax_indices(x, y, pixels, x_range=x_range))
+        return entry
+
+    def plot(self, x, y, depth=None, **kwargs):
+        # adds a line, depth places it at y=depth of a 3D axes. While the
+        # axes autoscale the line covers its whole range, which keeps the
+        # ends and the extremes of the data for the autoscaling
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        # points that can not be drawn are dropped before decimating
+        finite = np.isfinite(x) & np.isfinite(y)
+        if not finite.all():
+            x, y = x[finite], y[finite]
+        self.series.append((x, y, depth, None))
+        view = None if self.ax.get_autoscalex_on() else self.ax.get_xlim()
+        index = self._indices(view)[-1]
+        if depth is None:
+            line, = self.ax.plot(x[index], y[index], **kwargs)
+        else:
+            line, = self.ax.plot(x[index], np.full(len(index), depth), y[index], **kwargs)
+        self.series[-1] = (x, y, depth, line)
+        return line
+
+    def refresh(self):
+        entry = self._indices(self.ax.get_xlim())
+        for (x, y, depth, line), index in zip(self.series, entry):
+            if line is None:
+                # the line being added, autoscaling of ax.plot changed the view
+                continue
+            if depth is None:
+                line.set_data(x[index], y[index])
+            else:
+                line.set_data_3d(x[index], np.full(len(index), depth), y[index])
+
+    def _on_xlim_changed(self, ax):
+        self.refresh()
+
+    def clear(self):
+        for *_, line in self.series:
+            line.remove()
+        self.series = []
+        self._cache.clear()
+
+    def disconnect(self):
+        self.ax.callbacks.disconnect(self._cid)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.signal import find_peaks, peak_prominences, peak_widths
+from .scans import ScanStore
+from .profiling import profile
+
+# one row per peak: scan number (0-based), index of the apex inside its scan,
+# m/z (the centroid when centroiding), apex intensity, prominence and full
+# width at half prominence in m/z
+PEAK_DTYPE = np.dtype([('scan', np.int64),
+                       ('index', np.int64),
+                       ('mz', np.float64),
+                       ('intensity', np.float64),
+                       ('prominence', np.float64),
+                       ('width', np.float64)])
+
+
+def _padded(store: ScanStore):
+    # all scans in one array separated by +inf. A peak can never see past an
+    # infinite neighbour, so one scipy call gives the same peaks, prominences
+    # and widths as calling find_peaks on every scan
+    position = np.arange(store.npoints) + store.scan_index + 1
+    padded = np.full(store.npoints + store.nspectra + 1, np.inf)
+    padded[position] = store.intensity
+    return padded, position
+
+
+def _mz_at(mz, position):
+    # m/z at fractional point positions, interpolated linearly
+    below = np.minimum(np.floor(position).astype(np.int64), len(mz) - 1)
+    above = np.minimum(below + 1, len(mz) - 1)
+    return mz[below] + (position - below)*(mz[above] - mz[below])
+
+
+def _pick(args):
+    store, prominence, height, centroid = args
+    padded, position = _padded(store)
+    peaks, _ = find_peaks(padded, height=height)
+    peaks = peaks[np.isfinite(padded[peaks])]
+    prominence_data = peak_prominences(padded, peaks)
+    keep = prominence_data[0] >= (prominence or 0)
+    peaks = peaks[keep]
+    prominence_data = tuple(x[keep] for x in prominence_data)
+    table = np.zeros(len(peaks), dtype=PEAK_DTYPE)
+    if len(peaks) == 0:
+        return table
+    _, left, right = peak_widths(padded, peaks, rel_height=0.5,
+                                 prominence_data=prominence_data)[1:]
+    # padded index -> flat index, each scan is shifted by scan + 1
+    flat = np.searchsorted(position, peaks)
+    scan = store.scan_index[flat]
+    shift = scan + 1
+    mz = np.asarray(store.mz, dtype=float)
+    table['scan'] = scan
+    table['index'] = flat - store.offsets[scan]
+    table['mz'] = mz[flat]
+    table['intensity'] = store.intensity[flat]
+    table['prominence'] = prominence_data[0]
+    left, right = left - shift, right - shift
+    table['width'] = _mz_at(mz, right) - _mz_at(mz, left)
+    if centroid:
+        # intensity weighted m/z of the points above half prominence
+        intensity = np.asarray(store.intensity, dtype=float)
+        weight = np.concatenate([[0.0], np.cumsum(intensity)])
+        moment = np.concatenate([[0.0], np.cumsum(intensity*mz)])
+        start = np.ceil(left).astype(np.int64)
+        stop = np.floor(right).astype(np.int64) + 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centre = (moment[stop] - moment[start])/(weight[stop] - weight[start])
+        table['mz'] = np.where(np.isfinite(centre), centre, table['mz'])
+    return table
+
+
+@profile('peaks.pick_peaks')
+def pick_peaks(store: ScanStore,
+               prominence=None,
+               height=None,
+               centroid=False,
+               n_jobs=1,
+               chunk_scans=1000):
+    # peak table of every scan of the store. n_jobs > 1 (or None for every
+    # core) splits the store into chunks of scans handled by worker processes
+    if n_jobs == 1 or store.nspectra <= chunk_scans:
+        return _pick((store, prominence, height, centroid))
+    starts = np.arange(0, store.nspectra, chunk_scans)
+    chunks = [(store.slice(start, start + chunk_scans), prominence, height, centroid)
+              for start in starts]
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        tables = list(pool.map(_pick, chunks))
+    for start, table in zip(starts, tables):
+        table['scan'] += start
+    return np.concatenate(tables)
+
+
+def peak_mask(table, store: ScanStore):
+    # boolean mask over the points of the store that are peak apexes
+    mask = np.zeros(store.npoints, dtype=bool)
+    mask[store.offsets[table['scan']] + table['index']] = True
+    return mask
+
+
+def peaks_to_spectra(table, nspectra):
+    # peak table back to a ScanStore of (m/z, intensity) sticks
+    counts = np.bincount(table['scan'], minlength=nspectra)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return ScanStore(table['mz'], table['intensity'], offsets)
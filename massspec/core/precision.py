@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Storage precision and compression of scan buffers.
+
+``StoragePrecision`` sets the dtypes of the m/z and intensity buffers of a
+ScanStore: m/z as float64 (default) or float32, intensities as float64,
+float32 or integers scaled per scan (uint16, uint32). A scaled scan maps the
+range from min(0, lowest intensity) to its base peak onto the integers, so
+zeros stay exact. Scaled integers are a storage format only (cache files and
+npz exports). They are decoded to float32 when read, and RawFile keeps
+float dtypes in memory.
+
+Every conversion measures the errors it introduces (``error_bounds``): the
+largest absolute error and the largest error relative to the value, and for
+intensities the largest error relative to the base peak of the scan.
+float32 keeps a relative error below 6e-8 (0.06 ppm of m/z). Scaled
+integers round to half a step, 1/131070 of the base peak of every scan for
+uint16, and the float32 they are decoded to adds up to 6e-8 of the base
+peak, which is what limits uint32.
+
+Columns written to disk can also be compressed (``encode_column``). m/z
+buffers are delta encoded on their bit patterns, which is exact. Columns are
+byte shuffled and then compressed with zstd when the ``zstandard`` package
+is installed, or zlib otherwise.
+"""
+import zlib
+import numpy as np
+from .scans import ScanStore
+
+MZ_DTYPES = ('float64', 'float32')
+
+INTENSITY_DTYPES = ('float64', 'float32', 'uint16', 'uint32')
+
+CODECS = ('zstd', 'zlib')
+
+
+def _quantize(store: ScanStore, dtype):
+    # integers of every point and the (offset, scale) of every scan
+    top = np.iinfo(dtype).max
+    y = np.asarray(store.intensity, dtype=float)
+    low = np.minimum(store.reduce(np.minimum, y, empty=0.0), 0)
+    scale = (store.reduce(np.maximum, y, empty=0.0) - low)/top
+    scale[scale == 0] = 1.0
+    index = store.scan_index
+    return np.rint((y - low[index])/scale[index]).astype(dtype), low, scale
+
+
+def dequantize(values, offsets, low, scale, dtype=np.float32):
+    index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return (values*scale[index] + low[index]).astype(dtype)
+
+
+def error_bounds(reference: ScanStore, stored: ScanStore):
+    # largest errors of stored against reference, see the module docstring
+    bounds = {}
+    for key in ['mz', 'intensity']:
+        values = np.asarray(getattr(reference, key), dtype=float)
+        error = np.abs(np.asarray(getattr(stored, key), dtype=float) - values)
+        nonzero = values != 0
+        bounds[key] = dict(max_abs=float(error.max(initial=0)),
+                           max_rel=float((error[nonzero]/np.abs(values[nonzero])).max(initial=0)))
+        if key == 'intensity':
+            base = reference.reduce(np.maximum, np.abs(values), empty=0.0)
+            worst = reference.reduce(np.maximum, error, empty=0.0)
+            keep = base > 0
+            bounds[key]['max_rel_base_peak'] = float((worst[keep]/base[keep]).max(initial=0))
+    return bounds
+
+
+class StoragePrecision(object):
+    def __init__(self, mz='float64', intensity='float64'):
+        mz, intensity = np.dtype(mz).name, np.dtype(intensity).name
+        if mz not in MZ_DTYPES:
+            raise Exception(f'Unknown m/z dtype {mz}, choose from {", ".join(MZ_DTYPES)}.')
+        if intensity not in INTENSITY_DTYPES:
+            raise Exception(f'Unknown intensity dtype {intensity}, choose from {", ".join(INTENSITY_DTYPES)}.')
+        self.mz = mz
+        self.intensity = intensity
+
+    @classmethod
+    def create(cls, value=None):
+        # from None (float64), an intensity dtype, a dict or a StoragePrecision
+        if isinstance(value, StoragePrecision):
+            return value
+        if value is None:
+            return cls()
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(intensity=value)
+
+    @property
+    def scaled(self):
+        return self.intensity.startswith('uint')
+
+    @property
+    def memory_dtypes(self):
+        # (m/z, intensity) dtypes in memory, scaled integers are float32
+        return self.mz, 'float32' if self.scaled else self.intensity
+
+    @property
+    def is_default(self):
+        return self.mz == 'float64' and self.intensity == 'float64'
+
+    def to_dict(self):
+        return dict(mz=self.mz, intensity=self.intensity)
+
+    def __eq__(self, other):
+        return isinstance(other, StoragePrecision) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"StoragePrecision(mz='{self.mz}', intensity='{self.intensity}')"
+
+    def apply(self, store: ScanStore):
+        # the store in the memory dtypes and the errors it introduces, None
+        # when nothing changed
+        ret = store.astype(*self.memory_dtypes)
+        if ret is store:
+            return store, None
+        return ret, error_bounds(store, ret)
+
+    def encode(self, store: ScanStore):
+        # columns written to disk (mz, intensity, offsets and, for scaled
+        # integers, intensity_offset and intensity_scale) and the errors of
+        # the round trip
+        columns = {'mz': np.asarray(store.mz, dtype=self.mz),
+                   'intensity': np.asarray(store.intensity, dtype=self.intensity),
+                   'offsets': store.offsets}
+        if self.scaled:
+            columns['intensity'], columns['intensity_offset'], columns['intensity_scale'] = \
+                _quantize(store, self.intensity)
+        if self.is_default:
+            return columns, error_bounds(store, store)
+        return columns, error_bounds(store, decode_store(columns))
+
+
+def decode_store(columns):
+    # ScanStore of the columns written by StoragePrecision.encode
+    intensity = columns['intensity']
+    if 'intensity_scale' in columns:
+        intensity = dequantize(intensity, columns['offsets'],
+                               columns['intensity_offset'], columns['intensity_scale'])
+    return ScanStore(columns['mz'], intensity, columns['offsets'])
+
+
+def get_codec(name=None):
+    # (name, compress, decompress), zstd when zstandard is installed
+    if name in (None, 'zstd'):
+        try:
+            import zstandard
+        except ImportError:
+            if name == 'zstd':
+                raise Exception('zstd compression needs the zstandard package.')
+            name = 'zlib'
+        else:
+            return 'zstd', zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    if name == 'zlib':
+        return 'zlib', lambda data: zlib.compress(data, 6), zlib.decompress
+    raise Exception(f'Unknown compression {name}, choose from {", ".join(CODECS)}.')
+
+
+def encode_column(array, codec=None, delta=False):
+    # compressed bytes of an array and what decode_column needs to read it
+    # back. delta=True stores the differences of the bit patterns of a float
+    # array, exact and small for sorted m/z
+    array = np.ascontiguousarray(array)
+    name, compress, _ = get_codec(codec)
+    delta = bool(delta) and array.dtype.kind == 'f' and array.size > 0
+    data = array.ravel()
+    if delta:
+        bits = data.view(array.dtype.str.replace('f', 'i'))
+        data = np.diff(bits, prepend=bits.dtype.type(0))
+    # byte shuffle: the n-th bytes of all values are stored together
+    shuffled = data.view(np.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+    blob = compress(shuffled)
+    return blob, dict(codec=name, dtype=array.dtype.str, shape=list(array.shape), delta=delta,
+                      nbytes=len(blob))
+
+
+def decode_column(blob, info):
+    _, _, decompress = get_codec(info['codec'])
+    dtype = np.dtype(info['dtype'])
+    data = np.frombuffer(decompress(bytes(blob)), dtype=np.uint8)
+    data = np.ascontiguousarray(data.reshape(dtype.itemsize, -1).T)
+    if info['delta']:
+        bits = data.view(dtype.str.replace('f', 'i')).ravel()
+        bits = np.cumsum(bits, dtype=bits.dtype)
+        return bits.view(dtype).reshape(info['shape'])
+    return data.view(dtype).reshape(info['shape'])
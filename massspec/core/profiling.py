@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing of the load and processing pipeline.
+
+Functions decorated with ``profile`` and blocks wrapped in ``stage`` record
+their wall time, number of calls, and the bytes and number of items (points,
+scans) they handled, under a stage name such as ``'reader.get_spectra'``.
+Times are inclusive: a stage includes the stages it calls.
+
+Profiling is off by default. ``enable()`` (or ``MASSSPEC_PROFILE=1`` in the
+environment) turns it on; while it is off a decorated function costs one
+global lookup and ``stage`` returns a shared no-op context. Stages recorded
+in worker processes are sent back with their results and merged into the
+profiler of the main process.
+
+    from massspec.core import profiling
+    profiling.enable()
+    RawFileCollection('run', n_jobs=4)
+    print(profiling.to_openmetrics())
+    profiling.to_json('profile.json')
+"""
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+ENVIRONMENT_VARIABLE = 'MASSSPEC_PROFILE'
+
+
+class StageStats(object):
+    __slots__ = ('calls', 'seconds', 'min', 'max', 'bytes', 'items')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.bytes = 0
+        self.items = 0
+
+    def add(self, seconds, nbytes=0, items=0, calls=1):
+        self.calls += calls
+        self.seconds += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+        self.items += items
+
+    def merge(self, other):
+        self.add(other['seconds'], other['bytes'], other['items'], other['calls'])
+        self.min = min(self.min, other['min'])
+        self.max = max(self.max, other['max'])
+
+    def to_dict(self):
+        return dict(calls=self.calls,
+                    seconds=self.seconds,
+                    mean=self.seconds/self.calls if self.calls else 0.0,
+                    min=self.min if self.calls else 0.0,
+                    max=self.max,
+                    bytes=self.bytes,
+                    items=self.items)
+
+
+class Profiler(object):
+    def __init__(self):
+        self.stages = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, nbytes=0, items=0):
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(seconds, nbytes, items)
+
+    def merge(self, stages):
+        # stages of another profiler, as returned by to_dict
+        with self._lock:
+            for name, other in stages.items():
+                self.stages.setdefault(name, StageStats()).merge(other)
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.started = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in sorted(self.stages.items())}
+
+    def report(self):
+        return dict(started=self.started,
+                    elapsed=time.time() - self.started,
+                    pid=os.getpid(),
+                    stages=self.to_dict())
+
+    def to_json(self, path=None):
+        text = json.dumps(self.report(), indent=2)
+        if path is not None:
+            with open(path, 'w') as wf:
+                wf.write(text)
+        return text
+
+    def to_openmetrics(self):
+        # OpenMetrics text exposition, one counter family per statistic
+        stages = self.to_dict()
+        lines = []
+        for metric, key, unit, help_text in [('massspec_stage_calls', 'calls', None, 'Calls of a stage'),
+                                             ('massspec_stage_seconds', 'seconds', 'seconds',
+                                              'Wall time spent in a stage'),
+                                             ('massspec_stage_bytes', 'bytes', 'bytes',
+                                              'Bytes handled by a stage'),
+                                             ('massspec_stage_items', 'items', None,
+                                              'Points or scans handled by a stage')]:
+            lines.append(f"# TYPE {metric} counter")
+            if unit is not None:
+                lines.append(f"# UNIT {metric} {unit}")
+            lines.append(f"# HELP {metric} {help_text}.")
+            for name, stats in stages.items():
+                label = name.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'{metric}_total{{stage="{label}"}} {stats[key]!r}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+_profiler = None
+
+
+def enable(profiler=None):
+    # also enables the worker processes started from now on
+    global _profiler
+    _profiler = profiler or _profiler or Profiler()
+    os.environ[ENVIRONMENT_VARIABLE] = '1'
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+    os.environ.pop(ENVIRONMENT_VARIABLE, None)
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+def get_profiler():
+    return _profiler
+
+
+def _size(value):
+    # bytes and items of a result: ScanStores, arrays and lists of them
+    if value is None:
+        return 0, 0
+    if hasattr(value, 'npoints') and hasattr(value, 'nbytes'):
+        return int(value.nbytes), int(value.npoints)
+    if hasattr(value, 'nbytes') and hasattr(value, 'shape'):
+        return int(value.nbytes), int(value.shape[0]) if len(value.shape) > 0 else 1
+    if isinstance(value, (list, tuple)):
+        return 0, len(value)
+    return 0, 0
+
+
+def profile(name, size=_size):
+    """
+    Decorator recording every call of a function as the stage ``name``.
+    ``size(result)`` returns the bytes and items of the result, by default
+    those of ScanStores, arrays and lists.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            nbytes, items = size(result) if size is not None else (0, 0)
+            profiler.record(name, time.perf_counter() - start, nbytes, items)
+            return result
+        return wrapper
+    return decorator
+
+
+class _Stage(object):
+    __slots__ = ('profiler', 'name', 'nbytes', 'items', 'start')
+
+    def __init__(self, profiler, name, nbytes, items):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = nbytes
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, time.perf_counter() - self.start, self.nbytes, self.items)
+
+
+class _NoStage(object):
+    __slots__ = ('nbytes', 'items')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name, nbytes=0, items=0):
+    # context manager recording a block, nbytes and items can also be set
+    # on the yielded object inside the block
+    if _profiler is None:
+        return _NO_STAGE
+    return _Stage(_profiler, name, nbytes, items)
+
+
+@contextmanager
+def collect():
+    # in a worker process: yields a dict that is filled at the end of the
+    # block with the stages recorded in it, to be sent back to the main
+    # process and merged there. Yields None in the main process, where
+    # stages are recorded directly, and when profiling is off
+    if _profiler is None or multiprocessing.parent_process() is None:
+        yield None
+        return
+    stages = {}
+    previous = _profiler.stages
+    _profiler.stages = {}
+    try:
+        yield stages
+    finally:
+        stages.update(_profiler.to_dict())
+        _profiler.stages = previous
+
+
+def merge(stages):
+    if stages and _profiler is not None:
+        _profiler.merge(stages)
+
+
+def report():
+    return _profiler.report() if _profiler is not None else None
+
+
+def to_json(path=None):
+    return _profiler.to_json(path) if _profiler is not None else None
+
+
+def to_openmetrics():
+    return _profiler.to_openmetrics() if _profiler is not None else None
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE, '') not in ('', '0'):
+    enable()
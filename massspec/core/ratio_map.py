@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Intensity ratios of mass pairs mapped on a grid of wells or droplets.
+
+``GridLayout`` gives the (row, column) of the n-th file of a screen: row by
+row, column by column, serpentine (every other row or column reversed), or an
+explicit plate map of well names. ``RatioMap`` computes the ratios of any
+number of mass pairs for every scan of a file in one pass (the intensity of
+a mass is the most intense point, the summed intensity or the area of its
+window, see ``xic.ChromatogramExtractor``) and writes them to the grid as
+files arrive.
+"""
+import re
+import numpy as np
+from .scans import ScanStore
+from .xic import ChromatogramExtractor
+from .peaks import peaks_to_spectra
+
+ORDERS = ('row', 'column', 'serpentine', 'serpentine_column')
+
+PLATES = {6: (2, 3), 12: (3, 4), 24: (4, 6), 48: (6, 8), 96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+
+def well_name(row, col):
+    # 0-based row and column to a well name, e.g. (1, 2) -> 'B3', (26, 0) -> 'AA1'
+    letters = ''
+    row = int(row) + 1
+    while row > 0:
+        row, rest = divmod(row - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return f"{letters}{int(col) + 1}"
+
+
+def parse_well(name):
+    match = re.fullmatch(r'\s*([A-Za-z]+)\s*0*([0-9]+)\s*', name)
+    if match is None:
+        raise Exception(f'{name} is not a well name.')
+    row = 0
+    for letter in match.group(1).upper():
+        row = row*26 + ord(letter) - ord('A') + 1
+    return row - 1, int(match.group(2)) - 1
+
+
+class GridLayout(object):
+    def __init__(self, nrow, ncol, order='row', wells=None):
+        # wells: plate map, the well name (or (row, col)) of every file in
+        # the order of acquisition, instead of order
+        if order not in ORDERS:
+            raise Exception(f'Unknown order {order}, choose from {", ".join(ORDERS)}.')
+        self.nrow = nrow
+        self.ncol = ncol
+        self.order = order
+        self.wells = None
+        if wells is not None:
+            positions = np.array([parse_well(x) if isinstance(x, str) else x for x in wells],
+                                 dtype=np.int64).reshape(-1, 2)
+            if (positions < 0).any() or (positions[:, 0] >= nrow).any() or (positions[:, 1] >= ncol).any():
+                raise Exception(f'The plate map does not fit a {nrow} x {ncol} grid.')
+            self.wells = positions
+
+    @classmethod
+    def plate(cls, wells=96, order='row', plate_map=None):
+        if wells not in PLATES:
+            raise Exception(f'Unknown plate of {wells} wells, choose from {list(PLATES)}.')
+        return cls(*PLATES[wells], order=order, wells=plate_map)
+
+    @property
+    def size(self):
+        return len(self.wells) if self.wells is not None else self.nrow*self.ncol
+
+    def position(self, index):
+        # (row, col) of the files at index, -1 past the end of the grid
+        index = np.atleast_1d(np.asarray(index, dtype=np.int64))
+        if self.wells is not None:
+            inside = index < len(self.wells)
+            rows = np.where(inside, self.wells[np.minimum(index, len(self.wells) - 1), 0], -1)
+            cols = np.where(inside, self.wells[np.minimum(index, len(self.wells) - 1), 1], -1)
+            return rows, cols
+        if self.order in ('row', 'serpentine'):
+            rows, cols = index//self.ncol, index % self.ncol
+            if self.order == 'serpentine':
+                cols = np.where(rows % 2 == 1, self.ncol - 1 - cols, cols)
+        else:
+            cols, rows = index//self.nrow, index % self.nrow
+            if self.order == 'serpentine_column':
+                rows = np.where(cols % 2 == 1, self.nrow - 1 - rows, rows)
+        inside = index < self.nrow*self.ncol
+        return np.where(inside, rows, -1), np.where(inside, cols, -1)
+
+    def well(self, index):
+        rows, cols = self.position(index)
+        return [well_name(r, c) if r >= 0 else None for r, c in zip(rows, cols)]
+
+
+class RatioMap(object):
+    """
+    ``pairs`` is one (mass_1, mass_2) pair or a list of them. The intensity
+    of a mass in a scan is taken from its window (``delta_mz`` Da or
+    ``ppm``) with ``statistic`` 'max', 'counts' (sum) or 'area', in the
+    scans of the file (``source='scans'``), its peak table ('peaks', with
+    ``peak_prominence``) or its averaged spectrum ('average'). The value of
+    a file is the ratio in scan ``scan`` (0-based), or the ``aggregate``
+    (median or mean) of the ratios of all its scans.
+    """
+    def __init__(self, pairs, layout: GridLayout, delta_mz=0.5, ppm=None, statistic='max',
+                 source='scans', scan=None, aggregate='median', peak_prominence=500):
+        pairs = np.asarray(pairs, dtype=float).reshape(-1, 2)
+        self.pairs = pairs
+        # intensities are extracted once per distinct mass
+        self.masses, inverse = np.unique(pairs.ravel(), return_inverse=True)
+        self._numerator, self._denominator = inverse.reshape(-1, 2).T
+        self.layout = layout
+        self.delta_mz = delta_mz
+        self.ppm = ppm
+        self.statistic = statistic
+        self.source = source
+        self.scan = scan
+        self.aggregate = aggregate
+        self.peak_prominence = peak_prominence
+        self.values = np.full((len(pairs), layout.nrow, layout.ncol), np.nan)
+        self.count = 0
+        # per file: name, position and the (pairs, scans) ratios
+        self.names = []
+        self.scan_ratios = []
+
+    @property
+    def npairs(self):
+        return len(self.pairs)
+
+    def _store(self, raw_file):
+        if isinstance(raw_file, ScanStore):
+            return raw_file
+        if self.source == 'average':
+            return ScanStore.from_spectra([raw_file.data_avg])
+        if self.source == 'peaks':
+            return peaks_to_spectra(raw_file.peaks(self.peak_prominence), raw_file.nspectra)
+        if self.scan is not None:
+            if self.scan >= raw_file.nspectra:
+                return ScanStore.from_spectra([])
+            return raw_file.read_scans([self.scan])
+        return raw_file.data
+
+    def ratios(self, store: ScanStore):
+        # (pairs, scans) ratios of every scan of a store
+        extractor = ChromatogramExtractor(store)
+        if self.statistic == 'max':
+            intensity = extractor.maxima(self.masses, self.delta_mz, self.ppm)
+        elif self.statistic == 'counts':
+            intensity = extractor.counts(self.masses, self.delta_mz, self.ppm)
+        elif self.statistic == 'area':
+            intensity = extractor.extract(self.masses, self.delta_mz, self.ppm)
+        else:
+            raise Exception(f'Unknown statistic {self.statistic}, choose from max, counts or area.')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = intensity[self._numerator]/intensity[self._denominator]
+        return np.where(np.isfinite(ratios), ratios, np.nan)
+
+    def _value(self, ratios):
+        if ratios.shape[1] == 0 or np.isnan(ratios).all():
+            return np.full(self.npairs, np.nan)
+        if self.scan is not None and self.source == 'peaks':
+            return ratios[:, self.scan] if self.scan < ratios.shape[1] else np.full(self.npairs, np.nan)
+        if self.aggregate == 'mean':
+            return np.nanmean(ratios, axis=1)
+        return np.nanmedian(ratios, axis=1)
+
+    def add(self, raw_file, index=None, name=None):
+        # ratios of the next file (or of the file at index) written to its
+        # cell, returns the (row, col) of the cell, (-1, -1) past the grid
+        index = self.count if index is None else index
+        ratios = self.ratios(self._store(raw_file))
+        row, col = (int(x[0]) for x in self.layout.position(index))
+        if row >= 0:
+            self.values[:, row, col] = self._value(ratios)
+        while len(self.names) <= index:
+            self.names.append(None)
+            self.scan_ratios.append(None)
+        self.names[index] = name or getattr(getattr(raw_file, 'filename', None), 'name', None)
+        self.scan_ratios[index] = ratios
+        self.count = max(self.count, index + 1)
+        return row, col
+
+    def add_many(self, raw_files):
+        return [self.add(raw_file) for raw_file in raw_files]
+
+    def image(self, pair=0):
+        # (nrow, ncol) grid of the ratios of one pair, NaN for empty cells
+        return self.values[pair]
+
+    def to_table(self):
+        # one row per file and pair: index, well, row, col, name, pair and ratio
+        rows = []
+        for index in range(self.count):
+            if self.scan_ratios[index] is None:
+                continue
+            (row, ), (col, ) = self.layout.position(index)
+            well = well_name(row, col) if row >= 0 else None
+            for pair in range(self.npairs):
+                rows.append((index, well, int(row), int(col), self.names[index], pair,
+                             self.values[pair, row, col] if row >= 0 else np.nan))
+        dtype = [('index', np.int64), ('well', 'U8'), ('row', np.int64), ('col', np.int64),
+                 ('name', 'U256'), ('pair', np.int64), ('ratio', float)]
+        return np.array([tuple('' if v is None else v for v in r) for r in rows], dtype=dtype)
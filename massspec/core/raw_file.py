@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
 import re
-from pymsfilereader import MSFileReader
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pylab as plt
-from scipy.interpolate import interp1d
 import xlsxwriter
 from pathlib import Path
 from datetime import date
 from typing import Union
-from scipy.signal import find_peaks
 from scipy.io import savemat
+from .readers import open_reader, reader_suffixes, write_npz
+from .scans import ScanStore
+from .interpolation import BatchInterpolator
+from .binning import bin_spectra
+from .xic import ChromatogramExtractor
+from .peaks import pick_peaks, peak_mask
+from .state import FileRecord, CollectionState, file_signature
+from .lod import LevelOfDetail
+from .header import HeaderTable
+from .averaging import SpectrumAverager
+from .compare import RunComparison
+from .precision import StoragePrecision
+from . import profiling
+from .profiling import profile
 
 colors = ['red', 'blue', 'green', 'cyan', 'magenta']
 today = date.today()
@@ -19,45 +33,132 @@ class RawFile(object):  # need a better name
                  filename: Union[str, Path],
                  interpolate: bool=False,
                  interpolation_type: str = 'cubic', 
-                 factor: int=1):
+                 factor: int=1,
+                 reader=None,
+                 lazy: bool=False,
+                 precision=None):
+        # with lazy=True only the number of scans is read when the file is
+        # opened, scans, headers and averages are read on first access.
+        # precision: dtypes the scans are kept in, e.g. 'float32' intensities,
+        # see precision.StoragePrecision; error_bounds holds the errors
         self.filename = Path(filename)
+        self.reader = reader
+        self.lazy = lazy
+        self.precision = None if precision is None else StoragePrecision.create(precision)
+        self.error_bounds = None
         if not self.filename.exists():
             raise Exception(f'File {self.filename} does not exist.')            
-        self.data = []
-        self.data_avg = None
-        self.functions = []
-        self.interpolated_data = []
-        self.header = []
+        self._data = None
+        self._header = None
+        self._data_avg = None
+        self._average_spectrum = None
+        self._nspectra = 0
+        self.mass_resolution = None
+        self._interpolator = None
+        self._interpolated_data = ScanStore.from_spectra([])
+        self._interpolated_data_avg = None
+        self._interpolated = False
+        self._peaks = {}
+        self._averagers = {}
         self.has_error=False
         self._get_data()
         self.interpolate = interpolate
-        if interpolate and not self.has_error:
+        self.interpolation_type = interpolation_type
+        self.factor = factor
+        if interpolate and not self.has_error and not lazy:
             self._get_interpolated(interpolation_type, factor)
         
+    def _open(self):
+        return open_reader(self.filename, self.reader)
+
     def _get_data(self):
         try:
-            ms_file = MSFileReader(self.filename.as_posix())
+            with profiling.stage('reader.open'):
+                ms_file = self._open()
         except:
             print(f"Can not open {self.filename}")
             self.has_error = True
             return 
-        if ms_file.GetNumSpectra() == 0:
-            print(f"{self.filename} does not contain data")
-            self.has_error = True
-            return
-        for ispectrum in range(1, ms_file.GetNumSpectra() + 1):
-            self.data.append(np.array(ms_file.GetMassListFromScanNum(ispectrum)[0]).T)
-            self.header.append(ms_file.GetScanHeaderInfoForScanNum(ispectrum))
-        self._nspectra = ms_file.GetNumSpectra()
-        self.average_spectrum = np.array(ms_file.GetAveragedMassSpectrum(
-            list(range(1,self._nspectra+1)))[0]).T
-
-        self.mass_resolution = ms_file.MassResolution
-        self.data_avg = np.array(ms_file.GetAverageMassList(1,self._nspectra)[0]).T
-        ms_file.Close()
-        # self.data = np.array(self.data)
+        with ms_file:
+            if ms_file.nspectra == 0:
+                print(f"{self.filename} does not contain data")
+                self.has_error = True
+                return
+            self._nspectra = ms_file.nspectra
+            self.mass_resolution = ms_file.mass_resolution
+            if not self.lazy:
+                # the averaged spectrum of the reader is only read when it is
+                # used, other averages come from the scans (see average)
+                self._load(ms_file, 'data', 'header', 'data_avg')
         self.has_error=False
 
+    def _load(self, ms_file, *fields):
+        if 'data' in fields and self._data is None:
+            with profiling.stage('reader.get_spectra') as stage:
+                self._data = ms_file.get_spectra()
+                if self.precision is not None:
+                    self._data, self.error_bounds = self.precision.apply(self._data)
+                stage.nbytes, stage.items = self._data.nbytes, self._data.npoints
+        if 'header' in fields and self._header is None:
+            with profiling.stage('reader.get_header', items=self._nspectra):
+                self._header = ms_file.get_headers()
+        if 'average_spectrum' in fields and self._average_spectrum is None:
+            with profiling.stage('reader.get_average_spectrum') as stage:
+                self._average_spectrum = ms_file.get_average_spectrum()
+                stage.nbytes, stage.items = self._average_spectrum.nbytes, len(self._average_spectrum)
+        if 'data_avg' in fields and self._data_avg is None:
+            with profiling.stage('reader.get_average_mass_list') as stage:
+                self._data_avg = ms_file.get_average_mass_list()
+                stage.nbytes, stage.items = self._data_avg.nbytes, len(self._data_avg)
+
+    def _fetch(self, *fields):
+        if self.has_error:
+            return
+        with self._open() as ms_file:
+            self._load(ms_file, *fields)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._fetch('data')
+        if self._data is None:
+            return ScanStore.from_spectra([])
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._peaks = {}
+        self._averagers = {}
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._fetch('header')
+        if self._header is None:
+            return HeaderTable.from_columns({}, nscans=0)
+        return self._header
+
+    @property
+    def data_avg(self):
+        if self._data_avg is None:
+            self._fetch('data_avg')
+        return self._data_avg
+
+    @data_avg.setter
+    def data_avg(self, value):
+        self._data_avg = value
+
+    @property
+    def average_spectrum(self):
+        if self._average_spectrum is None:
+            self._fetch('average_spectrum')
+        return self._average_spectrum
+
+    @property
+    def is_loaded(self):
+        return self._data is not None
+
     @property
     def nspectra(self):
         return self._nspectra
@@ -66,52 +167,101 @@ class RawFile(object):  # need a better name
     def dt(self):
         return self._dt
 
+    def iter_spectra(self, scans_per_chunk=1024):
+        # (first scan, ScanStore) for consecutive groups of scans. Scans that
+        # are not loaded are read one group at a time and are not kept
+        if self.is_loaded or self.has_error:
+            for start in range(0, self.nspectra, scans_per_chunk):
+                yield start, self.data.slice(start, start + scans_per_chunk)
+            return
+        with self._open() as ms_file:
+            for start in range(0, self.nspectra, scans_per_chunk):
+                with profiling.stage('reader.get_spectra_range') as stage:
+                    store = ms_file.get_spectra_range(start, start + scans_per_chunk)
+                    stage.nbytes, stage.items = store.nbytes, store.npoints
+                yield start, store
+
+    def _ensure_interpolated(self):
+        if self.interpolate and not self._interpolated and not self.has_error:
+            self._get_interpolated(self.interpolation_type, self.factor)
+
+    @property
+    def interpolator(self):
+        self._ensure_interpolated()
+        if self._interpolator is None and not self.has_error:
+            self._interpolator = BatchInterpolator(self.data, kind=self.interpolation_type or 'cubic')
+        return self._interpolator
+
+    @property
+    def interpolated_data(self):
+        self._ensure_interpolated()
+        return self._interpolated_data
+
+    @property
+    def interpolated_data_avg(self):
+        self._ensure_interpolated()
+        return self._interpolated_data_avg
+
     def _get_interpolated(self, interpolation=None, factor=1):
         if interpolation is None:
             return 
         else :
-            for ispectrum in range(self.nspectra):
-                self.functions.append(interp1d(self.data[ispectrum][:,0], 
-                                               self.data[ispectrum][:,1], kind=interpolation))
-                x = np.linspace(self.data[ispectrum][:, 0].min(), self.data[ispectrum][:, 0].max(), self.data[ispectrum].shape[0]*factor)
-                y = self.functions[ispectrum](x)
-                self.interpolated_data.append(np.array([x, y]).T)
-        self.interpolated_data = np.array(self.interpolated_data)
-        func = interp1d(self.data_avg[:, 0], self.data_avg[:, 1], kind=interpolation)
-        x = np.linspace(self.data_avg[:, 0].min(), self.data_avg[:, 0].max(), self.data_avg.shape[0]*factor)
-        y = func(x)
-        self.interpolated_data_avg = np.array([x, y]).T
-
-    def get_ratio(self, mass_1, mass_2, spectrum_number):
+            # one interpolator for all scans instead of one interp1d per scan
+            with profiling.stage('RawFile.interpolate', items=self.data.npoints) as stage:
+                self._interpolator = BatchInterpolator(self.data, kind=interpolation)
+                self._interpolated_data = self._interpolator.resample(factor)
+                if self.precision is not None:
+                    self._interpolated_data = self._interpolated_data.astype(*self.precision.memory_dtypes)
+                stage.nbytes = self._interpolated_data.nbytes
+        average = BatchInterpolator(ScanStore.from_spectra([self.data_avg]), kind=interpolation)
+        self._interpolated_data_avg = average.resample(factor)[0]
+        self._interpolated = True
+
+    def get_ratio(self, mass_1, mass_2, spectrum_number=None):
         return self.get_intensity(mass_1, spectrum_number)/self.get_intensity(mass_2, spectrum_number)
 
-    def get_intensity(self, mass, spectrum_number):
-        return self.functions[spectrum_number](mass)
+    def get_intensity(self, mass, spectrum_number=None):
+        # mass and spectrum_number broadcast against each other, 
+        # spectrum_number=None returns an array with one value per scan
+        if spectrum_number is None:
+            spectrum_number = np.arange(self.nspectra)
+        return self.interpolator(mass, spectrum_number)
+
+    def get_intensities(self, masses, spectrum_numbers=None):
+        # shape (len(masses), len(spectrum_numbers))
+        return self.interpolator.matrix(masses, spectrum_numbers)
     
-    def plot(self, average=True, show=True):
+    def plot(self, average=True, show=True, peak_prominence=None, lod=True):
+        # with lod=True lines only hold the min/max of every pixel of m/z,
+        # recomputed when zooming (see lod.LevelOfDetail)
         plt.figure(figsize=(9, 6))
         ax = plt.subplot(111)
+        self.lod = LevelOfDetail(ax) if lod else None
+        draw = self.lod.plot if lod else ax.plot
         if not average:
-            for ispectrum, spec in enumerate(self.data):
-                ax.plot(
-                    spec[:, 0],
-                    spec[:, 1],
+            for ispectrum in range(self.nspectra):
+                draw(
+                    *self.data.scan(ispectrum),
                     label=f"Original Spectrum-{ispectrum + 1}",
                 )
                 if self.interpolate:
-                    ax.plot(
-                        self.interpolated_data[ispectrum][:, 0],
-                        self.interpolated_data[ispectrum][:, 1],
+                    draw(
+                        *self.interpolated_data.scan(ispectrum),
                         label=f"Interpolated Spectrum-{ispectrum + 1}",
                     )
-            xs = np.concatenate([x[:, 0] for x in self.data])
-            ax.set_xlim(xs.min(), xs.max())
+            if peak_prominence is not None:
+                peaks = self.peaks(peak_prominence)
+                ax.scatter(peaks['mz'], peaks['intensity'], marker='x', color='black', zorder=3)
+            ax.set_xlim(self.data.mz.min(), self.data.mz.max())
         else:
             if self.interpolate:
-                ax.plot(self.interpolated_data_avg[:, 0], 
-                        self.interpolated_data_avg[:, 1], label="Interpolated", color='blue')
-            ax.plot(self.data_avg[:, 0], 
-                    self.data_avg[:, 1], label="Original", color='red')
+                draw(self.interpolated_data_avg[:, 0], 
+                     self.interpolated_data_avg[:, 1], label="Interpolated", color='blue')
+            draw(self.data_avg[:, 0], 
+                 self.data_avg[:, 1], label="Original", color='red')
+            if peak_prominence is not None:
+                peaks = self.average_peaks(peak_prominence)
+                ax.scatter(peaks['mz'], peaks['intensity'], marker='x', color='black', zorder=3)
             ax.set_title("Averaged Spectra")
             ax.set_xlim(self.data_avg[:, 0].min(), self.data_avg[:, 0].max())
         ax.set_ylim(0,)
@@ -124,30 +274,57 @@ class RawFile(object):  # need a better name
             plt.show()
         return ax
 
+    def peaks(self, peak_prominence=500, centroid=False, n_jobs=1):
+        # peak table of every scan, see peaks.PEAK_DTYPE, computed once per
+        # set of parameters
+        key = ('scans', peak_prominence, centroid)
+        if key not in self._peaks:
+            self._peaks[key] = pick_peaks(self.data, prominence=peak_prominence, 
+                                          centroid=centroid, n_jobs=n_jobs)
+        return self._peaks[key]
+
+    def average_peaks(self, peak_prominence=500, centroid=False):
+        key = ('average', peak_prominence, centroid)
+        if key not in self._peaks:
+            self._peaks[key] = pick_peaks(ScanStore.from_spectra([self.data_avg]), 
+                                          prominence=peak_prominence, centroid=centroid)
+        return self._peaks[key]
+
+    @profile('RawFile.reduce', size=None)
     def reduce(self,
                peak_prominence=500):
-        for i_spec, spectrum in enumerate(self.data):        
-            peaks, _ = find_peaks(spectrum[:, 1], prominence=peak_prominence)
-            self.data[i_spec] = spectrum[peaks]
-        peaks, _ = find_peaks(self.data_avg[:, 1], prominence=peak_prominence)
-        self.data_avg = self.data_avg[peaks]
+        average_peaks = self.average_peaks(peak_prominence)
+        self.data = self.data.compress(peak_mask(self.peaks(peak_prominence), self.data))
+        self.data_avg = self.data_avg[average_peaks['index']]
         return 
 
     @property
     def ndata(self):
-        return self.data[0].shape[0]
+        return int(self.data.lengths[0])
     
+    @profile('RawFile.to_excel', size=None)
     def to_excel(self,
                 output_path=f"{today.strftime('%Y%m%d')}.xlsx",
                 rounding=False, 
                 decimals=2,
-                overwrite=False):
+                overwrite=False,
+                streaming=False,
+                spectra_per_sheet=8192,
+                rows_per_chunk=1024):
+        # streaming=True writes in xlsxwriter's constant_memory mode and 
+        # spills over to new sheets at Excel's row and column limits
         path = Path(output_path)
         c = 1
         while path.exists() and not overwrite:
             mod = f"{path.stem}-Run{c}{path.suffix}"
             path = path.parent / mod
             c += 1
+        if streaming:
+            from ..utils.export_to_excel import stream_raw_file
+            stream_raw_file(self, path, rounding=rounding, decimals=decimals,
+                            spectra_per_sheet=spectra_per_sheet, 
+                            rows_per_chunk=rows_per_chunk)
+            return
             
         with xlsxwriter.Workbook(path.as_posix()) as workbook:
             if self.filename.stat().st_size//2**20 > 50:
@@ -158,15 +335,16 @@ class RawFile(object):  # need a better name
                 num_format = None
             sheet_name = "Spectra"
             worksheet = workbook.add_worksheet(sheet_name)
-            for i_spec, spectrum in enumerate(self.data):
+            for i_spec in range(self.data.nspectra):
+                mz, intensity = self.data.scan(i_spec)
                 worksheet.write(0, i_spec*2, f"Spectrum {i_spec + 1} m/z")
                 worksheet.write(0, i_spec*2+1, 
                                 f"Spectrum {i_spec + 1} Intensity")
                 worksheet.write(1, i_spec*2, 
-                                self.header[i_spec]['StartTime'], 
+                                self.header['StartTime'][i_spec], 
                                 num_format)
-                worksheet.write_column(2, i_spec*2, spectrum[:, 0], num_format)
-                worksheet.write_column(2, i_spec*2+1, spectrum[:, 1], num_format)
+                worksheet.write_column(2, i_spec*2, mz, num_format)
+                worksheet.write_column(2, i_spec*2+1, intensity, num_format)
             sheet_name = "Average"
             worksheet = workbook.add_worksheet(sheet_name)
             worksheet.write(0, 0, "m/z")
@@ -175,75 +353,361 @@ class RawFile(object):  # need a better name
             worksheet.write_column(1, 1, self.data_avg[:, 1])
         return 
 
+    @property
+    def start_times(self):
+        return self.header.start_times
+
+    def averager(self, width=None, ppm=None):
+        # SpectrumAverager of the scans on a grid of width Da or ppm (the
+        # median spacing of the points by default), built once per grid
+        key = (width, ppm)
+        if key not in self._averagers:
+            self._averagers[key] = SpectrumAverager(self.data, width=width, ppm=ppm,
+                                                    start_times=self.start_times)
+        return self._averagers[key]
+
+    def average(self, start=None, stop=None, rt=None, statistic='mean', width=None, ppm=None):
+        # mean, sum or median spectrum of scans start to stop - 1 (0-based)
+        # or of the time window rt=(low, high), as an (n, 2) array
+        return self.averager(width, ppm).average(start, stop, rt=rt, statistic=statistic)
+
+    def select_scans(self, where=None, **ranges):
+        # 0-based indices of the scans matching a query on the headers, e.g.
+        # rt=(1.5, 3.0), tic=(1e6, None), see HeaderTable.mask. Only the
+        # headers are read
+        return self.header.select(where, **ranges)
+
+    def read_scans(self, indices=None, where=None, **ranges):
+        # scans at indices, or matching a query. Scans of a file that is not
+        # loaded are read from the reader and are not kept
+        if indices is None:
+            indices = self.select_scans(where, **ranges)
+        if self.is_loaded or self.has_error:
+            return self.data.take(indices)
+        with profiling.stage('reader.get_scans') as stage:
+            with self._open() as ms_file:
+                store = ms_file.get_scans(indices)
+            stage.nbytes, stage.items = store.nbytes, store.npoints
+        return store
+
+    def to_matrix(self, width=None, ppm=None, grid=None, statistic='sum', sparse=None):
+        # every scan binned on a common m/z axis, rows are the scan start times
+        return bin_spectra(self.data, grid=grid, width=width, ppm=ppm, 
+                           statistic=statistic, sparse=sparse,
+                           rows=self.start_times, row_label='Time')
+
+    def xic(self, masses, delta_mz=None, ppm=None, dx=None):
+        # integrated area of every target in every scan, (targets, scans)
+        return ChromatogramExtractor(self.data).extract(masses, delta_mz=delta_mz, ppm=ppm, dx=dx)
+
     def to_dict(self):
         ret = {}
         for attr in ['data', 'data_avg', 'header']:
             ret[attr] = getattr(self, attr)
+        ret['data'] = self.data.to_list()
+        ret['header'] = self.header.to_dicts()
         return ret
     
+    @profile('RawFile.to_matlab', size=None)
     def to_matlab(self, filename='matlab_out.mat'):
         savemat(filename, self.to_dict())
         return
+
+    @profile('RawFile.to_parquet', size=None)
+    def to_parquet(self, filename=None, compression='zstd'):
+        # long format (file, scan, rt, mz, intensity), see utils/export_to_parquet.py
+        from ..utils.export_to_parquet import write_parquet
+        if filename is None:
+            filename = self.filename.with_suffix('.parquet')
+        return write_parquet(self, filename, compression=compression)
+
+    @profile('RawFile.to_hdf5', size=None)
+    def to_hdf5(self, filename=None, compression='gzip', precision=None):
+        # adds this file as a group of the HDF5 file, see utils/export_to_hdf5.py
+        from ..utils.export_to_hdf5 import write_hdf5
+        if filename is None:
+            filename = self.filename.with_suffix('.h5')
+        return write_hdf5(self, filename, compression=compression, precision=precision)
+
+    @profile('RawFile.to_npz', size=None)
+    def to_npz(self, filename=None, precision=None, compression=None):
+        # precision and compression, see readers.write_npz. Returns the
+        # error bounds of the stored scans
+        if filename is None:
+            filename = self.filename.with_suffix('.npz')
+        return write_npz(filename, self.data, self.header, 
+                         average=self.data_avg, 
+                         mass_resolution=self.mass_resolution,
+                         precision=precision,
+                         compression=compression)
         
         
 
+def _file_number(name):
+    numbers = re.findall("([0-9]+)", name)
+    return int(numbers[0]) if len(numbers) > 0 else -1
+
+
+def _load_raw_file(args):
+    # module level so that it can be sent to worker processes
+    filename, kwargs = args
+    try:
+        # stages timed in a worker process go back with the file
+        with profiling.collect() as stages:
+            with profiling.stage('RawFile.load'):
+                raw_file = RawFile(filename, **kwargs)
+        if stages:
+            raw_file.profile = stages
+        return raw_file, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
 class RawFileCollection(object):
-    def __init__(self, path='.', interpolation='cubic', factor=2, track_mass=None, delta_mz=3, dmz=0.2):
+    def __init__(self, path='.', interpolation='cubic', factor=2, track_mass=None, delta_mz=3, dmz=0.2, reader=None,
+                 n_jobs=1, chunksize=1, lazy=False, state=None, precision=None):
+        # state=True keeps a summary of every loaded file in the cache 
+        # directory (or in the directory given as state), so a new session
+        # only loads the files that are new or changed. precision is passed
+        # to every RawFile
         self.path = Path(path)
+        self.reader = reader
+        self.lazy = lazy
+        self.precision = precision
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+        self.errors = {}
+        self._peaks = {}
         self.ratio = False
         self.interpolation = interpolation
         self.factor = factor
-        self._data_avg = []
-        self._data = []
-        self.files = []
-        self.track_area = []
-        self.total_area = []
-        self.nfiles = 0
+        # file name -> FileRecord, in the order of the files
+        self.records = {}
+        self._version = 0
         self.dt = 1
         self.track_mass = track_mass
         self.delta_mz = delta_mz
         self.dmz = dmz
+        self.track_area_sum = 0.0
+        self.total_area_sum = 0.0
+        settings = dict(track_mass=np.atleast_1d(track_mass).tolist() if track_mass is not None else None,
+                        delta_mz=delta_mz, dmz=dmz)
+        if state is None or state is False:
+            self.state = None
+        elif state is True:
+            self.state = CollectionState.for_path(self.path, settings)
+        else:
+            self.state = CollectionState(state, settings)
+        if self.state is not None:
+            for record in self.state.load(self.path).values():
+                self._add_record(record, save=False)
         self.parse()
 
 
-    def parse(self):
+    @profile('RawFileCollection.parse', size=None)
+    def parse(self, n_jobs=None, chunksize=None):
+        # n_jobs=1 loads in this process, n_jobs=None uses every core
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        chunksize = self.chunksize if chunksize is None else chunksize
+        # only files that are new or changed since they were added are 
+        # loaded, files that are gone are removed
         files = [x for x in self.path.iterdir()]
-        sort_dict = {int(re.findall("([0-9]+)", x.name)[0]):x for x in files if x.suffix.lower() == '.raw'}
-        for ix in sorted(sort_dict):
-            raw_file = RawFile(sort_dict[ix], interpolation=self.interpolation, factor=self.factor)
+        suffixes = reader_suffixes(self.reader)
+        sort_dict = {_file_number(x.name):x for x in files if x.suffix.lower() in suffixes}
+        present = set(x.name for x in sort_dict.values())
+        for name in [x for x in self.records if x not in present]:
+            self.remove_file(name)
+        filenames = [sort_dict[ix] for ix in sorted(sort_dict) 
+                     if not self.is_current(sort_dict[ix])]
+        args = [(filename, self._load_kwargs()) for filename in filenames]
+        if n_jobs == 1 or len(filenames) < 2:
+            results = map(_load_raw_file, args)
+            self._add_results(filenames, results)
+        else:
+            n_jobs = min(n_jobs or os.cpu_count(), len(filenames))
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                # map keeps the numeric order of the file names
+                results = pool.map(_load_raw_file, args, chunksize=chunksize)
+                self._add_results(filenames, results)
+        self.records = {name: self.records[name] for name in 
+                        sorted(self.records, key=_file_number)}
+
+    def _add_results(self, filenames, results):
+        for filename, (raw_file, error) in zip(filenames, results):
+            if error is not None:
+                print(f"Can not load {filename.name}, skipping")
+                self.errors[filename.name] = error
+                continue
             self.add_file(raw_file)
-            if not raw_file.has_error:
-                self.nfiles += 1
+            if raw_file.has_error:
+                self.errors[filename.name] = f"{filename.name} could not be read"
+
+    def _load_kwargs(self):
+        return dict(interpolate=self.interpolation is not None, 
+                    interpolation_type=self.interpolation, 
+                    factor=self.factor, 
+                    reader=self.reader,
+                    lazy=self.lazy,
+                    precision=self.precision)
+
+    def load_file(self, filename):
+        return RawFile(filename, **self._load_kwargs())
+
+    def is_current(self, filename):
+        # True if the file was added and did not change since
+        name = Path(filename).name
+        return name in self.records and self.records[name].matches(filename)
+
+    def _summarize(self, record):
+        if self.track_mass is not None and record.track_area is None:
+            # track_mass can be one mass or a list of masses
+            extractor = ChromatogramExtractor(ScanStore.from_spectra([record.data_avg]))
+            area = extractor.extract(self.track_mass, delta_mz=self.delta_mz, dx=self.dmz)[:, 0]
+            record.track_area = area if np.ndim(self.track_mass) else area[0]
+            record.total_area = extractor.total(dx=self.dmz)[0]
+
+    def _add_record(self, record, save=True):
+        # adds or replaces one file, the running totals are updated with 
+        # this file only
+        self._summarize(record)
+        if record.name in self.records:
+            self._discard(self.records[record.name])
+        self.records[record.name] = record
+        if record.track_area is not None:
+            self.track_area_sum = self.track_area_sum + record.track_area
+            self.total_area_sum = self.total_area_sum + record.total_area
+        if save and self.state is not None:
+            self.state.save(record)
+        self._version += 1
+
+    def _discard(self, record):
+        if record.track_area is not None:
+            self.track_area_sum = self.track_area_sum - record.track_area
+            self.total_area_sum = self.total_area_sum - record.total_area
 
     def add_file(self, raw_file):
+        profiling.merge(raw_file.__dict__.pop('profile', None))
         if raw_file.data_avg is not None:
-            if self._data_avg is None:
-                self._data_avg.append(raw_file.data_avg) 
-                self._data.append(raw_file.data)
-            else :
-                self._data_avg.append(raw_file.data_avg) 
-                self._data.append(raw_file.data)
-            if self.track_mass is not None:
-                cond1 = raw_file.data_avg[:,0] > self.track_mass - self.delta_mz
-                cond2 = raw_file.data_avg[:,0] < self.track_mass + self.delta_mz
-                cond = np.bitwise_and(cond1, cond2)
-                self.track_area.append(np.trapz(raw_file.data_avg[cond, 1], dx=self.dmz))
-                self.total_area.append(np.trapz(raw_file.data_avg[:, 1], dx=self.dmz))
-            self.files.append(raw_file.filename.name)
+            try:
+                size, mtime_ns = file_signature(raw_file.filename)
+            except OSError:
+                size, mtime_ns = -1, -1
+            self._add_record(FileRecord(raw_file.filename.name, raw_file.filename, 
+                                        size, mtime_ns, raw_file.nspectra, 
+                                        raw_file.data_avg, raw_file=raw_file))
+
+    def remove_file(self, name):
+        name = Path(name).name
+        if name in self.records:
+            self._discard(self.records.pop(name))
+            if self.state is not None:
+                self.state.remove(name)
+            self._version += 1
+
+    def _raw_file(self, record):
+        # files restored from the state are opened lazily on first use
+        if record.raw_file is None:
+            kwargs = self._load_kwargs()
+            kwargs['lazy'] = True
+            record.raw_file = RawFile(record.path, **kwargs)
+            record.raw_file.data_avg = record.data_avg
+        return record.raw_file
+
+    @property
+    def raw_files(self):
+        return [self._raw_file(x) for x in self.records.values()]
+
+    @property
+    def files(self):
+        return list(self.records)
+
+    @property
+    def nfiles(self):
+        return len(self.records)
+
+    @property
+    def track_area(self):
+        return [x.track_area for x in self.records.values()] if self.track_mass is not None else []
+
+    @property
+    def total_area(self):
+        return [x.total_area for x in self.records.values()] if self.track_mass is not None else []
 
     @property
     def data_avg(self):
-        return self._data_avg
+        return [x.data_avg for x in self.records.values()]
     
     @property    
     def data(self):
-        return self._data
+        # scans of lazy files are read here, on first access
+        return [x.data for x in self.raw_files]
+
+    @property
+    def scans(self):
+        # every scan of every file in a single store
+        return ScanStore.concatenate(self.data)
+
+    @property
+    def file_offsets(self):
+        return np.concatenate([[0], np.cumsum([x.nspectra for x in self.records.values()])]).astype(np.int64)
 
+    @property
+    def averages(self):
+        return ScanStore.from_spectra(self.data_avg)
+
+    @property
+    def track_masses(self):
+        return np.atleast_1d(self.track_mass) if self.track_mass is not None else np.zeros(0)
+
+    def xic(self, masses, delta_mz=None, ppm=None, dx=None, scans=True):
+        # (targets, scans) areas over every scan of every file, file i owns
+        # the columns file_offsets[i]:file_offsets[i+1]. With scans=False
+        # the averaged spectra are used and the result is (targets, files)
+        store = self.scans if scans else self.averages
+        return ChromatogramExtractor(store).extract(masses, delta_mz=delta_mz, ppm=ppm, dx=dx)
+
+    def peaks(self, peak_prominence=500, scans=True, centroid=False, n_jobs=1):
+        # peak table over every scan of the run (scan indexes self.scans, 
+        # use file_offsets to map it to files), or with scans=False over the
+        # averaged spectra (scan is then the file index). Computed once.
+        key = (peak_prominence, scans, centroid)
+        if key not in self._peaks or self._peaks[key][0] != self._version:
+            store = self.scans if scans else self.averages
+            self._peaks[key] = (self._version, 
+                                pick_peaks(store, prominence=peak_prominence, 
+                                           centroid=centroid, n_jobs=n_jobs))
+        return self._peaks[key][1]
+
+    def compare(self, *others, width=None, ppm=None, grid=None):
+        # files of this and other collections binned together, for
+        # similarity matrices, drift and differential tables (see compare.py)
+        return RunComparison([self, *others], grid=grid, width=width, ppm=ppm)
+
+    def to_matrix(self, width=None, ppm=None, grid=None, scans=False, statistic='sum', sparse=None):
+        # files x m/z matrix of the averaged spectra, or with scans=True 
+        # every scan of every file on the same m/z axis
+        if scans:
+            names = [f"{name} {i + 1}" for name, raw_file in zip(self.files, self.raw_files)
+                     for i in range(raw_file.nspectra)]
+            return bin_spectra(self.scans, grid=grid, width=width, ppm=ppm,
+                               statistic=statistic, sparse=sparse,
+                               row_label='Spectra Number', names=names)
+        return bin_spectra(self.averages, grid=grid, width=width, ppm=ppm,
+                           statistic=statistic, sparse=sparse,
+                           row_label='File', names=list(self.files))
+
+    @profile('RawFileCollection.to_excel', size=None)
     def to_excel(self,
                  output_path=f"{today.strftime('%Y%m%d')}-Run1.xlsx",
                  reduce=False,
                  peak_prominence=500,
-                 n_reduction=0):
+                 n_reduction=0,
+                 streaming=False,
+                 scans=False,
+                 spectra_per_sheet=8192,
+                 rows_per_chunk=1024):
+        # streaming=True writes in constant memory, spills over to new sheets
+        # at Excel's limits and with scans=True adds every scan of every file
         path = Path(output_path)
         c = 2
         while path.exists():
@@ -251,30 +715,56 @@ class RawFileCollection(object):
             # might need to change :-1 for double digits
             path = path.parent / mod
             c += 1
+        averages = self.averages
+        if reduce:
+            # every file is reduced at once
+            for i in range(n_reduction):
+                peaks = self.peaks(peak_prominence, scans=False) if i == 0 else \
+                    pick_peaks(averages, prominence=peak_prominence)
+                averages = averages.compress(peak_mask(peaks, averages))
+        if streaming:
+            from ..utils.export_to_excel import stream_collection
+            stream_collection(self, path, averages=averages, scans=scans,
+                              spectra_per_sheet=spectra_per_sheet,
+                              rows_per_chunk=rows_per_chunk)
+            return
         with xlsxwriter.Workbook(path.as_posix()) as workbook:
             sheet_name = "Avg spectrum"
             worksheet = workbook.add_worksheet(sheet_name)
-            for iscan, d in enumerate(self.data_avg):
-                data = d
-                if reduce:
-                    for i in range(n_reduction):
-                        peaks, _ = find_peaks(data[:, 1], prominence=peak_prominence)
-                        data = data[peaks]
+            for iscan in range(averages.nspectra):
+                mz, intensity = averages.scan(iscan)
                 worksheet.write(0, iscan*2, f"{self.files[iscan]}")
                 worksheet.write(1, iscan*2, "m/z")
                 worksheet.write(1, iscan*2 + 1, "Intensity")
-                worksheet.write_column(2, iscan*2, data[:, 0])
-                worksheet.write_column(2, iscan*2 + 1, data[:, 1])
+                worksheet.write_column(2, iscan*2, mz)
+                worksheet.write_column(2, iscan*2 + 1, intensity)
             if self.track_mass is not None:
-                worksheet_track_mass = workbook.add_worksheet(f"Integrated {self.track_mass} m-z ")
+                if np.ndim(self.track_mass):
+                    worksheet_track_mass = workbook.add_worksheet("Integrated m-z")
+                else:
+                    worksheet_track_mass = workbook.add_worksheet(f"Integrated {self.track_mass} m-z ")
+                track_area = np.array(self.track_area).reshape(self.nfiles, -1)
                 worksheet_track_mass.write(0, 0, "Scan number")
-                worksheet_track_mass.write(0, 1, f"{self.track_mass} Count")
-                worksheet_track_mass.write(0, 2, "Total Count")
                 worksheet_track_mass.write_column(1, 0, np.arange(1, self.nfiles+1))
-                worksheet_track_mass.write_column(1, 1, np.array(self.track_area))
-                worksheet_track_mass.write_column(1, 2, np.array(self.total_area))
+                for itarget, mass in enumerate(self.track_masses):
+                    worksheet_track_mass.write(0, itarget + 1, f"{mass} Count")
+                    worksheet_track_mass.write_column(1, itarget + 1, track_area[:, itarget])
+                worksheet_track_mass.write(0, len(self.track_masses) + 1, "Total Count")
+                worksheet_track_mass.write_column(1, len(self.track_masses) + 1, np.array(self.total_area))
         return
 
+    @profile('RawFileCollection.to_parquet', size=None)
+    def to_parquet(self, directory, compression='zstd'):
+        # one Parquet part per file, read back with utils.export_to_parquet.read_parquet
+        from ..utils.export_to_parquet import collection_to_parquet
+        return collection_to_parquet(self, directory, compression=compression)
+
+    @profile('RawFileCollection.to_hdf5', size=None)
+    def to_hdf5(self, filename, compression='gzip'):
+        # one group per file, read back with utils.export_to_hdf5.read_hdf5
+        from ..utils.export_to_hdf5 import collection_to_hdf5
+        return collection_to_hdf5(self, filename, compression=compression)
+
     def init_plot(self):
         self.fig = plt.figure(figsize=(16, 9))
         if self.track_mass:
@@ -294,14 +784,19 @@ class RawFileCollection(object):
         self.ax_spectra.set_xlabel("m/z", fontsize=18)
         self.ax_spectra.set_ylabel("Spectra Number", fontsize=18)
         self.ax_spectra.set_zlabel("Intensity", fontsize=18)
+        # spectra are drawn at screen resolution, see lod.LevelOfDetail
+        self.lod = LevelOfDetail(self.ax_spectra)
 
     def plot(self):
         self.init_plot()
         for i in range(self.nfiles):
             self.update(i)
-        self.ax_track_mass.plot(np.arange(1, self.nfiles + 1), 
-                                self.track_area, color='blue', 
-                                label=f'Inegrated {self.track_mass-self.delta_mz}-{self.track_mass+self.delta_mz}')
+        track_area = np.array(self.track_area).reshape(self.nfiles, -1)
+        for itarget, mass in enumerate(self.track_masses):
+            self.ax_track_mass.plot(np.arange(1, self.nfiles + 1), 
+                                    track_area[:, itarget], 
+                                    color='blue' if len(self.track_masses) == 1 else None, 
+                                    label=f'Inegrated {mass-self.delta_mz}-{mass+self.delta_mz}')
         self.ax_track_mass.scatter(np.arange(1, self.nfiles + 1), 
                                self.total_area, facecolors='none', edgecolor='red',
                                label='Total Count', marker='o')
@@ -316,9 +811,8 @@ class RawFileCollection(object):
 
     def update(self, i):
         x = self.data_avg[i][:, 0]
-        y = [i * self.dt] * len(x)
         z = self.data_avg[i][:, 1]
-        self.ax_spectra.plot(x, y, z, color=colors[i % 5])
+        self.lod.plot(x, z, depth=i * self.dt, color=colors[i % 5])
         # if self.track_mass is not None:
         #     self.ax_track_mass.plot(i, self.track_area[i])
                 
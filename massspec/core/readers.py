@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Spectrum reader backends used by RawFile and RawFileCollection.
+
+A reader is any callable that takes a filename and returns an object with the
+interface of ``SpectrumReader``. Scan numbers are 1-based, as in MSFileReader.
+
+Two backends ship with the package:
+
+``MSFileReaderBackend`` (``'msfilereader'``, ``.raw``)
+    Thin wrapper around ``pymsfilereader.MSFileReader``. Windows only.
+
+``NpzReader`` (``'npz'``, ``.npz``)
+    Pure numpy reader for the following archive layout (see ``write_npz``)::
+
+        mz               float (N,)       m/z of all scans, concatenated
+        intensity        float (N,)       intensity of all scans, concatenated
+        offsets          int64 (nscans+1) scan i is mz[offsets[i-1]:offsets[i]]
+        header_<Field>   (nscans,)        one column per scan header field,
+                                          e.g. header_StartTime, header_TIC
+        average          float (M, 2)     optional averaged spectrum
+        mass_resolution  float ()         optional
+
+    When ``average`` is missing, it is computed by averaging the intensities
+    of identical m/z values over all scans.
+
+    Intensities stored as scaled integers come with two more float arrays
+    of shape (nscans,), ``intensity_offset`` and ``intensity_scale``. A
+    compressed archive stores its columns as uint8 arrays of compressed bytes
+    and an ``encoding`` JSON string describing them. See ``write_npz`` and
+    ``precision``.
+"""
+import json
+from pathlib import Path
+from typing import Union
+import numpy as np
+from .scans import ScanStore
+from .header import HeaderTable
+from .precision import StoragePrecision, encode_column, decode_column, dequantize
+
+
+class SpectrumReader(object):
+    suffixes = ()
+
+    def __init__(self, filename: Union[str, Path]):
+        self.filename = Path(filename)
+
+    @property
+    def nspectra(self):
+        raise NotImplementedError
+
+    @property
+    def mass_resolution(self):
+        return None
+
+    def get_spectrum(self, iscan):
+        raise NotImplementedError
+
+    def get_spectra(self):
+        return ScanStore.from_spectra([self.get_spectrum(i) 
+                                       for i in range(1, self.nspectra + 1)])
+
+    def get_spectra_range(self, start, stop):
+        # scans start+1 to stop, i.e. a 0-based half-open range like a slice
+        stop = min(stop, self.nspectra)
+        return ScanStore.from_spectra([self.get_spectrum(i) 
+                                       for i in range(start + 1, stop + 1)])
+
+    def get_scans(self, indices):
+        # scans at 0-based indices, e.g. selected with HeaderTable.select
+        return ScanStore.from_spectra([self.get_spectrum(int(i) + 1) for i in indices])
+
+    def get_header(self, iscan):
+        raise NotImplementedError
+
+    def get_headers(self):
+        return HeaderTable.from_dicts(self.get_header(i) for i in range(1, self.nspectra + 1))
+
+    def get_average_spectrum(self):
+        raise NotImplementedError
+
+    def get_average_mass_list(self):
+        return self.get_average_spectrum()
+
+    def close(self):
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MSFileReaderBackend(SpectrumReader):
+    suffixes = ('.raw', )
+
+    def __init__(self, filename):
+        super(MSFileReaderBackend, self).__init__(filename)
+        from pymsfilereader import MSFileReader
+        self._ms_file = MSFileReader(self.filename.as_posix())
+
+    @property
+    def nspectra(self):
+        return self._ms_file.GetNumSpectra()
+
+    @property
+    def mass_resolution(self):
+        return self._ms_file.MassResolution
+
+    def get_spectrum(self, iscan):
+        return np.array(self._ms_file.GetMassListFromScanNum(iscan)[0]).T
+
+    def get_header(self, iscan):
+        return self._ms_file.GetScanHeaderInfoForScanNum(iscan)
+
+    def get_average_spectrum(self):
+        return np.array(self._ms_file.GetAveragedMassSpectrum(
+            list(range(1, self.nspectra + 1)))[0]).T
+
+    def get_average_mass_list(self):
+        return np.array(self._ms_file.GetAverageMassList(1, self.nspectra)[0]).T
+
+    def close(self):
+        self._ms_file.Close()
+
+
+class NpzReader(SpectrumReader):
+    suffixes = ('.npz', )
+
+    def __init__(self, filename):
+        super(NpzReader, self).__init__(filename)
+        # members are only decompressed when they are first used
+        self._archive = np.load(self.filename.as_posix(), allow_pickle=False)
+        encoding = None
+        if 'encoding' in self._archive.files:
+            encoding = json.loads(str(self._archive['encoding']))
+        self._arrays = _LazyArrays(self._archive, encoding)
+        for key in ['mz', 'intensity', 'offsets']:
+            if key not in self._archive.files:
+                self._archive.close()
+                raise Exception(f'{self.filename} is missing the "{key}" array.')
+        self._offsets = self._arrays['offsets'].astype(np.int64)
+        self._header_keys = [key for key in self._archive.files if key.startswith('header_')]
+
+    @property
+    def nspectra(self):
+        return len(self._offsets) - 1
+
+    @property
+    def mass_resolution(self):
+        if 'mass_resolution' in self._arrays:
+            return float(self._arrays['mass_resolution'])
+        return None
+
+    def get_spectrum(self, iscan):
+        start, stop = self._offsets[iscan - 1], self._offsets[iscan]
+        return np.array([self._arrays['mz'][start:stop],
+                         self._arrays['intensity'][start:stop]]).T
+
+    def get_spectra(self):
+        return ScanStore(self._arrays['mz'], self._arrays['intensity'], self._offsets)
+
+    def get_spectra_range(self, start, stop):
+        return self.get_spectra().slice(start, stop)
+
+    def get_scans(self, indices):
+        return take_scans(self.get_spectra(), indices)
+
+    def get_header(self, iscan):
+        header = {}
+        for key in self._header_keys:
+            header[key[len('header_'):]] = self._arrays[key][iscan - 1].item()
+        return header
+
+    def get_headers(self):
+        # straight from the columns of the archive
+        return HeaderTable.from_columns({key[len('header_'):]: self._arrays[key] 
+                                         for key in self._header_keys}, nscans=self.nspectra)
+
+    def get_average_spectrum(self):
+        if 'average' in self._arrays:
+            return np.array(self._arrays['average'])
+        mz, inverse = np.unique(self._arrays['mz'], return_inverse=True)
+        intensity = np.bincount(inverse, weights=self._arrays['intensity'])
+        return np.array([mz, intensity/max(self.nspectra, 1)]).T
+
+    def close(self):
+        self._archive.close()
+
+
+class _LazyArrays(dict):
+    # compressed columns (encoding) are decoded and scaled integer
+    # intensities dequantized when they are first used
+    def __init__(self, archive, encoding=None):
+        super(_LazyArrays, self).__init__()
+        self._archive = archive
+        self._encoding = encoding or {}
+
+    def __contains__(self, key):
+        return key in self._archive.files
+
+    def _read(self, key):
+        if key in self._encoding:
+            return decode_column(self._archive[key], self._encoding[key])
+        return self._archive[key]
+
+    def __missing__(self, key):
+        if key == 'intensity' and 'intensity_scale' in self._archive.files:
+            self[key] = dequantize(self._read(key), self['offsets'],
+                                   self._read('intensity_offset'), self._read('intensity_scale'))
+        else:
+            self[key] = self._read(key)
+        return self[key]
+
+
+def take_scans(store, indices):
+    # a view for a contiguous range of scans, a copy of the scans otherwise
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) > 0 and np.all(np.diff(indices) == 1):
+        return store.slice(indices[0], indices[-1] + 1)
+    return store.take(indices)
+
+
+def write_npz(filename, spectra, headers=None, average=None, mass_resolution=None,
+              precision=None, compression=None):
+    # headers is a HeaderTable or a list of dicts. precision sets the dtypes
+    # of the scans (see precision.StoragePrecision), compression ('zstd',
+    # 'zlib' or True for the best available) compresses the scans. Returns
+    # the error bounds of the stored scans
+    if not isinstance(spectra, ScanStore):
+        spectra = ScanStore.from_spectra(spectra)
+    arrays, error_bounds = StoragePrecision.create(precision).encode(spectra)
+    encoding = {}
+    if compression:
+        for key in list(arrays):
+            blob, encoding[key] = encode_column(arrays[key], None if compression is True else compression,
+                                                delta=key == 'mz')
+            arrays[key] = np.frombuffer(blob, dtype=np.uint8)
+        arrays['encoding'] = np.array(json.dumps(encoding))
+    if headers is not None and len(headers) > 0:
+        if not isinstance(headers, HeaderTable):
+            headers = HeaderTable.from_dicts(headers)
+        for key, values in headers.to_columns().items():
+            # numeric fields only, standard fields missing in the source are skipped
+            if values.dtype.kind in 'biuf' and not (values.dtype.kind == 'f' and np.isnan(values).all()):
+                arrays[f'header_{key}'] = values
+    if average is not None:
+        arrays['average'] = np.asarray(average)
+    if mass_resolution is not None:
+        arrays['mass_resolution'] = np.array(mass_resolution)
+    np.savez(Path(filename).as_posix(), **arrays)
+    return error_bounds
+
+
+READERS = {'msfilereader': MSFileReaderBackend,
+           'npz': NpzReader}
+
+
+def get_reader(reader=None, filename=None):
+    if reader is None:
+        suffix = Path(filename).suffix.lower() if filename is not None else ''
+        for backend in READERS.values():
+            if suffix in backend.suffixes:
+                return backend
+        return MSFileReaderBackend
+    if isinstance(reader, str):
+        if reader.lower() not in READERS:
+            raise Exception(f'Unknown reader {reader}, choose from {list(READERS)}.')
+        return READERS[reader.lower()]
+    return reader
+
+
+def reader_suffixes(reader=None):
+    if reader is None:
+        return MSFileReaderBackend.suffixes
+    return getattr(get_reader(reader), 'suffixes', MSFileReaderBackend.suffixes)
+
+
+def open_reader(filename, reader=None):
+    return get_reader(reader, filename)(filename)
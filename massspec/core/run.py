@@ -1,102 +1,135 @@
-from pymsfilereader import MSFileReader
 import numpy as np
 import matplotlib.pylab as plt
 from scipy.interpolate import interp1d
 import xlsxwriter
 from .raw_file import RawFile, RawFileCollection
+from .readers import reader_suffixes
+from .ingest import Ingestor
+from .blit import Waterfall
 from pathlib import Path
-import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import os
+import queue
 
 
 colors = ['red', 'blue', 'green', 'cyan', 'magenta']
 
 class LiveView():
-    def __init__(self, path='.', delay=1, interpolation='cubic', factor=2):
+    def __init__(self, path='.', delay=1, interpolation='cubic', factor=2, reader=None,
+                 settle_time=2.0, min_size=22*1024, n_jobs=1, state=True, window=20):
+        # a new file is loaded once its size did not change for settle_time
+        # seconds and it is at least min_size bytes, on n_jobs worker processes.
+        # With state=True a restarted session resumes from the files it 
+        # already loaded. The plot keeps the last window files
         self.path = Path(path)
+        self.reader = reader
         self.delay = delay
         self.interpolation=interpolation
         self.factor=factor
+        self.settle_time = settle_time
+        self.min_size = min_size
+        self.n_jobs = n_jobs
+        self.state = state
+        self.window = window
         self.observer = Observer()
-        self.delay = delay
   
     def run(self):
-        event_handler = Handler(self.path, self.interpolation, self.factor)
+        event_handler = Handler(self.path, self.interpolation, self.factor, self.reader,
+                                settle_time=self.settle_time, min_size=self.min_size, 
+                                n_jobs=self.n_jobs, state=self.state, window=self.window)
         self.observer.schedule(event_handler, self.path.as_posix(), recursive = True)
         self.observer.start()
         try:
             while True:
-                time.sleep(self.delay)
+                # loaded files are plotted here, watchdog's thread only
+                # queues events
+                event_handler.process_results()
+                # unlike plt.pause this does not draw the whole figure
+                event_handler.fig.canvas.start_event_loop(self.delay)
         except:
             self.observer.stop()
+            event_handler.ingestor.stop(wait=False)
             plt.show()
             print("Observer Stopped")
         self.observer.join()
 
 class Handler(FileSystemEventHandler, RawFileCollection):
-    def __init__(self, path, interpolation='cubic', factor=2):
-        super(Handler, self).__init__(path, interpolation='cubic', factor=2)
+    def __init__(self, path, interpolation='cubic', factor=2, reader=None,
+                 settle_time=2.0, min_size=22*1024, n_jobs=1, state=None, window=20):
+        super(Handler, self).__init__(path, interpolation=interpolation, factor=factor, reader=reader,
+                                      state=state)
+        self.ingestor = Ingestor(self._load_kwargs(), 
+                                 suffixes=reader_suffixes(reader),
+                                 settle_time=settle_time, 
+                                 min_size=min_size, 
+                                 n_jobs=n_jobs)
+        # files loaded by the collection are only loaded again if they change
+        for record in self.records.values():
+            self.ingestor.submitted[record.path] = record.signature
+        self.deleted = queue.Queue()
         
         self.count = 0
         self.ratio = False
+        self.dt = 1
         # plt.ion()
         self.init_plot()
+        self.waterfall = Waterfall(self.ax_spectra, window=window, dt=self.dt)
         self.plot_present_files()
         plt.show(block=False)
         # plt.show()
-        plt.draw()
-        plt.clf()
-
-        self.sizes = {}
-        self.dt = 1
+        self.waterfall.draw()
+        self.ingestor.start()
 
 
     def plot_present_files(self):
-        path = Path(self.path)
-        for i, ifile in enumerate(path.iterdir()):
-            if ifile.suffix == '.raw':
-                raw_file = RawFile(ifile, 
-                                interpolation=self.interpolation,
-                                factor=self.factor)
-                self.add_file(raw_file)
-                self.update(self.count)
-            # self.fig.canvas.draw()
-            # self.fig.canvas.flush_events()
-            # plt.pause(0.1)
+        # the files are already loaded by the collection
+        for record in self.records.values():
+            self.update(record)
             self.count += 1
 
+    def update(self, record):
+        # new spectra are blitted on the next waterfall.draw()
+        spectrum = record.data_avg
+        self.waterfall.add(spectrum[:, 0], spectrum[:, 1])
 
     def on_created(self, event):
-        path = Path(event.src_path)
-        self.sizes[path.name] = path.stat().st_size
+        self.ingestor.submit(event.src_path)
 
     def on_modified(self, event):
-        time.sleep(5)
-        path = Path(event.src_path)
-        print(f'incoming {path.name}')
-        if not path.name in self.sizes:
-            self.sizes[path.name] = path.stat().st_size
-        else:
-            if self.sizes[path.name] != path.stat().st_size:
-                self.sizes[path.name] = path.stat().st_size
-            else : 
-                if path.stat().st_size > 22*1024:
-                    print(f'detected file copying finished for {path.name}')
-                    if path.suffix == '.raw':
-                        raw_file = RawFile(path, 
-                                        interpolation=self.interpolation,
-                                        factor=self.factor)
-                        self.add_file(raw_file)
-                        self.update(self.count)
-                        self.fig.canvas.draw()
-                        self.fig.canvas.flush_events()
-                        # plt.pause(0.1)
-                        self.count += 1
+        # called on watchdog's thread, must never block
+        self.ingestor.submit(event.src_path)
+
+    def on_moved(self, event):
+        self.ingestor.submit(event.dest_path)
+
+    def process_results(self):
+        # adds and plots the files loaded since the last call, on the
+        # plotting thread
+        while True:
+            try:
+                self.remove_file(self.deleted.get_nowait())
+            except queue.Empty:
+                break
+        results = self.ingestor.results()
+        for path, raw_file, error in results:
+            if error is not None or raw_file.has_error:
+                print(f"Can not load {path.name}, skipping")
+                self.errors[path.name] = error or f"{path.name} could not be read"
+                continue
+            print(f'detected file copying finished for {path.name}')
+            self.add_file(raw_file)
+            if path.name in self.records:
+                self.update(self.records[path.name])
+            self.count += 1
+        if len(results) > 0:
+            self.waterfall.draw()
+        return len(results)
 
     def on_deleted(self, event):
         path = Path(event.src_path)
+        if path.suffix.lower() in reader_suffixes(self.reader):
+            self.deleted.put(path.name)
         if path.suffix == '.meth':
             print('done!')
         # plt.close(self.fig)
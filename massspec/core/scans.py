@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+class ScanStore(object):
+    """
+    Ragged collection of spectra kept in flat ``mz`` and ``intensity`` buffers.
+    Scan ``i`` spans ``offsets[i]:offsets[i+1]`` of both buffers.
+
+    ``store.scan(i)`` returns zero-copy views of one scan and ``store[i]``
+    returns the usual ``(n, 2)`` array, so a store can be used wherever a list
+    of spectra was used before.
+    """
+    def __init__(self, mz, intensity, offsets):
+        self.mz = np.asarray(mz)
+        self.intensity = np.asarray(intensity)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if self.mz.shape != self.intensity.shape:
+            raise Exception('m/z and intensity buffers must have the same shape.')
+        if (self.offsets.ndim != 1 or len(self.offsets) == 0 
+                or self.offsets[0] != 0 or self.offsets[-1] != len(self.mz)):
+            raise Exception('offsets do not match the size of the buffers.')
+
+    @classmethod
+    def from_spectra(cls, spectra):
+        spectra = [np.asarray(x).reshape(-1, 2) for x in spectra]
+        lengths = [x.shape[0] for x in spectra]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        if len(spectra) == 0:
+            return cls(np.zeros(0), np.zeros(0), offsets)
+        return cls(np.concatenate([x[:, 0] for x in spectra]),
+                   np.concatenate([x[:, 1] for x in spectra]),
+                   offsets)
+
+    @classmethod
+    def concatenate(cls, stores):
+        stores = list(stores)
+        if len(stores) == 0:
+            return cls(np.zeros(0), np.zeros(0), [0])
+        starts = np.cumsum([0] + [len(x.mz) for x in stores[:-1]])
+        offsets = np.concatenate([[0]] + [x.offsets[1:] + s for x, s in zip(stores, starts)])
+        return cls(np.concatenate([x.mz for x in stores]),
+                   np.concatenate([x.intensity for x in stores]),
+                   offsets)
+
+    @property
+    def nspectra(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def npoints(self):
+        return int(self.offsets[-1])
+
+    @property
+    def nbytes(self):
+        return self.mz.nbytes + self.intensity.nbytes + self.offsets.nbytes
+
+    @property
+    def scan_index(self):
+        # scan number of every point
+        return np.repeat(np.arange(self.nspectra), self.lengths)
+
+    def __len__(self):
+        return self.nspectra
+
+    def scan(self, i):
+        if i < 0:
+            i += self.nspectra
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.mz[start:stop], self.intensity[start:stop]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.nspectra)
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            return self.slice(start, stop)
+        mz, intensity = self.scan(key)
+        return np.array([mz, intensity]).T
+
+    def __iter__(self):
+        for i in range(self.nspectra):
+            yield self[i]
+
+    def slice(self, start, stop):
+        # zero copy: the new store holds views of the buffers
+        start = max(0, min(start, self.nspectra))
+        stop = max(start, min(stop, self.nspectra))
+        first, last = self.offsets[start], self.offsets[stop]
+        return ScanStore(self.mz[first:last], self.intensity[first:last],
+                         self.offsets[start:stop + 1] - first)
+
+    def copy(self):
+        return ScanStore(self.mz.copy(), self.intensity.copy(), self.offsets.copy())
+
+    def astype(self, mz=None, intensity=None):
+        # the store with other dtypes, itself when nothing changes
+        mz = self.mz if mz is None else self.mz.astype(mz, copy=False)
+        intensity = self.intensity if intensity is None else self.intensity.astype(intensity, copy=False)
+        if mz is self.mz and intensity is self.intensity:
+            return self
+        return ScanStore(mz, intensity, self.offsets)
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # index of every kept point in the flat buffers
+        points = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return ScanStore(self.mz[points], self.intensity[points], offsets)
+
+    def compress(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        counts = np.bincount(self.scan_index[mask], minlength=self.nspectra)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return ScanStore(self.mz[mask], self.intensity[mask], offsets)
+
+    def reduce(self, ufunc, values=None, empty=0):
+        # applies ufunc.reduceat per scan, empty scans get ``empty``
+        values = self.intensity if values is None else values
+        out = np.full(self.nspectra, empty, dtype=np.result_type(values, type(empty)))
+        nonempty = self.lengths > 0
+        if nonempty.any():
+            out[nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty])
+        return out
+
+    def sum(self):
+        return self.reduce(np.add)
+
+    def max(self):
+        return self.reduce(np.maximum, empty=np.nan)
+
+    def min(self):
+        return self.reduce(np.minimum, empty=np.nan)
+
+    def mz_range(self):
+        return (self.reduce(np.minimum, self.mz, empty=np.nan),
+                self.reduce(np.maximum, self.mz, empty=np.nan))
+
+    def argmax(self):
+        # flat index (relative to the scan start) of the most intense point
+        is_max = self.intensity == self.max()[self.scan_index]
+        position = np.where(is_max, np.arange(self.npoints), self.npoints)
+        ret = self.reduce(np.minimum, position, empty=-1)
+        nonempty = self.lengths > 0
+        ret[nonempty] -= self.offsets[:-1][nonempty]
+        return ret
+
+    def base_peaks(self):
+        index = self.argmax()
+        nonempty = index >= 0
+        ret = np.full((self.nspectra, 2), np.nan)
+        flat = self.offsets[:-1][nonempty] + index[nonempty]
+        ret[nonempty, 0] = self.mz[flat]
+        ret[nonempty, 1] = self.intensity[flat]
+        return ret
+
+    def to_list(self):
+        return [self[i] for i in range(self.nspectra)]
+
+    def __repr__(self):
+        return f"ScanStore(nspectra={self.nspectra}, npoints={self.npoints})"
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental state of a RawFileCollection.
+
+Every file of a collection is summarized by a ``FileRecord``: its size and
+modification time, number of scans, averaged spectrum and tracked areas.
+``CollectionState`` keeps one small ``.npz`` per record in a state directory,
+so saving or removing a file is independent of the size of the run and a
+restarted session only loads the files that are new or changed.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+from .cache import default_cache_dir
+
+
+class FileRecord(object):
+    def __init__(self, name, path, size, mtime_ns, nspectra, data_avg,
+                 track_area=None, total_area=None, raw_file=None):
+        self.name = name
+        self.path = Path(path)
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.nspectra = nspectra
+        self.data_avg = data_avg
+        self.track_area = track_area
+        self.total_area = total_area
+        self.raw_file = raw_file
+
+    @property
+    def signature(self):
+        # same as the signature of the SettleDetector
+        return self.size, self.mtime_ns
+
+    def matches(self, path=None):
+        # True if the file on disk is still the one summarized
+        try:
+            stat = os.stat(path or self.path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == self.signature
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class CollectionState(object):
+    """
+    State directory of a collection. ``settings`` (tracked masses, windows)
+    are stored with every record; records saved with other settings keep
+    their averages but their areas are computed again.
+    """
+    def __init__(self, directory, settings=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.settings = json.dumps(settings or {}, sort_keys=True)
+
+    @classmethod
+    def for_path(cls, path, settings=None):
+        # default state directory of a run directory, in the cache directory
+        path = Path(path).resolve()
+        key = hashlib.sha1(path.as_posix().encode('utf-8')).hexdigest()[:16]
+        return cls(default_cache_dir() / 'state' / f"{path.name}-{key}", settings)
+
+    def path_for(self, name):
+        return self.directory / f"{name}.npz"
+
+    def save(self, record: FileRecord):
+        arrays = dict(size=record.size,
+                      mtime_ns=record.mtime_ns,
+                      nspectra=record.nspectra,
+                      data_avg=np.asarray(record.data_avg, dtype=float),
+                      settings=self.settings)
+        if record.track_area is not None:
+            arrays['track_area'] = record.track_area
+            arrays['total_area'] = record.total_area
+        path = self.path_for(record.name)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as wf:
+            np.savez(wf, **arrays)
+        os.replace(tmp_path, path)
+
+    def remove(self, name):
+        try:
+            os.remove(self.path_for(name))
+        except OSError:
+            pass
+
+    def load(self, source_dir):
+        # records of the files of source_dir that did not change since they
+        # were saved, the others are dropped
+        records = {}
+        for path in self.directory.glob('*.npz'):
+            name = path.name[:-len('.npz')]
+            source = Path(source_dir) / name
+            try:
+                with np.load(path) as npz:
+                    record = FileRecord(name, source, int(npz['size']), int(npz['mtime_ns']),
+                                        int(npz['nspectra']), npz['data_avg'])
+                    if 'track_area' in npz.files and str(npz['settings']) == self.settings:
+                        record.track_area = npz['track_area'][()]
+                        record.total_area = float(npz['total_area'])
+            except Exception:
+                self.remove(name)
+                continue
+            if record.matches():
+                records[name] = record
+            else:
+                self.remove(name)
+        return records
+
+    def clear(self):
+        for path in self.directory.glob('*.npz'):
+            os.remove(path)
@@ -1,35 +1,15 @@
 # -*- coding: utf-8 -*-
-from itertools import count
-from matplotlib.animation import Animation, FuncAnimation
-from pymsfilereader import MSFileReader
+import asyncio
 import matplotlib.pylab as plt
-from mpl_toolkits.mplot3d import axes3d
 import numpy as np
-import os
-import time
 from pathlib import Path
-from .core.raw_file import RawFile
-import dash
-from dash import dcc, html
-import plotly
-import plotly.express as px
-from dash.dependencies import Input, Output
+from .core.readers import reader_suffixes
+from .core.ingest import AsyncIngestor
+from .core.blit import Waterfall
+from .core.ratio_map import GridLayout, RatioMap
 
 colors = ['red', 'blue', 'green', 'cyan', 'magenta']
 
-app = dash.Dash(__name__)
-app.layout = html.Div(
-        html.Div([
-            html.H4('Mass Spec'),
-            dcc.Graph(id='live-update-graph'),
-            dcc.Interval(
-                id='interval-component',
-                interval=5*1000, # in milliseconds
-                n_intervals=0
-            )
-        ])
-)
-
 class LiveView(object):
     def __init__(self, path=".", 
                 #  only_new=True, 
@@ -40,76 +20,99 @@ class LiveView(object):
                  mass_2=None, 
                  spectrum_number=None, 
                  nrow=4,
-                 ncol=4):
+                 ncol=4,
+                 reader=None,
+                 window=20,
+                 layout='row',
+                 delta_mz=0.5,
+                 plate_map=None,
+                 settle_time=2.0,
+                 min_size=22*1024,
+                 n_jobs=1):
+        # the waterfall keeps the last window spectra (a row of drops with
+        # ratio=True) and only draws what is new, see core.blit.Waterfall.
+        # Drops fill the grid in the order of layout ('row', 'column',
+        # 'serpentine' or 'serpentine_column'), or at the wells of plate_map.
+        # mass_1 and mass_2 can be lists of masses, one drop map per pair.
+        # New files are loaded by an AsyncIngestor once their size did not
+        # change for settle_time seconds, on n_jobs worker processes
 
         # plt.ion()
 
         self.path = Path(path)
+        self.reader = reader
         self.files = []
         self.ratio = ratio
         if self.ratio:
-            self.ratios = np.zeros(shape=(nrow, ncol))
-            self.ratios[:, :] = None
+            self.ratio_map = RatioMap(np.column_stack([np.atleast_1d(mass_1), np.atleast_1d(mass_2)]),
+                                      GridLayout(nrow, ncol, order=layout, wells=plate_map),
+                                      delta_mz=delta_mz, scan=spectrum_number)
+            # updated in place as the drops arrive
+            self.ratios = self.ratio_map.image(0)
             self.nrow = nrow
             self.ncol = ncol
             self.mass_1 = mass_1
             self.mass_2 = mass_2
         self.dt = 0.5
         self.delay = delay
-        # if only_new:
-        #     self.analyzed = os.listdir(self.path.as_posix())
-        # else:
-        #     self.analyzed = []
+        self.ingestor = AsyncIngestor(self.path, dict(reader=reader),
+                                      suffixes=reader_suffixes(reader),
+                                      settle_time=settle_time,
+                                      min_size=min_size,
+                                      n_jobs=n_jobs,
+                                      poll_interval=min(delay, 1.0))
         self.analyzed = []
         self.count = 0
         self.spectrum_number = spectrum_number
+        self.window = ncol if ratio else window
         # self.init_plot()
-        # self.animation = Animation(self.fig, self.run, blit=True)
-        # if run:
-        # self.run()
-        app.run_server()
-
         
     def run(self):
-        while True:
-            try:
-                time.sleep(self.delay)
-                to_analyze = self.check()
-                if len(to_analyze) != 0:
+        self.init_plot()
+        try:
+            asyncio.run(self.watch())
+        except KeyboardInterrupt:
+            print("Stopping now")
+
+    async def watch(self):
+        # consumes the files loaded by the ingest service while the GUI
+        # events are handled on the same event loop
+        events = asyncio.get_running_loop().create_task(self.handle_events())
+        try:
+            async with self.ingestor:
+                async for result in self.ingestor:
+                    to_analyze = self.check([result] + self.ingestor.results())
                     for ifile in to_analyze:
                         if ifile != "error":
                             self.update(self.count)
                             self.analyzed.append(ifile)
-                        self.count += 1                
-            except KeyboardInterrupt:
-                print("Stopping now")
-                break
+                        self.count += 1
+                    self.waterfall.draw()
+        finally:
+            events.cancel()
 
+    async def handle_events(self):
+        while True:
+            # handles the GUI events without drawing the figure again
+            self.fig.canvas.flush_events()
+            await asyncio.sleep(0.05)
 
-    def check(self):
-        dirs = os.listdir(self.path.as_posix())
-        new_files = np.setdiff1d(dirs, self.analyzed)
+    def check(self, results):
+        # adds the (path, raw_file, error) loaded by the ingest service
         to_analyze = []
-        for ifile in new_files:
-            if len(ifile.split(".")) > 1:
-                if ifile.split(".")[1] == "raw":
-                    raw_file = RawFile(self.path.joinpath(ifile).as_posix())
-                    print(f"Analyzing {ifile}")
-                    if not raw_file.has_error:
-                        to_analyze.append(ifile)
-                        self.files.append(raw_file)
-                        nfiles = len(self.files)
-                        if self.ratio:
-                            irow = (nfiles-1)//self.ncol
-                            icol = (nfiles-1)%self.ncol
-                            self.ratios[irow, icol] = raw_file.get_ratio(self.mass_1, 
-                                                                        self.mass_2, 
-                                                                        self.spectrum_number)
-                    else:
-                        print(f"file {ifile} has an error, skipping")
-                        self.analyzed.append(ifile)
-                        self.files.append(raw_file)
-                        to_analyze.append("error")
+        for path, raw_file, error in results:
+            ifile = path.name
+            print(f"Analyzing {ifile}")
+            if error is None and not raw_file.has_error:
+                to_analyze.append(ifile)
+                self.files.append(raw_file)
+                if self.ratio:
+                    self.ratio_map.add(raw_file, index=len(self.files) - 1)
+            else:
+                print(f"file {ifile} has an error, skipping")
+                self.analyzed.append(ifile)
+                self.files.append(raw_file)
+                to_analyze.append("error")
         return to_analyze
 
 
@@ -128,34 +131,20 @@ class LiveView(object):
         self.ax_spectra.set_xlabel("m/z", fontsize=18)
         self.ax_spectra.set_ylabel("Spectra Number", fontsize=18)
         self.ax_spectra.set_zlabel("Intensity", fontsize=18)
+        self.waterfall = Waterfall(self.ax_spectra, window=self.window, dt=self.dt, 
+                                   colors=['black'])
+        if self.ratio:
+            self.drops = self.ax_drops.imshow(self.ratios, cmap='Greys')
+            self.waterfall.blit.add(self.drops)
         plt.show(block=False)
         plt.draw()
 
     def update(self, i):
+        # only adds artists, the next waterfall.draw() blits them
         if self.ratio:
-            self.ax_drops.imshow(self.ratios,cmap='Greys')
-            if (len(self.files)-1)%self.ncol == 0 :
-                self.ax_spectra.cla()
-        x = self.files[i].data_avg[:, 0]
-        y = [self.files[i].dt + self.count * self.dt] * len(x)
-        z = self.files[i].data_avg[:, 1]
-        self.ax_spectra.plot(x, y, z, color='black')
-        self.fig.canvas.draw()
-        self.fig.canvas.flush_events()
-        # plt.close(self.fig)
-
-    @app.callback(Output('live-update-graph', 'figure'),
-                Input('interval-component', 'n_intervals'))
-    def update_graph_live(n, self):
-        to_analyze = self.check()
-        if len(to_analyze) != 0:
-            for _, ifile in enumerate(to_analyze):
-                if ifile != "error":
-                    x = self.files[self.count].data_avg[:, 0]
-                    y = [self.files[self.count].dt + self.count * self.dt]*len(x)
-                    z = self.files[self.count].data_avg[:, 1]
-                    df = {'m/z':x, 'time':y ,"Intensity":z}
-                    self.analyzed.append(ifile)
-                self.count += 1
-        fig = px.line_3d(df, x="m/z", y="time", z="Intensity")
-        return fig
+            self.drops.set_data(self.ratios)
+            self.drops.autoscale()
+            self.waterfall.blit.touch(self.drops)
+        if self.files[i].has_error:
+            return
+        self.waterfall.add(self.files[i].data_avg[:, 0], self.files[i].data_avg[:, 1])
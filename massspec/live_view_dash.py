@@ -1,168 +1,201 @@
 # -*- coding: utf-8 -*-
-from itertools import count
-from matplotlib.animation import Animation, FuncAnimation
-from pymsfilereader import MSFileReader
-import matplotlib.pylab as plt
-from mpl_toolkits.mplot3d import axes3d
+import asyncio
+import threading
 import numpy as np
-import os
-import time
 from pathlib import Path
-from .core.raw_file import RawFile
+from .core.raw_file import RawFileCollection
+from .core.readers import reader_suffixes
+from .core.ingest import AsyncIngestor
+from .core.decimate import minmax_decimate
 import dash
-from dash import dcc, html
-import plotly
-import plotly.express as px
-from dash.dependencies import Input, Output
+from dash import dcc, html, Patch
+from dash.dependencies import Input, Output, State
 
 colors = ['red', 'blue', 'green', 'cyan', 'magenta']
 
-app = dash.Dash(__name__)
-app.layout = html.Div(
-        html.Div([
-            html.H4('Mass Spec'),
-            dcc.Graph(id='live-update-graph'),
-            dcc.Interval(
-                id='interval-component',
-                interval=5*1000, # in milliseconds
-                n_intervals=0
-            )
-        ])
-)
-
-
-
-
-
-@app.callback(Output('live-update-graph', 'figure'),
-            Input('interval-component', 'n_intervals'))
-def update_graph_live(n):
-    to_analyze = check()
-    if len(to_analyze) != 0:
-        for _, ifile in enumerate(to_analyze):
-            if ifile != "error":
-                x = files[count].data_avg[:, 0]
-                y = [files[count].dt + count * dt]*len(x)
-                z = files[count].data_avg[:, 1]
-                df = {'m/z':x, 'time':y ,"Intensity":z}
-                self.analyzed.append(ifile)
-            self.count += 1                       
-    fig = px.line_3d(df, x="m/z", y="time", z="Intensity")
-    return fig
-
-
 
 class LiveView(object):
-    def __init__(self, path=".", 
-                #  only_new=True, 
-                 delay=20, 
-                #  run=True, 
-                 ratio=False,
-                 mass_1=None, 
-                 mass_2=None, 
-                 spectrum_number=None, 
-                 nrow=4,
-                 ncol=4):
-
-        # plt.ion()
-
+    """
+    Dash live view of a run directory.
+
+    The run is kept on the server in a RawFileCollection. Every change (a new
+    or a replaced file) gets a revision number; each browser keeps the last
+    revision it has drawn in a ``dcc.Store`` and every tick only the traces
+    of the newer revisions are sent, as a partial (Patch) update of the
+    figures. Spectra are decimated to the min/max of ``points`` m/z bins.
+    New files are loaded by an AsyncIngestor running on its own event loop
+    in a background thread.
+    """
+    def __init__(self, path=".",
+                 delay=5,
+                 interpolation=None,
+                 factor=2,
+                 track_mass=None,
+                 delta_mz=3,
+                 dmz=0.2,
+                 reader=None,
+                 points=2000,
+                 settle_time=2.0,
+                 min_size=22*1024,
+                 n_jobs=1,
+                 state=None):
         self.path = Path(path)
-        self.files = []
-        self.ratio = ratio
-        if self.ratio:
-            self.ratios = np.zeros(shape=(nrow, ncol))
-            self.ratios[:, :] = None
-            self.nrow = nrow
-            self.ncol = ncol
-            self.mass_1 = mass_1
-            self.mass_2 = mass_2
-        self.dt = 0.5
+        self.reader = reader
         self.delay = delay
-        # if only_new:
-        #     self.analyzed = os.listdir(self.path.as_posix())
-        # else:
-        #     self.analyzed = []
-        self.analyzed = []
-        self.count = 0
-        self.spectrum_number = spectrum_number
-        # self.init_plot()
-        # self.animation = Animation(self.fig, self.run, blit=True)
-        # if run:
-        # self.run()
-        self.
-
-        
-    def run(self):
-        while True:
-            try:
-                time.sleep(self.delay)
-                to_analyze = self.check()
-                if len(to_analyze) != 0:
-                    for ifile in to_analyze:
-                        if ifile != "error":
-                            self.update(self.count)
-                            self.analyzed.append(ifile)
-                        self.count += 1                
-            except KeyboardInterrupt:
-                print("Stopping now")
-                break
-
-
-    def check(self):
-        dirs = os.listdir(self.path.as_posix())
-        new_files = np.setdiff1d(dirs, self.analyzed)
-        to_analyze = []
-        for ifile in new_files:
-            if len(ifile.split(".")) > 1:
-                if ifile.split(".")[1] == "raw":
-                    raw_file = RawFile(self.path.joinpath(ifile).as_posix())
-                    print(f"Analyzing {ifile}")
-                    if not raw_file.has_error:
-                        to_analyze.append(ifile)
-                        self.files.append(raw_file)
-                        nfiles = len(self.files)
-                        if self.ratio:
-                            irow = (nfiles-1)//self.ncol
-                            icol = (nfiles-1)%self.ncol
-                            self.ratios[irow, icol] = raw_file.get_ratio(self.mass_1, 
-                                                                        self.mass_2, 
-                                                                        self.spectrum_number)
-                    else:
-                        print(f"file {ifile} has an error, skipping")
-                        self.analyzed.append(ifile)
-                        self.files.append(raw_file)
-                        to_analyze.append("error")
-        return to_analyze
-
-
-    def init_plot(self):
-        plt.ion()
-        self.fig = plt.figure(figsize=(16, 9))
-        if self.ratio:
-            self.ax_spectra = self.fig.add_subplot(121, projection="3d")
-            self.ax_drops = self.fig.add_subplot(122)   
-            self.ax_drops.set_xlim(-0.5, self.ncol-0.5)
-            self.ax_drops.set_ylim(-0.5, self.nrow-0.5)
-            self.ax_drops.set_facecolor('red')
-        else:
-            self.ax_spectra = self.fig.add_subplot(111, projection="3d")
-        self.ax_spectra.view_init(elev=10, azim=60)
-        self.ax_spectra.set_xlabel("m/z", fontsize=18)
-        self.ax_spectra.set_ylabel("Spectra Number", fontsize=18)
-        self.ax_spectra.set_zlabel("Intensity", fontsize=18)
-        plt.show(block=False)
-        plt.draw()
-
-    def update(self, i):
-        if self.ratio:
-            self.ax_drops.imshow(self.ratios,cmap='Greys')
-            if (len(self.files)-1)%self.ncol == 0 :
-                self.ax_spectra.cla()
-        x = self.files[i].data_avg[:, 0]
-        y = [self.files[i].dt + self.count * self.dt] * len(x)
-        z = self.files[i].data_avg[:, 1]
-        self.ax_spectra.plot(x, y, z, color='black')
-        self.fig.canvas.draw()
-        self.fig.canvas.flush_events()
-        # plt.close(self.fig)
-
+        self.points = points
+        self.dt = 1
+        self.collection = RawFileCollection(path, interpolation=interpolation, factor=factor,
+                                            track_mass=track_mass, delta_mz=delta_mz, dmz=dmz,
+                                            reader=reader, state=state)
+        self.ingestor = AsyncIngestor(self.path, self.collection._load_kwargs(),
+                                      suffixes=reader_suffixes(reader),
+                                      settle_time=settle_time,
+                                      min_size=min_size,
+                                      n_jobs=n_jobs,
+                                      poll_interval=min(delay, 1.0))
+        # files loaded by the collection are only loaded again if they change
+        for record in self.collection.records.values():
+            self.ingestor.poller.seed(record.path.name, *record.signature)
+        # changes[i] is the file name changed by revision i + 1
+        self.changes = list(self.collection.files)
+        # distinct[r] is the number of different files of the first r revisions
+        self.distinct = list(range(len(self.changes) + 1))
+        self._seen = set(self.changes)
+        self._traces = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.app = self.create_app()
+
+    @property
+    def revision(self):
+        return len(self.changes)
+
+    def start(self):
+        # starts the ingest service once, files are then added as they load
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=asyncio.run, args=(self.watch(), ),
+                                                name='massspec-dash-ingest', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self.ingestor.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def watch(self):
+        async with self.ingestor:
+            async for path, raw_file, error in self.ingestor:
+                self.add(path, raw_file, error)
+
+    def add(self, path, raw_file, error=None):
+        with self._lock:
+            if error is not None or raw_file.has_error:
+                print(f"Can not load {path.name}, skipping")
+                self.collection.errors[path.name] = error or f"{path.name} could not be read"
+                return
+            self.collection.add_file(raw_file)
+            self._traces.pop(path.name, None)
+            self.changes.append(path.name)
+            self.distinct.append(self.distinct[-1] + (path.name not in self._seen))
+            self._seen.add(path.name)
+
+    def poll(self):
+        # the files are added by the ingest service, this only makes sure
+        # that it runs
+        self.start()
+        return self.revision
+
+    def trace(self, name):
+        # decimated 3D line of the averaged spectrum of one file, cached
+        if name not in self._traces:
+            i = self.collection.files.index(name)
+            x, z = minmax_decimate(self.collection.records[name].data_avg[:, 0],
+                                   self.collection.records[name].data_avg[:, 1], self.points)
+            self._traces[name] = dict(type='scatter3d', mode='lines', name=name,
+                                      x=x.tolist(), y=[i*self.dt]*len(x), z=z.tolist(),
+                                      line=dict(color=colors[i % 5], width=2))
+        return self._traces[name]
+
+    def track_traces(self):
+        masses = self.collection.track_masses
+        names = [f'Integrated {mass-self.collection.delta_mz}-{mass+self.collection.delta_mz}'
+                 for mass in masses] + ['Total Count']
+        return [dict(type='scatter', mode='lines+markers', name=name, x=[], y=[]) for name in names]
+
+    def figure(self):
+        return dict(data=[], layout=dict(uirevision='live', height=700,
+                                         scene=dict(xaxis=dict(title='m/z'),
+                                                    yaxis=dict(title='Spectra Number'),
+                                                    zaxis=dict(title='Intensity'))))
+
+    def track_figure(self):
+        return dict(data=self.track_traces(),
+                    layout=dict(uirevision='live', xaxis=dict(title='Scan number'),
+                                yaxis=dict(title='Count')))
+
+    def create_app(self):
+        app = dash.Dash(__name__)
+        graphs = [dcc.Graph(id='live-update-graph', figure=self.figure())]
+        if self.collection.track_mass is not None:
+            graphs.append(dcc.Graph(id='track-graph', figure=self.track_figure()))
+        app.layout = html.Div([html.H4('Mass Spec'),
+                               *graphs,
+                               dcc.Store(id='revision', data=0),
+                               dcc.Interval(id='interval-component',
+                                            interval=self.delay*1000,
+                                            n_intervals=0)])
+        outputs = [Output('live-update-graph', 'figure'), Output('revision', 'data')]
+        if self.collection.track_mass is not None:
+            outputs.append(Output('track-graph', 'figure'))
+
+        @app.callback(*outputs,
+                      Input('interval-component', 'n_intervals'),
+                      State('revision', 'data'))
+        def update_graph_live(n, revision):
+            return self.update(revision or 0)
+
+        return app
+
+    def update(self, revision):
+        # partial updates of the figures for a browser that drew revision:
+        # traces of new files are appended, those of replaced files are
+        # overwritten, nothing is sent when nothing changed
+        self.poll()
+        with self._lock:
+            latest = self.revision
+            if latest == revision:
+                return (dash.no_update,)*(3 if self.collection.track_mass is not None else 2)
+            files = self.collection.files
+            position = {name: i for i, name in enumerate(files)}
+            drawn = self.distinct[min(revision, latest)]
+            changed = sorted(set(position[name] for name in self.changes[revision:] if name in position))
+            figure = Patch()
+            for i in changed:
+                if i < drawn:
+                    figure['data'][i] = self.trace(files[i])
+                else:
+                    figure['data'].append(self.trace(files[i]))
+            ret = [figure, latest]
+            if self.collection.track_mass is not None:
+                track = Patch()
+                areas = np.array(self.collection.track_area).reshape(len(files), -1)
+                columns = np.column_stack([areas, self.collection.total_area])
+                for k in range(columns.shape[1]):
+                    for i in changed:
+                        if i < drawn:
+                            track['data'][k]['y'][i] = float(columns[i, k])
+                        else:
+                            track['data'][k]['x'].append(i + 1)
+                            track['data'][k]['y'].append(float(columns[i, k]))
+                ret.append(track)
+        return tuple(ret)
+
+    def run(self, **kwargs):
+        self.start()
+        try:
+            self.app.run(**kwargs)
+        finally:
+            self.stop()
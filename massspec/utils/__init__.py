@@ -1 +1,5 @@
-from . import export_to_excel
\ No newline at end of file
+from . import export_to_excel
+from . import export_to_parquet
+from . import export_to_hdf5
+from . import synthetic
+from . import benchmark
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths on synthetic runs (see ``synthetic.py``).
+
+Every stage is timed ``repeat`` times and reported with the best and the
+median wall time, the throughput in points and in bytes of the source files
+per second, and the peak memory allocated while it runs. Memory is measured
+with ``tracemalloc`` in a separate run, so tracing does not slow down the
+timed runs. A report saved as JSON can be passed as ``baseline`` to a later
+run to flag the stages that got slower.
+"""
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+from .synthetic import write_synthetic_directory
+
+
+class Benchmark(object):
+    def __init__(self, repeat=3, memory=True):
+        self.repeat = repeat
+        self.memory = memory
+        self.results = []
+
+    def measure(self, name, function, setup=None, npoints=None, nbytes=None):
+        # function(setup()) is timed, setup builds a fresh input every time
+        # and is not timed
+        times = []
+        for _ in range(self.repeat):
+            arg = setup() if setup is not None else None
+            start = time.perf_counter()
+            function(arg) if setup is not None else function()
+            times.append(time.perf_counter() - start)
+        result = dict(name=name,
+                      best=min(times),
+                      median=float(np.median(times)),
+                      repeat=self.repeat)
+        if npoints is not None:
+            result['points_per_second'] = npoints/result['best']
+        if nbytes is not None:
+            result['bytes_per_second'] = nbytes/result['best']
+        if self.memory:
+            arg = setup() if setup is not None else None
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            function(arg) if setup is not None else function()
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.results.append(result)
+        print(format_result(result))
+        return result
+
+    def skip(self, name, reason):
+        self.results.append(dict(name=name, skipped=reason))
+        print(f"{name:<32} skipped: {reason}")
+
+    def report(self, **parameters):
+        return dict(parameters=parameters, results=self.results)
+
+
+def format_result(result):
+    text = f"{result['name']:<32} {result['best']*1e3:10.1f} ms {result['median']*1e3:10.1f} ms"
+    if 'points_per_second' in result:
+        text += f" {result['points_per_second']/1e6:8.2f} Mpt/s"
+    if 'bytes_per_second' in result:
+        text += f" {result['bytes_per_second']/2**20:8.1f} MB/s"
+    if 'peak_memory' in result:
+        text += f" {result['peak_memory']/2**20:8.1f} MB"
+    return text
+
+
+def compare(report, baseline, tolerance=1.25):
+    # stages at least tolerance times slower than in the baseline report
+    before = {x['name']: x for x in baseline['results'] if 'best' in x}
+    slower = []
+    for result in report['results']:
+        if result['name'] in before and 'best' in result:
+            ratio = result['best']/before[result['name']]['best']
+            if ratio >= tolerance:
+                slower.append(dict(name=result['name'], ratio=ratio))
+    return slower
+
+
+def run_benchmarks(directory=None,
+                   nfiles=8,
+                   nscans=200,
+                   npoints=2000,
+                   peak_density=2,
+                   noise=20,
+                   repeat=3,
+                   memory=True,
+                   exporters=True,
+                   baseline=None,
+                   output=None):
+    """
+    Benchmarks RawFile construction, interpolation, peak reduction,
+    RawFileCollection parsing and add_file, and the exporters, on nfiles
+    synthetic runs written in directory (a temporary directory by default).
+    Returns the report, saved as JSON to output if given.
+    """
+    from ..core.raw_file import RawFile, RawFileCollection
+    temporary = directory is None
+    directory = Path(tempfile.mkdtemp(prefix='massspec-benchmark-') if temporary else directory)
+    try:
+        paths = write_synthetic_directory(directory / 'run', nfiles=nfiles, nscans=nscans,
+                                          npoints=npoints, peak_density=peak_density, noise=noise)
+        first = paths[0]
+        size = first.stat().st_size
+        points = RawFile(first, reader='npz').data.npoints
+        bench = Benchmark(repeat=repeat, memory=memory)
+        bench.measure('RawFile', lambda: RawFile(first, reader='npz'),
+                      npoints=points, nbytes=size)
+        bench.measure('RawFile lazy', lambda: RawFile(first, reader='npz', lazy=True),
+                      nbytes=size)
+        bench.measure('_get_interpolated', lambda raw_file: raw_file._get_interpolated('cubic', 2),
+                      setup=lambda: RawFile(first, reader='npz'), npoints=points)
+        bench.measure('reduce', lambda raw_file: raw_file.reduce(500),
+                      setup=lambda: RawFile(first, reader='npz'), npoints=points)
+        total_size = sum(x.stat().st_size for x in paths)
+        bench.measure('RawFileCollection.parse',
+                      lambda: RawFileCollection(directory / 'run', interpolation=None,
+                                                track_mass=500, reader='npz'),
+                      npoints=points*nfiles, nbytes=total_size)
+        collection = RawFileCollection(directory / 'run', interpolation=None, track_mass=500,
+                                       reader='npz')
+        bench.measure('RawFileCollection.add_file', collection.add_file,
+                      setup=lambda: RawFile(paths[-1], reader='npz'), npoints=points)
+        if exporters:
+            out = directory / 'out'
+            out.mkdir(exist_ok=True)
+            raw_file = RawFile(first, reader='npz')
+            calls = [('to_excel', lambda: raw_file.to_excel(out / 'bench.xlsx', overwrite=True)),
+                     ('to_excel streaming', lambda: raw_file.to_excel(out / 'bench.xlsx', overwrite=True,
+                                                                      streaming=True)),
+                     ('to_parquet', lambda: raw_file.to_parquet(out / 'bench.parquet')),
+                     ('to_hdf5', lambda: (out / 'bench.h5').unlink(missing_ok=True) or
+                      raw_file.to_hdf5(out / 'bench.h5')),
+                     ('to_matlab', lambda: raw_file.to_matlab(out / 'bench.mat')),
+                     ('to_npz', lambda: raw_file.to_npz(out / 'bench.npz'))]
+            for name, call in calls:
+                try:
+                    bench.measure(name, call, npoints=points)
+                except ImportError as error:
+                    bench.skip(name, str(error))
+    finally:
+        if temporary:
+            shutil.rmtree(directory, ignore_errors=True)
+    report = bench.report(nfiles=nfiles, nscans=nscans, npoints=npoints,
+                          peak_density=peak_density, noise=noise, repeat=repeat)
+    if baseline is not None:
+        with open(baseline) as rf:
+            report['slower'] = compare(report, json.load(rf))
+        for x in report['slower']:
+            print(f"{x['name']} is {x['ratio']:.2f} times slower than the baseline")
+    if output is not None:
+        with open(output, 'w') as wf:
+            json.dump(report, wf, indent=2)
+    return report
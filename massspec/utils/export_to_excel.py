@@ -1,4 +1,3 @@
-from pymsfilereader import MSFileReader
 import pandas as pd
 import xlsxwriter
 import numpy as np
@@ -7,42 +6,193 @@ import time
 from pathlib import Path
 # from string import ascii_uppercase
 from ..core.raw_file import RawFile
+from ..core.readers import reader_suffixes
+from ..core.scans import ScanStore
+from ..core.binning import bin_spectra
+
+EXCEL_MAX_ROWS = 1048576
+EXCEL_MAX_COLS = 16384
 
 
 def dir_to_excel(input_path, 
              output_path="data.xlsx", 
-             average=True):
+             average=True,
+             reader=None,
+             bin_width=None,
+             ppm=None):
+    # spectra of different lengths, or any spectra when bin_width or ppm is
+    # given, are binned on a common m/z axis before they are written
     input_path = Path(input_path)
     data = []
     file_names = []
     dirs = os.listdir(input_path.as_posix())
     for ifile in dirs:
         if len(ifile.split(".")) > 1:
-            if ifile.split(".")[1].lower() == "raw":
-                raw_file = RawFile(input_path.joinpath(ifile).as_posix())
+            if "." + ifile.split(".")[1].lower() in reader_suffixes(reader):
+                raw_file = RawFile(input_path.joinpath(ifile).as_posix(), reader=reader, lazy=average)
                 print("Analyzing {}".format(ifile))
                 if not raw_file.has_error:
                     if average:
-                        data.append(raw_file.average_spectrum)
+                        data.append([raw_file.average_spectrum])
                     else:
-                        data.append(raw_file.data)
+                        data.append(raw_file.data.to_list())
                     file_names.append(ifile)
                 else :
                     print("file {} has an error, skipping".format(ifile))
-    data = np.array(data)
-    if len(data.shape)==3:
-        nfiles = data.shape[0]
-        nmass = data.shape[1]
-        data = data.reshape(nfiles, 1, nmass, -1)
+    nspectrum = min(len(x) for x in data)
+    spectra = [spectrum for x in data for spectrum in x[:nspectrum]]
+    if bin_width is None and ppm is None and len(set(x.shape[0] for x in spectra)) == 1:
+        mass = spectra[0][:, 0]
+        intensity = np.array([x[:, 1] for x in spectra])
+    else:
+        matrix = bin_spectra(ScanStore.from_spectra(spectra), width=bin_width, ppm=ppm, sparse=False)
+        mass = matrix.mz
+        intensity = matrix.values
+    intensity = intensity.reshape(len(file_names), nspectrum, -1)
     with xlsxwriter.Workbook(output_path) as workbook:
-        nspectrum = data.shape[1]
         for i in range(nspectrum):
             sheet_name = f"spectrum {i+1}"
             worksheet = workbook.add_worksheet(sheet_name)
             worksheet.write(0, 0, "Mass")
-            worksheet.write_column(1, 0, data[0, i, :, 0])
+            worksheet.write_column(1, 0, mass)
             for ifile, fname in enumerate(file_names):
-                worksheet.write(0, ifile+1, fname.replace(".raw",""))
-                worksheet.write_column(1, ifile+1, data[ifile, i, :, 1])
-            
-            
+                worksheet.write(0, ifile+1, Path(fname).stem)
+                worksheet.write_column(1, ifile+1, intensity[ifile, i])
+
+
+def sheet_names(workbook, base):
+    # Excel sheet names are unique, at most 31 characters and can not 
+    # contain []:*?/\
+    base = "".join("_" if c in "[]:*?/\\" else c for c in base)
+    names = [x.name for x in workbook.worksheets()]
+    i = 1
+    while True:
+        suffix = "" if i == 1 else f" ({i})"
+        name = base[:31 - len(suffix)] + suffix
+        if name not in names:
+            yield name
+            names.append(name)
+        i += 1
+
+
+def write_spectra(workbook,
+                  sheet_name,
+                  nspectra,
+                  fetch,
+                  headers,
+                  num_format=None,
+                  spectra_per_sheet=EXCEL_MAX_COLS//2,
+                  rows_per_chunk=1024):
+    """
+    Writes spectra as (m/z, intensity) column pairs, row by row, so that it
+    works with xlsxwriter's constant_memory mode. ``fetch(start, stop)``
+    returns the spectra start:stop as a ScanStore and ``headers(start, stop)``
+    the header rows written above them (lists of cells, None is skipped).
+    A sheet holds at most ``spectra_per_sheet`` spectra and Excel's row
+    limit; the rest spills over to new sheets. Only one group of spectra is
+    fetched at a time and only ``rows_per_chunk`` rows are gathered at once.
+    """
+    names = sheet_names(workbook, sheet_name)
+    spectra_per_sheet = max(1, min(spectra_per_sheet, EXCEL_MAX_COLS//2))
+    for first in range(0, max(nspectra, 1), spectra_per_sheet):
+        last = min(first + spectra_per_sheet, nspectra)
+        group = fetch(first, last)
+        header_rows = headers(first, last)
+        rows_per_sheet = EXCEL_MAX_ROWS - len(header_rows)
+        lengths = group.lengths
+        nrows = int(lengths.max()) if len(lengths) > 0 else 0
+        for row_start in range(0, max(nrows, 1), rows_per_sheet):
+            worksheet = workbook.add_worksheet(next(names))
+            for irow, row in enumerate(header_rows):
+                for icol, cell in enumerate(row):
+                    if cell is not None:
+                        worksheet.write(irow, icol, cell, num_format)
+            row_stop = min(row_start + rows_per_sheet, nrows)
+            for chunk_start in range(row_start, row_stop, rows_per_chunk):
+                chunk_stop = min(chunk_start + rows_per_chunk, row_stop)
+                rows = np.arange(chunk_start, chunk_stop)
+                valid = rows[:, None] < lengths[None, :]
+                index = np.where(valid, group.offsets[:-1][None, :] + rows[:, None], 0)
+                mz = np.asarray(group.mz[index.ravel()]).reshape(index.shape)
+                intensity = np.asarray(group.intensity[index.ravel()]).reshape(index.shape)
+                for irow, row in enumerate(rows):
+                    excel_row = len(header_rows) + row - row_start
+                    for icol in np.nonzero(valid[irow])[0]:
+                        worksheet.write_number(excel_row, 2*icol, mz[irow, icol], num_format)
+                        worksheet.write_number(excel_row, 2*icol + 1, intensity[irow, icol], num_format)
+    return
+
+
+def _scan_headers(start_times):
+    def headers(start, stop):
+        return [[x for i in range(start, stop) 
+                 for x in (f"Spectrum {i + 1} m/z", f"Spectrum {i + 1} Intensity")],
+                [x for i in range(start, stop) for x in (start_times[i], None)]]
+    return headers
+
+
+def _write_scans(workbook, sheet_name, raw_file, num_format, spectra_per_sheet, rows_per_chunk):
+    headers = _scan_headers(raw_file.start_times)
+    if raw_file.is_loaded or raw_file.has_error:
+        write_spectra(workbook, sheet_name, raw_file.nspectra, raw_file.data.slice, headers, 
+                      num_format, spectra_per_sheet, rows_per_chunk)
+    else:
+        with raw_file._open() as ms_file:
+            write_spectra(workbook, sheet_name, raw_file.nspectra, ms_file.get_spectra_range, 
+                          headers, num_format, spectra_per_sheet, rows_per_chunk)
+
+
+def stream_raw_file(raw_file,
+                    output_path,
+                    rounding=False,
+                    decimals=2,
+                    spectra_per_sheet=EXCEL_MAX_COLS//2,
+                    rows_per_chunk=1024):
+    # same layout as RawFile.to_excel, written in constant memory. Scans that
+    # are not loaded yet are pulled from the reader one sheet at a time
+    # instead of being loaded into the RawFile
+    options = {'constant_memory': True}
+    with xlsxwriter.Workbook(Path(output_path).as_posix(), options) as workbook:
+        workbook.use_zip64()
+        if rounding:
+            num_format = workbook.add_format({'num_format': '0.'+'0'*decimals})
+        else:
+            num_format = None
+        _write_scans(workbook, "Spectra", raw_file, num_format, spectra_per_sheet, rows_per_chunk)
+        average = ScanStore.from_spectra([raw_file.data_avg] if raw_file.data_avg is not None else [])
+        write_spectra(workbook, "Average", average.nspectra, average.slice,
+                      lambda start, stop: [["m/z", "Intensity"]], None, 1, rows_per_chunk)
+    return
+
+
+def stream_collection(collection,
+                      output_path,
+                      averages=None,
+                      scans=False,
+                      spectra_per_sheet=EXCEL_MAX_COLS//2,
+                      rows_per_chunk=1024):
+    # same layout as RawFileCollection.to_excel in constant memory. With
+    # scans=True every scan of every file is added, one file at a time
+    averages = collection.averages if averages is None else averages
+    options = {'constant_memory': True}
+    with xlsxwriter.Workbook(Path(output_path).as_posix(), options) as workbook:
+        workbook.use_zip64()
+        files = collection.files
+        write_spectra(workbook, "Avg spectrum", averages.nspectra, averages.slice,
+                      lambda start, stop: [[x for i in range(start, stop) for x in (files[i], None)],
+                                           ["m/z", "Intensity"]*(stop - start)],
+                      None, spectra_per_sheet, rows_per_chunk)
+        if collection.track_mass is not None:
+            masses = collection.track_masses
+            track_area = np.array(collection.track_area).reshape(collection.nfiles, -1)
+            values = np.column_stack([np.arange(1, collection.nfiles + 1), track_area, 
+                                      np.array(collection.total_area)])
+            name = "Integrated m-z" if np.ndim(collection.track_mass) else f"Integrated {collection.track_mass} m-z "
+            worksheet = workbook.add_worksheet(name)
+            worksheet.write_row(0, 0, ["Scan number"] + [f"{mass} Count" for mass in masses] + ["Total Count"])
+            for irow, row in enumerate(values):
+                worksheet.write_row(irow + 1, 0, row)
+        if scans:
+            for name, raw_file in zip(files, collection.raw_files):
+                _write_scans(workbook, Path(name).stem, raw_file, None, spectra_per_sheet, rows_per_chunk)
+    return
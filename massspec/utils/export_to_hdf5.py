@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+HDF5 export. Every raw file is a group of the HDF5 file holding
+
+    mz, intensity   flat buffers of all scans, chunked and compressed, float64
+                    unless a ``precision`` is given (scaled integer
+                    intensities are written as float32)
+    offsets         scan i spans offsets[i]:offsets[i+1] of the buffers
+    rt              start time of every scan
+    average         averaged spectrum, (n, 2), when the file has one
+
+Files are added one at a time and only the scans matching a time window are
+read back, the m/z window is then applied while reading them.
+"""
+import numpy as np
+from pathlib import Path
+from ..core.scans import ScanStore
+from ..core.precision import StoragePrecision
+from .export_to_parquet import COLUMNS
+
+
+def write_hdf5(raw_file,
+               output_path,
+               name=None,
+               compression='gzip',
+               compression_opts=4,
+               chunk_points=65536,
+               scans_per_chunk=1024,
+               precision=None):
+    # adds (or replaces) the group of one raw file. Scans that are not loaded
+    # are read from the file one group at a time
+    import h5py
+    dtypes = dict(zip(['mz', 'intensity'], StoragePrecision.create(precision).memory_dtypes))
+    name = raw_file.filename.stem if name is None else name
+    options = dict(compression=compression, compression_opts=compression_opts, shuffle=True)
+    if compression is None:
+        options = {}
+    path = Path(output_path)
+    with h5py.File(path.as_posix(), 'a') as h5:
+        if name in h5:
+            del h5[name]
+        group = h5.create_group(name)
+        group.attrs['source'] = str(raw_file.filename)
+        if raw_file.mass_resolution is not None:
+            group.attrs['mass_resolution'] = raw_file.mass_resolution
+        buffers = {}
+        for key in ['mz', 'intensity']:
+            buffers[key] = group.create_dataset(key, shape=(0,), maxshape=(None,), dtype=dtypes[key],
+                                                chunks=(chunk_points,), **options)
+        offsets = [np.zeros(1, dtype=np.int64)]
+        npoints = 0
+        for start, store in raw_file.iter_spectra(scans_per_chunk):
+            for key, values in [('mz', store.mz), ('intensity', store.intensity)]:
+                buffers[key].resize((npoints + store.npoints,))
+                buffers[key][npoints:] = values
+            offsets.append(store.offsets[1:] + npoints)
+            npoints += store.npoints
+        group.create_dataset('offsets', data=np.concatenate(offsets))
+        group.create_dataset('rt', data=raw_file.start_times)
+        if raw_file.data_avg is not None:
+            group.create_dataset('average', data=np.asarray(raw_file.data_avg, dtype=float), **options)
+    return path
+
+
+def collection_to_hdf5(collection, output_path, **kwargs):
+    for raw_file in collection.raw_files:
+        write_hdf5(raw_file, output_path, **kwargs)
+    return Path(output_path)
+
+
+def _selected_scans(rt, bounds):
+    if bounds is None:
+        return np.arange(len(rt))
+    low, high = bounds
+    keep = np.ones(len(rt), dtype=bool)
+    if low is not None:
+        keep &= rt >= low
+    if high is not None:
+        keep &= rt <= high
+    return np.nonzero(keep)[0]
+
+
+def read_spectra(group, rt=None):
+    # ScanStore of the scans of one group within the (low, high) time window,
+    # their (0-based) scan numbers and start times. Only the points between
+    # the first and the last selected scan are read
+    offsets = group['offsets'][:]
+    times = group['rt'][:]
+    scans = _selected_scans(times, rt)
+    if len(scans) == 0:
+        return ScanStore.from_spectra([]), scans, times[:0]
+    first, last = offsets[scans[0]], offsets[scans[-1] + 1]
+    store = ScanStore(group['mz'][first:last], group['intensity'][first:last],
+                      offsets[scans[0]:scans[-1] + 2] - first)
+    if len(scans) < scans[-1] - scans[0] + 1:
+        store = store.take(scans - scans[0])
+    return store, scans, times[scans]
+
+
+def read_hdf5(path, mz=None, rt=None, files=None):
+    """
+    Reads the groups of an HDF5 file in the long format of the Parquet
+    export (file, scan, rt, mz, intensity) as a pandas DataFrame. ``mz`` and
+    ``rt`` are (low, high) ranges and ``files`` a list of file names.
+    """
+    import h5py
+    import pandas as pd
+    frames = []
+    with h5py.File(Path(path).as_posix(), 'r') as h5:
+        names = list(h5) if files is None else [Path(x).stem for x in np.atleast_1d(files)]
+        for name in names:
+            if name not in h5:
+                continue
+            store, scans, times = read_spectra(h5[name], rt)
+            scan_index = store.scan_index
+            keep = np.ones(store.npoints, dtype=bool)
+            if mz is not None:
+                low, high = mz
+                if low is not None:
+                    keep &= store.mz >= low
+                if high is not None:
+                    keep &= store.mz <= high
+            frames.append(pd.DataFrame({'file': name,
+                                        'scan': (scans[scan_index] + 1)[keep].astype(np.int32),
+                                        'rt': times[scan_index][keep],
+                                        'mz': store.mz[keep],
+                                        'intensity': store.intensity[keep]}))
+    if len(frames) == 0:
+        return pd.DataFrame({x: [] for x in COLUMNS})
+    return pd.concat(frames, ignore_index=True)
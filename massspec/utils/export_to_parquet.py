@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Long format Parquet/Arrow export: one row per point with the columns
+
+    file       name of the raw file (stem)
+    scan       scan number, starting at 1
+    rt         start time of the scan
+    mz         m/z
+    intensity  intensity
+
+A raw file is written as one Parquet file with one row group per group of
+scans, so row group statistics let readers skip scans by time. A run is a
+directory with one part per raw file, which can be appended to one file at
+a time and is read by pandas, pyarrow or Spark as a single dataset.
+"""
+import numpy as np
+from pathlib import Path
+from ..core.scans import ScanStore
+
+COLUMNS = ['file', 'scan', 'rt', 'mz', 'intensity']
+
+
+def _schema(source=None):
+    import pyarrow as pa
+    metadata = {'massspec.source': str(source)} if source is not None else None
+    return pa.schema([('file', pa.string()),
+                      ('scan', pa.int32()),
+                      ('rt', pa.float64()),
+                      ('mz', pa.float64()),
+                      ('intensity', pa.float64())], metadata=metadata)
+
+
+def scans_table(store: ScanStore, name, start_times, first_scan=0, source=None):
+    # Arrow table of the scans of a store, first_scan is the 0-based number
+    # of the first scan of the store in its file
+    import pyarrow as pa
+    scans = first_scan + store.scan_index
+    start_times = np.asarray(start_times, dtype=float)
+    return pa.Table.from_arrays([pa.repeat(pa.scalar(name, pa.string()), store.npoints),
+                                 pa.array(scans + 1, pa.int32()),
+                                 pa.array(start_times[scans], pa.float64()),
+                                 pa.array(np.asarray(store.mz, dtype=float)),
+                                 pa.array(np.asarray(store.intensity, dtype=float))],
+                                schema=_schema(source))
+
+
+def raw_file_table(raw_file, name=None):
+    # the whole file as one in-memory Arrow table
+    import pyarrow as pa
+    name = raw_file.filename.stem if name is None else name
+    start_times = raw_file.start_times
+    tables = [scans_table(store, name, start_times, start, raw_file.filename)
+              for start, store in raw_file.iter_spectra()]
+    if len(tables) == 0:
+        return _schema(raw_file.filename).empty_table()
+    return pa.concat_tables(tables)
+
+
+def write_parquet(raw_file,
+                  output_path,
+                  name=None,
+                  compression='zstd',
+                  scans_per_group=256):
+    # one row group per ``scans_per_group`` scans. Scans that are not loaded
+    # are read from the file one row group at a time
+    import pyarrow.parquet as pq
+    name = raw_file.filename.stem if name is None else name
+    start_times = raw_file.start_times
+    path = Path(output_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with pq.ParquetWriter(path.as_posix(), _schema(raw_file.filename), compression=compression) as writer:
+        for start, store in raw_file.iter_spectra(scans_per_group):
+            table = scans_table(store, name, start_times, start, raw_file.filename)
+            writer.write_table(table, row_group_size=max(len(table), 1))
+    return path
+
+
+def append_parquet(raw_file, directory, name=None, compression='zstd', scans_per_group=256):
+    # adds (or replaces) the part of one raw file in a run directory
+    name = raw_file.filename.stem if name is None else name
+    return write_parquet(raw_file, Path(directory) / f"{name}.parquet", name=name,
+                         compression=compression, scans_per_group=scans_per_group)
+
+
+def collection_to_parquet(collection, directory, compression='zstd', scans_per_group=256):
+    paths = []
+    for raw_file in collection.raw_files:
+        paths.append(append_parquet(raw_file, directory, compression=compression,
+                                    scans_per_group=scans_per_group))
+    return paths
+
+
+def _filter(mz=None, rt=None, files=None):
+    # (low, high) ranges, both ends included, and a list of file names
+    import pyarrow.dataset as ds
+    expression = None
+    for field, bounds in [('mz', mz), ('rt', rt)]:
+        if bounds is None:
+            continue
+        low, high = bounds
+        if low is not None:
+            term = ds.field(field) >= low
+            expression = term if expression is None else expression & term
+        if high is not None:
+            term = ds.field(field) <= high
+            expression = term if expression is None else expression & term
+    if files is not None:
+        term = ds.field('file').isin([Path(x).stem for x in np.atleast_1d(files)])
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def read_parquet(path, mz=None, rt=None, files=None, columns=None, as_table=False):
+    """
+    Reads a Parquet file or a run directory as a pandas DataFrame (or an
+    Arrow table with ``as_table=True``). ``mz`` and ``rt`` are (low, high)
+    ranges and ``files`` a list of file names; they are pushed down to the
+    Parquet reader, which skips the parts and row groups that can not match.
+    """
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(Path(path).as_posix(), format='parquet')
+    table = dataset.to_table(columns=columns, filter=_filter(mz, rt, files))
+    return table if as_table else table.to_pandas()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic runs for benchmarks and for trying the package without an
+instrument. A run is a set of compounds with an isotope pattern and an
+elution profile; every scan is a profile mode spectrum of the compounds
+eluting at its start time, on a slightly jittered m/z axis, over a noisy
+baseline. Runs are written in the npz format read by ``NpzReader``.
+"""
+from pathlib import Path
+import numpy as np
+from ..core.readers import write_npz
+from ..core.scans import ScanStore
+
+ISOTOPE_SPACING = 1.00336
+
+
+class SyntheticRun(object):
+    """
+    ``peak_density`` is the number of compounds per 100 m/z, ``resolution``
+    the m/z over the full width at half maximum of the peaks and ``noise``
+    the standard deviation of the baseline noise. Compounds elute over
+    ``elution_width`` (a fraction of the run) around a random time.
+    """
+    def __init__(self,
+                 nscans=100,
+                 npoints=2000,
+                 mz_range=(100, 1000),
+                 peak_density=2,
+                 resolution=2000,
+                 noise=20,
+                 baseline=50,
+                 scan_time=0.01,
+                 elution_width=0.3,
+                 seed=None):
+        self.nscans = nscans
+        self.npoints = npoints
+        self.mz_range = mz_range
+        self.peak_density = peak_density
+        self.resolution = resolution
+        self.noise = noise
+        self.baseline = baseline
+        self.scan_time = scan_time
+        self.elution_width = elution_width
+        self.rng = np.random.default_rng(seed)
+        low, high = mz_range
+        ncompounds = max(int(peak_density*(high - low)/100), 1)
+        self.masses = np.sort(self.rng.uniform(low, high, ncompounds))
+        self.heights = self.rng.lognormal(np.log(5000), 1, ncompounds)
+        self.retention = self.rng.uniform(0, 1, ncompounds)
+        # intensity of the M+1, M+2 peaks, roughly one carbon per 14 Da
+        carbons = self.masses/14
+        self.isotopes = np.column_stack([np.ones(ncompounds), 0.011*carbons, (0.011*carbons)**2/2])
+
+    def peaks(self, iscan):
+        # m/z and height of the peaks of a scan
+        t = iscan/max(self.nscans - 1, 1)
+        elution = np.exp(-0.5*((t - self.retention)/(self.elution_width/2.355))**2)
+        mz = self.masses[:, None] + ISOTOPE_SPACING*np.arange(self.isotopes.shape[1])
+        height = (self.heights*elution)[:, None]*self.isotopes
+        keep = height.ravel() > self.noise
+        return mz.ravel()[keep], height.ravel()[keep]
+
+    def scan(self, iscan):
+        low, high = self.mz_range
+        npoints = max(int(self.npoints*self.rng.uniform(0.95, 1.05)), 2)
+        step = (high - low)/npoints
+        mz = low + step*(np.arange(npoints) + self.rng.uniform(-0.2, 0.2, npoints))
+        intensity = self.baseline + self.noise*np.abs(self.rng.standard_normal(npoints))
+        centers, heights = self.peaks(iscan)
+        sigma = centers/self.resolution/2.355
+        # every peak is added on the points within 4 sigma of its center
+        width = int(np.ceil(4*sigma.max()/step)) + 1 if len(centers) > 0 else 0
+        index = np.searchsorted(mz, centers - 4*sigma)[:, None] + np.arange(2*width + 1)
+        inside = index < npoints
+        index = np.minimum(index, npoints - 1)
+        distance = (mz[index] - centers[:, None])/sigma[:, None]
+        inside &= np.abs(distance) <= 4
+        np.add.at(intensity, index[inside], (heights[:, None]*np.exp(-0.5*distance**2))[inside])
+        return mz, intensity
+
+    def spectra(self):
+        lengths, mz, intensity = [], [], []
+        for iscan in range(self.nscans):
+            x, y = self.scan(iscan)
+            mz.append(x)
+            intensity.append(y)
+            lengths.append(len(x))
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return ScanStore(np.concatenate(mz), np.concatenate(intensity), offsets)
+
+    def headers(self, spectra):
+        # the fields of the MSFileReader scan headers used by the package
+        tic = spectra.sum()
+        base = spectra.base_peaks() if spectra.npoints > 0 else np.zeros((0, 2))
+        low, high = spectra.mz_range() if spectra.npoints > 0 else (np.zeros(0), np.zeros(0))
+        return [dict(ScanNumber=i + 1,
+                     StartTime=i*self.scan_time,
+                     TIC=float(tic[i]),
+                     BasePeakMass=float(base[i, 0]),
+                     BasePeakIntensity=float(base[i, 1]),
+                     LowMass=float(low[i]),
+                     HighMass=float(high[i]),
+                     NumPackets=int(spectra.lengths[i]))
+                for i in range(spectra.nspectra)]
+
+    def average(self, spectra):
+        # mean of the scans on a regular m/z axis, like the averaged
+        # spectrum of the acquisition software
+        low, high = self.mz_range
+        mz = np.linspace(low, high, self.npoints)
+        intensity = np.zeros(self.npoints)
+        for spectrum in spectra:
+            intensity += np.interp(mz, spectrum[:, 0], spectrum[:, 1])
+        return np.column_stack([mz, intensity/max(spectra.nspectra, 1)])
+
+    def write(self, filename):
+        spectra = self.spectra()
+        write_npz(filename, spectra, self.headers(spectra), average=self.average(spectra),
+                  mass_resolution=float(np.mean(self.mz_range))/self.resolution)
+        return Path(filename)
+
+
+def write_synthetic_run(filename, **kwargs):
+    return SyntheticRun(**kwargs).write(filename)
+
+
+def write_synthetic_directory(directory, nfiles=10, prefix='run_', seed=0, **kwargs):
+    # nfiles runs numbered like the files of an acquisition, returns the paths
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    return [write_synthetic_run(directory / f"{prefix}{i + 1}.npz", seed=seed + i, **kwargs)
+            for i in range(nfiles)]
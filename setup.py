@@ -1,2 +1,12 @@
 # -*- coding: utf-8 -*-
+from setuptools import setup, find_packages
 
+setup(name='massspec',
+      packages=find_packages(),
+      package_data={'massspec.utils': ['tavadze.mplstyle']},
+      install_requires=['numpy', 'scipy', 'matplotlib', 'xlsxwriter', 'watchdog'],
+      extras_require={'parquet': ['pyarrow'],
+                      'hdf5': ['h5py'],
+                      'dash': ['dash'],
+                      'zstd': ['zstandard']},
+      entry_points={'console_scripts': ['massspec=massspec.cli:main']})
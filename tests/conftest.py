@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+import pytest
+from massspec.utils.synthetic import SyntheticRun
+
+
+@pytest.fixture(scope='session')
+def run():
+    # enough points per scan to resolve the synthetic peaks
+    return SyntheticRun(nscans=12, npoints=20000, seed=3)
+
+
+@pytest.fixture(scope='session')
+def spectra(run):
+    return run.spectra()
+
+
+@pytest.fixture(scope='session')
+def npz_file(run, tmp_path_factory):
+    return run.write(tmp_path_factory.mktemp('run') / 'run_1.npz')
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+The vectorized code paths against the per-scan reference they replace.
+"""
+import numpy as np
+import pytest
+from scipy.interpolate import CubicSpline, PchipInterpolator
+from scipy.signal import find_peaks, peak_widths
+from massspec.core import RawFile, SpectrumCache, NpzReader, write_npz
+from massspec.core.interpolation import BatchInterpolator
+from massspec.core.xic import ChromatogramExtractor
+from massspec.core.peaks import pick_peaks
+from massspec.core.precision import error_bounds
+from massspec.utils.synthetic import SyntheticRun
+
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+REFERENCE = {'linear': lambda x, y: (lambda q: np.interp(q, x, y)),
+             'cubic': lambda x, y: CubicSpline(x, y, bc_type='natural'),
+             'pchip': PchipInterpolator}
+
+
+@pytest.mark.parametrize('kind', list(REFERENCE))
+def test_interpolator_matches_scipy(spectra, kind):
+    interpolator = BatchInterpolator(spectra, kind=kind)
+    rng = np.random.default_rng(0)
+    for iscan in range(spectra.nspectra):
+        x, y = spectra.scan(iscan)
+        query = np.sort(rng.uniform(x[0], x[-1], 500))
+        expected = REFERENCE[kind](x, y)(query)
+        np.testing.assert_allclose(interpolator(query, iscan), expected,
+                                   rtol=1e-9, atol=1e-9*np.abs(y).max())
+    # outside the m/z range of a scan
+    x, _ = spectra.scan(0)
+    assert np.isnan(interpolator([x[0] - 1, x[-1] + 1], 0)).all()
+
+
+def test_resample_keeps_scan_ends(spectra):
+    resampled = BatchInterpolator(spectra, kind='cubic').resample(2)
+    assert np.isfinite(resampled.intensity).all()
+    np.testing.assert_array_equal(resampled.mz_range()[0], spectra.mz_range()[0])
+    np.testing.assert_array_equal(resampled.mz_range()[1], spectra.mz_range()[1])
+
+
+@pytest.mark.parametrize('dx', [None, 0.5])
+def test_xic_matches_trapezoid(run, spectra, dx):
+    masses = run.masses[:10]
+    delta_mz = 0.3
+    areas = ChromatogramExtractor(spectra).extract(masses, delta_mz=delta_mz, dx=dx)
+    for iscan in range(spectra.nspectra):
+        x, y = spectra.scan(iscan)
+        for k, mass in enumerate(masses):
+            # open windows, as the track_mass masks
+            inside = (x > mass - delta_mz) & (x < mass + delta_mz)
+            if dx is None:
+                expected = trapezoid(y[inside], x[inside])
+            else:
+                expected = trapezoid(y[inside], dx=dx)
+            assert areas[k, iscan] == pytest.approx(expected, rel=1e-9, abs=1e-6)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_pick_peaks_matches_find_peaks(spectra, n_jobs):
+    prominence = 500.0
+    table = pick_peaks(spectra, prominence=prominence, n_jobs=n_jobs, chunk_scans=5)
+    assert len(table) > 0
+    for iscan in range(spectra.nspectra):
+        x, y = spectra.scan(iscan)
+        peaks, properties = find_peaks(y, prominence=prominence)
+        rows = table[table['scan'] == iscan]
+        np.testing.assert_array_equal(rows['index'], peaks)
+        np.testing.assert_allclose(rows['prominence'], properties['prominences'])
+        np.testing.assert_allclose(rows['mz'], x[peaks])
+        left, right = peak_widths(y, peaks, rel_height=0.5)[2:]
+        width = np.interp(right, np.arange(len(x)), x) - np.interp(left, np.arange(len(x)), x)
+        np.testing.assert_allclose(rows['width'], width, rtol=1e-9)
+
+
+# largest errors relative to the value (m/z, float intensities) or to the
+# base peak (scaled intensities, half a step plus the float32 they are
+# decoded to), see the precision module
+LIMITS = {'float64': 0.0, 'float32': 6e-8, 'uint16': 1/131070 + 6e-8, 'uint32': 1/8589934590 + 6e-8}
+
+
+def assert_bounds_equal(measured, bounds):
+    assert measured.keys() == bounds.keys()
+    for key in measured:
+        assert measured[key] == pytest.approx(bounds[key])
+
+
+@pytest.mark.parametrize('intensity', list(LIMITS))
+@pytest.mark.parametrize('compression', [None, 'zlib', 'zstd'])
+def test_npz_round_trip(spectra, tmp_path, intensity, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    precision = dict(mz='float32' if intensity != 'float64' else 'float64', intensity=intensity)
+    filename = tmp_path / 'run_1.npz'
+    bounds = write_npz(filename, spectra, precision=precision, compression=compression)
+    with NpzReader(filename) as ms_file:
+        stored = ms_file.get_spectra()
+    np.testing.assert_array_equal(stored.offsets, spectra.offsets)
+    measured = error_bounds(spectra, stored)
+    assert_bounds_equal(measured, bounds)
+    assert measured['mz']['max_rel'] <= LIMITS[precision['mz']]
+    key = 'max_rel_base_peak' if intensity.startswith('uint') else 'max_rel'
+    assert measured['intensity'][key] <= LIMITS[intensity]
+
+
+@pytest.mark.parametrize('precision', [None, 'float32', 'uint16'])
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_cache_round_trip(npz_file, tmp_path, precision, compression):
+    with NpzReader(npz_file) as ms_file:
+        reference = ms_file.get_spectra()
+    cache = SpectrumCache(tmp_path, reader='npz', precision=precision, compression=compression)
+    # the second open reads the cache file written by the first
+    for _ in range(2):
+        with cache.open(npz_file) as ms_file:
+            stored = ms_file.get_spectra()
+            bounds = ms_file.error_bounds
+        assert_bounds_equal(error_bounds(reference, stored), bounds)
+    if precision is None:
+        np.testing.assert_array_equal(stored.mz, reference.mz)
+        np.testing.assert_array_equal(stored.intensity, reference.intensity)
+    else:
+        key = 'max_rel_base_peak' if precision == 'uint16' else 'max_rel'
+        assert bounds['intensity'][key] <= LIMITS[precision]
+
+
+def _sheets(path):
+    openpyxl = pytest.importorskip('openpyxl')
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    ret = {name: [list(row) for row in workbook[name].iter_rows(values_only=True)]
+           for name in workbook.sheetnames}
+    workbook.close()
+    return ret
+
+
+def test_streamed_excel_matches_regular(tmp_path):
+    filename = SyntheticRun(nscans=5, npoints=300, seed=1).write(tmp_path / 'run_1.npz')
+    raw_file = RawFile(filename, reader='npz')
+    raw_file.to_excel(tmp_path / 'regular.xlsx')
+    raw_file.to_excel(tmp_path / 'streamed.xlsx', streaming=True, rows_per_chunk=64)
+    regular, streamed = _sheets(tmp_path / 'regular.xlsx'), _sheets(tmp_path / 'streamed.xlsx')
+    assert list(regular) == list(streamed)
+    for name in regular:
+        # trailing empty cells of ragged columns are not written
+        width = max(len(row) for row in regular[name] + streamed[name])
+        pad = lambda table: [row + [None]*(width - len(row)) for row in table]
+        assert pad(streamed[name]) == pad(regular[name])